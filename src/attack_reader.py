@@ -0,0 +1,119 @@
+import gzip
+import itertools
+import os
+
+import ijson
+
+# the properties of ATT&CK objects read by parse_mappings, mappings_to_heatmaps, list_mappings and the other stages
+# which only need to resolve techniques, and by mappings_to_coverage to group them by tactic.
+# substitute needs the complete objects and reads them with iter_objects
+PIPELINE_FIELDS = ("type", "id", "name", "external_references", "revoked", "x_mitre_deprecated",
+                   "kill_chain_phases", "x_mitre_shortname")
+
+# bundles whose file name ends with this suffix are gzip compressed, see open_bundle
+GZIP_SUFFIX = ".gz"
+GZIP_LEVEL = 6  # most of the size reduction of level 9 for a fraction of the time
+
+
+def other_variant(path):
+    """return the path of the compressed variant of an uncompressed bundle path, and vice versa"""
+    path = str(path)
+    return path[:-len(GZIP_SUFFIX)] if path.endswith(GZIP_SUFFIX) else path + GZIP_SUFFIX
+
+
+def find_bundle(path):
+    """return path if it exists, else its compressed or uncompressed variant if that exists, else None.
+    Lets readers find a bundle whether or not it was written compressed"""
+    for candidate in [str(path), other_variant(path)]:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def open_bundle(path, mode="r"):
+    """open the bundle file at path like open, transparently compressing or decompressing it with gzip
+    if its name ends with GZIP_SUFFIX. Text modes use UTF-8"""
+    encoding = None if "b" in mode else "utf-8"
+    if str(path).endswith(GZIP_SUFFIX):
+        mode = mode if "b" in mode else mode + "t"
+        return gzip.open(path, mode, compresslevel=GZIP_LEVEL, encoding=encoding)
+    return open(path, mode, encoding=encoding)
+
+
+def project(sdo, fields):
+    """return a copy of sdo holding only the given fields. Only the first external reference
+    (the ATT&CK ID) is kept"""
+    projected = {field: sdo[field] for field in fields if field in sdo}
+    if "external_references" in projected:
+        projected["external_references"] = projected["external_references"][:1]
+    return projected
+
+
+def iter_objects(path):
+    """incrementally parse the STIX bundle at path, yielding its objects one at a time
+    without ever holding the whole bundle in memory. The bundle may be gzip compressed, see open_bundle"""
+    with open_bundle(path, "rb") as f:
+        yield from ijson.items(f, "objects.item", use_float=True)
+
+
+def load_objects(path, fields=PIPELINE_FIELDS, exclude_types=("relationship",)):
+    """incrementally parse the STIX bundle at path and return a list of its objects, projected onto fields.
+    :param path: the filepath to the STIX bundle, e.g. enterprise-attack-v12.1.json
+    :param fields: the object properties to keep, all other properties are discarded while parsing
+    :param exclude_types: objects of these types are skipped entirely. Relationships are excluded by default
+                          because the stages only ever resolve the targets of mappings
+    """
+    return [project(sdo, fields) for sdo in iter_objects(path) if sdo["type"] not in exclude_types]
+
+
+class ObjectStore:
+    """helper class holding the objects of several ATT&CK releases, each unique object once. Objects are keyed by
+    their STIX ID and modified timestamp, which identify one version of a STIX object, so an object unchanged
+    between releases is loaded into memory once and shared by every release holding it. Each release is a list
+    of keys into the store.
+
+    Objects are projected onto fields and objects of exclude_types are skipped, as in load_objects
+    """
+    def __init__(self, fields=PIPELINE_FIELDS, exclude_types=("relationship",)):
+        """constructor"""
+        self.fields = fields
+        self.exclude_types = exclude_types
+        self.objects = {}  # {(STIX ID, modified): object}
+        self.releases = {}  # {release name: [(STIX ID, modified)]}
+
+    @staticmethod
+    def key(sdo):
+        """return the key of a STIX object in the store. Objects without a modified timestamp, such as
+        marking definitions, are keyed by their created timestamp"""
+        return sdo["id"], sdo.get("modified", sdo.get("created"))
+
+    def add_release(self, name, path):
+        """incrementally parse the STIX bundle at path into the store as the release name, replacing the
+        release of that name if any, and return its objects as load_objects would"""
+        keys = []
+        for sdo in iter_objects(path):
+            if sdo["type"] in self.exclude_types:
+                continue
+            key = self.key(sdo)
+            if key not in self.objects:
+                self.objects[key] = project(sdo, self.fields)
+            keys.append(key)
+        replaced = name in self.releases
+        self.releases[name] = keys
+        if replaced:
+            self.prune()
+        return self.release(name)
+
+    def release(self, name):
+        """return the objects of the release name"""
+        return [self.objects[key] for key in self.releases[name]]
+
+    def remove_release(self, name):
+        """remove the release name, and the objects no other release holds"""
+        del self.releases[name]
+        self.prune()
+
+    def prune(self):
+        """remove the objects no release holds"""
+        held = set(itertools.chain.from_iterable(self.releases.values()))
+        self.objects = {key: sdo for key, sdo in self.objects.items() if key in held}
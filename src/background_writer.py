@@ -0,0 +1,77 @@
+import queue
+import threading
+
+
+class BackgroundWriter:
+    """helper class running write jobs (serializing and saving finished outputs) on a small pool of
+    background threads, so that the calling thread can move on to the next stage while they run.
+
+    Jobs are queued with submit; at most max_pending jobs wait in the queue, after which submit blocks
+    so that finished outputs don't pile up in memory. flush waits for every queued job and raises the
+    first error raised by a job. Errors are raised once, so that a long-lived writer, e.g. the daemon's, can
+    be used again after a failed job. Use as a context manager to flush and stop the threads on exit.
+
+    With no workers, jobs are run by submit in the calling thread, e.g. so that they can be profiled.
+    """
+    def __init__(self, workers=2, max_pending=4):
+        """constructor"""
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        self.errors_lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        """worker thread loop: run jobs until the None sentinel is received"""
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                func, args, kwargs = job
+                func(*args, **kwargs)
+            # parse_mappings and list_mappings exit on invalid input, which mustn't stop the worker thread
+            except (Exception, SystemExit) as err:
+                with self.errors_lock:
+                    self.errors.append(err)
+            finally:
+                self.queue.task_done()
+
+    def raise_errors(self):
+        """raise the first error raised by a job since errors were last raised, if any, and forget the others"""
+        with self.errors_lock:
+            errors, self.errors = self.errors, []
+        if errors:
+            raise errors[0]
+
+    def submit(self, func, *args, **kwargs):
+        """queue func(*args, **kwargs) to be run by a background thread. Blocks while the queue is full.
+        Raises the error of an earlier failed job instead of queueing more work"""
+        self.raise_errors()
+        if not self.threads:
+            func(*args, **kwargs)
+            return
+        self.queue.put((func, args, kwargs))
+
+    def flush(self):
+        """wait until every queued job has finished, then raise the first error raised by a job, if any"""
+        self.queue.join()
+        self.raise_errors()
+
+    def close(self):
+        """wait for the queued jobs and stop the threads. Does not raise job errors, see flush"""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.close()
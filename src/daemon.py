@@ -0,0 +1,332 @@
+import argparse
+import json
+import os
+import pathlib
+import socket
+import socketserver
+import threading
+import time
+import traceback
+
+from colorama import Fore
+
+import attack_reader
+import background_writer
+import make
+
+DEFAULT_SOCKET = make.PROJECT_FOLDER / ".make-daemon.sock"
+
+
+class BuildDaemon:
+    """helper class keeping the parsed ATT&CK releases, their indexes and the parsed controls resident between
+    builds, so that a change to a mappings or controls file only rebuilds the outputs of the (ATT&CK version,
+    framework) pairs it affects, without paying for the imports and the ATT&CK parse again. The comparison of the
+    frameworks of each rebuilt ATT&CK version is rewritten afterwards, from the mappings of the other frameworks
+    as last built.
+
+    Cached data is reloaded when the modification time of the file it was read from changes. Builds are
+    serialized, and return once the mappings, layers and comparisons are saved. The bulk exports of
+    make.build_domain_exports (substituted bundle, list of mappings, Feather, SQLite and index) are then built
+    on a background thread, one pair after the other; their errors are reported with the next request.
+    """
+    def __init__(self, dedup_layers=False, output_folder=make.PROJECT_FOLDER, compress=False, archive_layers=False):
+        """constructor
+        :param dedup_layers: see make.main
+        :param output_folder: see make.main
+        :param compress: see make.main
+        :param archive_layers: see make.main
+        """
+        self.dedup_layers = dedup_layers
+        self.output_folder = output_folder
+        self.compress = compress
+        self.archive_layers = archive_layers
+        self.writer = background_writer.BackgroundWriter()
+        self.export_writer = background_writer.BackgroundWriter(workers=1, max_pending=64)
+        self.export_errors = []  # errors of the exports since they were last reported, see handle_request
+        self.export_errors_lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self.store = attack_reader.ObjectStore()  # objects unchanged between ATT&CK versions are held once
+        self.domain_data = {}  # {(attack_version, domain): (mtime, make.load_domain output)}
+        self.controls = {}  # {(attack_version, framework): [mtime, make.build_controls output, saved]}
+        self.relationships = {}  # {(attack_version, framework, domain): relationship cache of parse_mappings}
+        self.mappings = {}  # {(attack_version, framework, domain): mappings as plain STIX objects}
+
+    def get_domain(self, attack_version, domain):
+        """return make.load_domain output for the ATT&CK version and domain, loading it if not cached or stale"""
+        key = (attack_version, domain)
+        if key in self.domain_data:
+            mtime, data = self.domain_data[key]
+            if os.stat(data[0]).st_mtime_ns == mtime:
+                return data
+        data = make.load_domain(attack_version, domain, self.store)
+        self.domain_data[key] = (os.stat(data[0]).st_mtime_ns, data)
+        return data
+
+    def get_controls(self, attack_version, framework, save=False):
+        """return make.build_controls output for the ATT&CK version and framework, parsing the controls
+        if not cached or if the controls file changed
+        :param save: save the controls unless they were saved since they were parsed, see make.save_controls
+        """
+        key = (attack_version, framework)
+        mtime = os.stat(make.controls_file(framework)).st_mtime_ns
+        if key not in self.controls or self.controls[key][0] != mtime:
+            self.controls[key] = [mtime, make.build_controls(attack_version, framework, None, self.output_folder,
+                                                             self.compress), False]
+        if save and not self.controls[key][2]:
+            make.save_controls(attack_version, framework, *self.controls[key][1], self.writer, self.output_folder,
+                               self.compress)
+            self.controls[key][2] = True
+        return self.controls[key][1]
+
+    def get_mappings(self, attack_version, framework, domain):
+        """return the mappings of the ATT&CK version, framework and domain as plain STIX objects, as last built
+        by this daemon or, if it hasn't built them, as read from the saved bundle. Returns None if neither exists"""
+        key = (attack_version, framework, domain)
+        if key not in self.mappings:
+            dashed_framework = framework.replace('_', '-')
+            in_mappings = (self.output_folder / "frameworks" / f"attack_{attack_version}" / framework / "stix" /
+                           f"{dashed_framework}-{make.domain_infix_lookup[domain]}mappings"
+                           f"{make.bundle_suffix(self.compress)}")
+            if not in_mappings.exists():
+                return None  # never built
+            self.mappings[key] = list(attack_reader.iter_objects(in_mappings))
+        return self.mappings[key]
+
+    def pairs(self):
+        """return the (ATT&CK version, framework) pairs which have at least one mappings file"""
+        return [
+            (attack_version, framework)
+            for attack_version in make.ATTACK_VERSIONS
+            for framework in make.FRAMEWORKS
+            if any(make.mappings_file(attack_version, framework, domain).exists()
+                   for domain in make.domain_infix_lookup)
+        ]
+
+    def warm(self):
+        """load every ATT&CK release and parse every controls file used by the mappings, without writing any
+        output"""
+        for attack_version, framework in self.pairs():
+            self.get_controls(attack_version, framework)
+            for domain in make.domain_infix_lookup:
+                if make.mappings_file(attack_version, framework, domain).exists():
+                    self.get_domain(attack_version, domain)
+
+    def rebuild(self, attack_version, framework):
+        """rebuild the mappings and layers of every domain of one ATT&CK version and framework, and wait until they
+        are saved. Returns the arguments of export for each rebuilt domain, whose bulk exports are left to build"""
+        with self.build_lock:
+            controls_bundle, controls = self.get_controls(attack_version, framework, save=True)
+            built = []
+            for domain in make.domain_infix_lookup:
+                if not make.mappings_file(attack_version, framework, domain).exists():
+                    continue  # this framework has no mappings to this domain of ATT&CK
+                attack_path, attack_data, attack_index = self.get_domain(attack_version, domain)
+                relationship_cache = self.relationships.setdefault((attack_version, framework, domain), {})
+                self.mappings.pop((attack_version, framework, domain), None)  # read back if the build fails
+                self.mappings[(attack_version, framework, domain)] = make.build_domain_layers(
+                    attack_version, framework, domain, controls_bundle, controls, attack_data, attack_index,
+                    self.dedup_layers, self.writer, self.output_folder, relationship_cache, self.compress,
+                    self.archive_layers)
+                built.append((domain, attack_path, attack_data))
+            self.writer.flush()
+            # the first domain writes the controls to the SQLite database for every domain
+            return [(attack_version, framework, domain, controls, attack_path, attack_data,
+                     self.mappings[(attack_version, framework, domain)], index == 0)
+                    for index, (domain, attack_path, attack_data) in enumerate(built)]
+
+    def export(self, attack_version, framework, domain, controls, attack_path, attack_data, mappings,
+               write_controls=True):
+        """build the bulk exports of a domain rebuilt by rebuild, see make.build_domain_exports. Run on the
+        export thread, where the outputs are saved as they are built. Errors are kept for handle_request"""
+        try:
+            make.build_domain_exports(attack_version, framework, domain, controls, attack_path, attack_data,
+                                      mappings, background_writer.BackgroundWriter(workers=0), self.output_folder,
+                                      self.compress, write_controls=write_controls)
+        except (Exception, SystemExit) as err:
+            traceback.print_exc()
+            with self.export_errors_lock:
+                self.export_errors.append(f"{attack_version} {framework} {domain} exports: {err!r}")
+
+    def compare(self, attack_version):
+        """rewrite the comparison of the frameworks mapped to each domain of an ATT&CK version, see
+        make.compare_frameworks, and wait until it is saved. Frameworks which were never built are left out"""
+        with self.build_lock:
+            domain_data = {}
+            compared = {}  # {domain: {framework: (controls, mappings)}}
+            for pair_attack_version, framework in self.pairs():
+                if pair_attack_version != attack_version:
+                    continue
+                controls = self.get_controls(attack_version, framework)[1]
+                for domain in make.domain_infix_lookup:
+                    if not make.mappings_file(attack_version, framework, domain).exists():
+                        continue
+                    mappings = self.get_mappings(attack_version, framework, domain)
+                    if mappings is None:
+                        continue
+                    domain_data[domain] = self.get_domain(attack_version, domain)
+                    compared.setdefault(domain, {})[framework] = (controls, mappings)
+            make.compare_frameworks(attack_version, compared, domain_data, self.writer, self.output_folder)
+            self.writer.flush()
+
+    def handle_request(self, request):
+        """rebuild the pairs selected by a request of format {"attack_version": "12_1", "framework":
+        "nist800_53_r5", "wait": true}, where an omitted key selects every ATT&CK version or framework, then the
+        comparison of the frameworks of each rebuilt ATT&CK version. The response is sent once the layers are
+        saved, or with "wait" once the bulk exports are saved as well.
+        Returns a response of format {"rebuilt": [[attack_version, framework]], "errors": [error message]},
+        where the errors include those of the exports queued by earlier requests"""
+        response = {"rebuilt": [], "errors": []}
+        exports = []
+        for attack_version, framework in self.pairs():
+            if request.get("attack_version", attack_version) != attack_version:
+                continue
+            if request.get("framework", framework) != framework:
+                continue
+            try:
+                exports += self.rebuild(attack_version, framework)
+                response["rebuilt"].append([attack_version, framework])
+            # parse_mappings exits when the mappings don't validate, which mustn't stop the daemon
+            except (Exception, SystemExit) as err:
+                traceback.print_exc()
+                response["errors"].append(f"{attack_version} {framework}: {err!r}")
+        for attack_version in dict.fromkeys(attack_version for attack_version, _ in response["rebuilt"]):
+            try:
+                self.compare(attack_version)
+            except Exception as err:
+                traceback.print_exc()
+                response["errors"].append(f"{attack_version} comparison: {err!r}")
+        # queued once the layers and comparisons are saved, so that they don't hold up the response
+        for export in exports:
+            self.export_writer.submit(self.export, *export)
+        if request.get("wait"):
+            self.export_writer.flush()
+        with self.export_errors_lock:
+            response["errors"] += self.export_errors
+            self.export_errors = []
+        return response
+
+    def watched_files(self):
+        """return a dict of format {path: [(ATT&CK version, framework)]} of the pairs affected by each input file"""
+        affected = {}
+        for attack_version, framework in self.pairs():
+            affected.setdefault(make.controls_file(framework), []).append((attack_version, framework))
+            for domain in make.domain_infix_lookup:
+                in_mappings = make.mappings_file(attack_version, framework, domain)
+                if in_mappings.exists():
+                    affected.setdefault(in_mappings, []).append((attack_version, framework))
+        return affected
+
+    def watch(self, stop, interval=0.2):
+        """poll the mappings and controls files until the stop event is set, rebuilding the pairs affected by
+        each file whose modification time changed"""
+        mtimes = {path: path.stat().st_mtime_ns for path in self.watched_files()}
+        while not stop.wait(interval):
+            affected = self.watched_files()
+            changed = []
+            for path in affected:
+                mtime = path.stat().st_mtime_ns if path.exists() else None
+                if mtimes.get(path) != mtime:
+                    mtimes[path] = mtime
+                    changed += [pair for pair in affected[path] if pair not in changed]
+            for attack_version, framework in changed:
+                print(f"change detected, rebuilding {attack_version} {framework}")
+                start = time.perf_counter()
+                response = self.handle_request({"attack_version": attack_version, "framework": framework})
+                for error in response["errors"]:
+                    print(Fore.RED + f"ERROR: {error}" + Fore.RESET)
+                print(f"rebuilt {attack_version} {framework} in {time.perf_counter() - start:.2f}s")
+
+    def serve(self, socket_path=DEFAULT_SOCKET, watch=True):
+        """load the caches, then answer rebuild requests on the Unix socket at socket_path and watch the input
+        files until interrupted. Each request is a line of JSON, answered with a line of JSON, see handle_request
+        """
+        print("loading ATT&CK data and controls")
+        self.warm()
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        response = daemon.handle_request(json.loads(line))
+                    except ValueError as err:
+                        response = {"rebuilt": [], "errors": [f"invalid request: {err}"]}
+                    self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)  # left behind by a daemon which didn't shut down cleanly
+        stop = threading.Event()
+        watcher = threading.Thread(target=self.watch, args=(stop,), daemon=True)
+        with socketserver.ThreadingUnixStreamServer(str(socket_path), Handler) as server:
+            if watch:
+                watcher.start()
+            print(f"listening on {socket_path}")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                stop.set()
+                if watch:
+                    watcher.join()
+                os.remove(socket_path)
+                self.writer.close()
+                self.export_writer.close()
+
+
+def request(socket_path=DEFAULT_SOCKET, **kwargs):
+    """send a rebuild request to the daemon listening on socket_path and return its response.
+    kwargs are the keys of the request, see BuildDaemon.handle_request"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(str(socket_path))
+        with client.makefile("rwb") as f:
+            f.write(json.dumps(kwargs).encode("utf-8") + b"\n")
+            f.flush()
+            return json.loads(f.readline())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="keep the input data loaded and rebuild the control frameworks "
+                                                 "affected by each change to the mappings and controls files")
+    parser.add_argument("--socket",
+                        default=DEFAULT_SOCKET,
+                        help="path of the Unix socket accepting rebuild requests")
+    parser.add_argument("--no-watch",
+                        action="store_true",
+                        help="only rebuild on request, without watching data/mappings and data/controls")
+    parser.add_argument("--dedup-layers",
+                        action="store_true",
+                        help="see make.py --dedup-layers")
+    parser.add_argument("--compress",
+                        action="store_true",
+                        help="see make.py --compress")
+    parser.add_argument("--archive-layers",
+                        action="store_true",
+                        help="see make.py --archive-layers")
+    parser.add_argument("--output",
+                        type=pathlib.Path,
+                        default=make.PROJECT_FOLDER,
+                        help="see make.py --output")
+    parser.add_argument("--rebuild",
+                        action="store_true",
+                        help="instead of starting a daemon, ask the running daemon to rebuild and print its response")
+    parser.add_argument("--attack-version",
+                        help="with --rebuild, only rebuild this ATT&CK version, e.g. 12_1")
+    parser.add_argument("--framework",
+                        help="with --rebuild, only rebuild this framework, e.g. nist800_53_r5")
+    parser.add_argument("--wait",
+                        action="store_true",
+                        help="with --rebuild, wait until the bulk exports (substituted bundle, list of mappings, "
+                             "Feather, SQLite and index) are saved as well")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        selection = {"attack_version": args.attack_version, "framework": args.framework, "wait": args.wait}
+        print(json.dumps(request(args.socket, **{k: v for k, v in selection.items() if v}), indent=4))
+    else:
+        if args.archive_layers and args.dedup_layers:
+            parser.error("--archive-layers and --dedup-layers can't be combined")
+        build_daemon = BuildDaemon(dedup_layers=args.dedup_layers, output_folder=args.output,
+                                   compress=args.compress, archive_layers=args.archive_layers)
+        build_daemon.serve(args.socket, watch=not args.no_watch)
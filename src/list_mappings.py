@@ -1,22 +1,25 @@
+import concurrent.futures
+
 from colorama import Fore
-import openpyxl
-import openpyxl.utils
-import pandas
 
 
 def mappings_to_df(mappings_bundle, stixid_to_object):
     """Return a pandas dataframe listing the mappings in mappings_bundle"""
+    import pandas
+
     rows = []
+    errors = []  # every dangling reference is reported before stopping
     for mapping in mappings_bundle:
         control = stixid_to_object.get(mapping["source_ref"])
         if not control:
-            print(Fore.RED + f"ERROR: cannot find object with ID {mapping.source_ref} in controls bundle" + Fore.RESET)
-            exit()
+            errors.append(f"cannot find object with ID {mapping['source_ref']} in controls bundle")
 
         technique = stixid_to_object.get(mapping["target_ref"])
         if not technique:
-            print(Fore.RED + f"ERROR: cannot find object with ID {mapping.target_ref} in ATT&CK bundle" + Fore.RESET)
-            exit()
+            errors.append(f"cannot find object with ID {mapping['target_ref']} in ATT&CK bundle")
+
+        if not control or not technique:
+            continue
 
         rows.append({
             "Control ID": control["external_references"][0]["external_id"],
@@ -26,16 +29,31 @@ def mappings_to_df(mappings_bundle, stixid_to_object):
             "Technique Name": technique["name"],
         })
 
+    if errors:
+        for error in errors:
+            print(Fore.RED + f"ERROR: {error}" + Fore.RESET)
+        exit(1)
+
     data_frame = pandas.DataFrame(rows)
     data_frame.sort_values(['Control ID', 'Technique ID'], ascending=[True, True], inplace=True)
 
     return data_frame
 
 
-def workbook_changes(filename):
+def build_mappings_df(attack_data, controls, mappings):
+    """Return the dataframe of mappings_to_df for the mappings of controls to attack_data. It may be built
+    once and passed to both main and mappings_to_feather.main"""
+    stixid_to_object = {obj["id"]: obj for obj in attack_data}
+    stixid_to_object.update({obj["id"]: obj for obj in controls})
+
+    return mappings_to_df(mappings, stixid_to_object)
+
+
+def workbook_changes(worksheet):
     """Changes spreadsheet format width, freezes first row, and sets
-    filtering reference"""
-    sheet_name = 'Sheet1'
+    filtering reference of the worksheet, before its workbook is saved"""
+    import openpyxl.utils
+
     freeze_row = 'A2'  # freezes the first row of the document
 
     control_id_width = 14
@@ -52,21 +70,43 @@ def workbook_changes(filename):
         technique_name_width,
     ]
 
-    workbook = openpyxl.load_workbook(filename)
-    worksheet = workbook[sheet_name]
     worksheet.freeze_panes = worksheet[freeze_row]
 
     # establishes filtering references in document
-    auto_filter_section = f'A1:E{len(list(worksheet.rows))}'
+    auto_filter_section = f'A1:E{worksheet.max_row}'
     worksheet.auto_filter.ref = auto_filter_section
 
     for i, column_width in enumerate(column_widths):
         worksheet.column_dimensions[openpyxl.utils.get_column_letter(i + 1)].width = column_width
 
-    workbook.save(filename)
 
+def save_df(df, output, pd_export):
+    """write the dataframe to output using the given pandas export function name, e.g. "to_excel" """
+    import pandas
 
-def main(attack_data, controls, mappings, output):
+    file_extension = output.suffix
+    print(f"writing {output}... ", end="", flush=True)
+    if file_extension in [".md"]:  # md doesn't support index=False and requires a stream and not a path
+        with open(output, "w") as f:
+            getattr(df, pd_export)(f)
+    elif file_extension in [".xlsx"]:
+        # the workbook is formatted in memory before it is saved, instead of being saved and reopened
+        sheet_name = 'Sheet1'
+        with pandas.ExcelWriter(output, engine="openpyxl") as excel_writer:
+            df.to_excel(excel_writer, sheet_name=sheet_name, index=False)
+            workbook_changes(excel_writer.sheets[sheet_name])
+    else:
+        getattr(df, pd_export)(output, index=False)
+    print("done")
+
+
+def main(attack_data, controls, mappings, output, writer=None, mappings_df=None):
+    """write the list of mappings to one or more outputs, building the dataframe once for all of them.
+    :param output: a pathlib.Path or a list of them, each ending in .xlsx, .csv, .html or .md
+    :param writer: optional background_writer.BackgroundWriter the outputs are saved on. The outputs are
+                   otherwise saved concurrently on a thread per output before returning
+    :param mappings_df: optional output of build_mappings_df for the mappings, built here if not given
+    """
     extension_to_pd_export = {
         ".xlsx": "to_excel",  # extension to df export function name
         ".csv": "to_csv",
@@ -74,26 +114,23 @@ def main(attack_data, controls, mappings, output):
         ".md": "to_markdown",
     }
     allowed_extension_list = ", ".join(extension_to_pd_export.keys())
-    file_extension = output.suffix
-    if file_extension not in extension_to_pd_export:
-        msg = (f"ERROR: Unknown output extension \"{file_extension}\", please make "
-               f"sure your output extension is one of: {allowed_extension_list}")
-        print(Fore.RED + msg + Fore.RESET)
-        exit()
-
-    stixid_to_object = {obj["id"]: obj for obj in attack_data}
-    stixid_to_object.update({obj["id"]: obj for obj in controls})
+    outputs = output if isinstance(output, (list, tuple)) else [output]
+    for output in outputs:  # every output is checked before any work is done
+        file_extension = output.suffix
+        if file_extension not in extension_to_pd_export:
+            msg = (f"ERROR: Unknown output extension \"{file_extension}\", please make "
+                   f"sure your output extension is one of: {allowed_extension_list}")
+            print(Fore.RED + msg + Fore.RESET)
+            exit()
 
-    df = mappings_to_df(mappings, stixid_to_object)
+    df = mappings_df if mappings_df is not None else build_mappings_df(attack_data, controls, mappings)
 
-    print(f"writing {output}... ", end="", flush=True)
-    if file_extension in [".md"]:  # md doesn't support index=False and requires a stream and not a path
-        with open(output, "w") as f:
-            getattr(df, extension_to_pd_export[file_extension])(f)
+    if writer:
+        for output in outputs:
+            writer.submit(save_df, df, output, extension_to_pd_export[output.suffix])
     else:
-        getattr(df, extension_to_pd_export[file_extension])(output, index=False)
-
-        if file_extension in [".xlsx"]:
-            workbook_changes(output)
-
-        print("done")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+            futures = [executor.submit(save_df, df, output, extension_to_pd_export[output.suffix])
+                       for output in outputs]
+        for future in futures:
+            future.result()  # raises the error of a failed output
@@ -1,11 +1,27 @@
+import argparse
 import json
 import pathlib
+import sys
+import time
 
+from colorama import Fore
+
+import attack_reader
+import background_writer
 import list_mappings
+import mappings_to_comparison
+import mappings_to_coverage
+import mappings_to_feather
 import mappings_to_heatmaps
+import mappings_to_index
+import mappings_to_sqlite
+import stage_profiler
 import substitute
+import validate_stix
+import work_queue
 
 import parse
+import parse_mappings
 
 ATTACK_8_2 = "8_2"
 ATTACK_9_0 = "9_0"
@@ -20,85 +36,709 @@ framework_id_lookup = {
     R5: "NIST 800-53 Revision 5"
 }
 
+ENTERPRISE = "enterprise-attack"
+MOBILE = "mobile-attack"
+ICS = "ics-attack"
+
+# infix of the mappings, layers and list file names of each ATT&CK domain. Enterprise keeps the original names,
+# e.g. attack-12-1-to-nist800-53-r5-mappings.tsv and layers/, while mobile uses
+# attack-12-1-to-nist800-53-r5-mobile-mappings.tsv and mobile-layers/.
+# A domain is built for a framework when its mappings file exists in data/mappings
+domain_infix_lookup = {
+    ENTERPRISE: "",
+    MOBILE: "mobile-",
+    ICS: "ics-",
+}
+
+ATTACK_VERSIONS = [ATTACK_8_2, ATTACK_9_0, ATTACK_10_1, ATTACK_12_1]
+FRAMEWORKS = [R4, R5]
+
+PROJECT_FOLDER = pathlib.Path(__file__).absolute().parent.parent
+
+
+def bundle_suffix(compress):
+    """return the file name suffix of the STIX bundles, see attack_reader.open_bundle"""
+    return ".json" + attack_reader.GZIP_SUFFIX if compress else ".json"
+
+
+def mappings_file(attack_version, framework, domain):
+    """return the path of the mappings TSV file of the given ATT&CK version, framework and domain"""
+    dashed_framework = framework.replace('_', '-')
+    dashed_attack_version = attack_version.replace('_', '-')
+    infix = domain_infix_lookup[domain]
+    return (PROJECT_FOLDER / "data" / "mappings" /
+            f"attack-{dashed_attack_version}-to-{dashed_framework}-{infix}mappings.tsv")
+
+
+def controls_file(framework):
+    """return the path of the controls TSV file of the given framework"""
+    dashed_framework = framework.replace('_', '-')
+    return PROJECT_FOLDER / "data" / "controls" / f"{dashed_framework}-controls.tsv"
+
+
+def attack_file(attack_version, domain):
+    """return the path of the ATT&CK bundle of the given version and domain, which may be gzip compressed,
+    e.g. enterprise-attack-v12.1.json.gz"""
+    attack_version_string = "v" + attack_version.replace("_", ".")
+    attack_path = PROJECT_FOLDER / "data" / "attack" / f"{domain}-{attack_version_string}.json"
+    return attack_reader.find_bundle(attack_path) or attack_path
+
+
+def load_domain(attack_version, domain, store=None):
+    """load and index the ATT&CK data of the given version and domain.
+    Only the fields needed to resolve techniques are loaded; substitute streams the complete objects.
+    If store, an attack_reader.ObjectStore, is given the objects are loaded into it, sharing the objects
+    unchanged between the releases loaded into the same store.
+    Returns a tuple of (path to the ATT&CK bundle, ATT&CK objects, parse_mappings.index_attack_data output)"""
+    attack_version_string = "v" + attack_version.replace("_", ".")
+    attack_path = attack_file(attack_version, domain)
+    if store is not None:
+        attack_data = store.add_release(f"{domain}-{attack_version_string}", attack_path)
+    else:
+        attack_data = attack_reader.load_objects(attack_path)
+    return attack_path, attack_data, parse_mappings.index_attack_data(attack_data)
+
+
+def controls_output(attack_version, framework, output_folder=PROJECT_FOLDER, compress=False):
+    """return the path of the controls bundle of a framework for an ATT&CK version"""
+    dashed_framework = framework.replace('_', '-')
+    framework_folder = output_folder / "frameworks" / f"attack_{attack_version}" / framework
+    return framework_folder / "stix" / f"{dashed_framework}-controls{bundle_suffix(compress)}"
+
+
+def build_controls(attack_version, framework, writer, output_folder=PROJECT_FOLDER, compress=False):
+    """parse the controls of a framework for an ATT&CK version and save them on writer, see save_controls.
+    With no writer the controls are only parsed.
+    Returns a tuple of (controls stix2.Bundle, controls as plain STIX objects)"""
+    controls_bundle = parse.build_controls(in_controls=controls_file(framework),
+                                           out_controls=controls_output(attack_version, framework, output_folder,
+                                                                        compress),
+                                           framework_id=framework_id_lookup[framework])
+    controls = json.loads(controls_bundle.serialize())["objects"]
+    if writer:
+        save_controls(attack_version, framework, controls_bundle, controls, writer, output_folder, compress)
+    return controls_bundle, controls
+
+
+def save_controls(attack_version, framework, controls_bundle, controls, writer, output_folder=PROJECT_FOLDER,
+                  compress=False):
+    """save the controls of a framework for an ATT&CK version on writer, gzip compressed if compress,
+    along with their metadata as a Feather file, which is shared by every domain"""
+    dashed_framework = framework.replace('_', '-')
+    dashed_attack_version = attack_version.replace('_', '-')
+    out_controls = controls_output(attack_version, framework, output_folder, compress)
+    out_controls.parent.mkdir(parents=True, exist_ok=True)
+    dist_folder = output_folder / "dist"
+    dist_folder.mkdir(parents=True, exist_ok=True)
+
+    writer.submit(parse.save_bundle, controls_bundle, out_controls)
+    out_feather_controls = dist_folder / f"attack-{dashed_attack_version}-to-{dashed_framework}-controls.feather"
+    mappings_to_feather.write_controls(controls, out_feather_controls, writer)
+
+
+def generated_bundles(attack_version, framework, controls, domain_data, output_folder=PROJECT_FOLDER, compress=False):
+    """return the STIX bundles built for an ATT&CK version and framework along with the IDs of the objects of
+    other bundles they may refer to, see validate_stix.main
+    :param controls: the controls as plain STIX objects
+    :param domain_data: a dict of format {domain: load_domain output} of the ATT&CK domains mapped to
+    """
+    dashed_framework = framework.replace('_', '-')
+    stix_folder = output_folder / "frameworks" / f"attack_{attack_version}" / framework / "stix"
+    suffix = bundle_suffix(compress)
+    control_ids = {sdo["id"] for sdo in controls}
+
+    bundles = [(stix_folder / f"{dashed_framework}-controls{suffix}", set())]
+    for domain, infix in domain_infix_lookup.items():
+        if not mappings_file(attack_version, framework, domain).exists():
+            continue
+        attack_ids = {sdo["id"] for sdo in domain_data[domain][1]}
+        # the mappings refer to the controls and techniques, the substituted bundle holds both
+        bundles.append((stix_folder / f"{dashed_framework}-{infix}mappings{suffix}", control_ids | attack_ids))
+        bundles.append((stix_folder / f"{dashed_framework}-{domain}{suffix}", set()))
+    return bundles
+
+
+def build_domain(attack_version, framework, domain, controls_bundle, controls, attack_path, attack_data,
+                 attack_index, dedup_layers, writer, output_folder=PROJECT_FOLDER, relationship_cache=None,
+                 compress=False, ndjson_shards=None, shard_size=None, archive_layers=False, profiler=None,
+                 write_controls=True):
+    """parse the mappings of one ATT&CK domain to the already parsed controls of a framework, and run the
+    utility scripts on them, see build_domain_layers and build_domain_exports
+    :param attack_version: the ATT&CK version, e.g. "12_1"
+    :param framework: the framework, e.g. "nist800_53_r5"
+    :param domain: the ATT&CK domain, e.g. "enterprise-attack"
+    :param controls_bundle: the controls stix2.Bundle returned by parse.build_controls
+    :param controls: the controls as plain STIX objects
+    :param attack_path: the ATT&CK STIX bundle of the domain, streamed by substitute
+    :param attack_data: the ATT&CK objects of the domain, as loaded by attack_reader.load_objects
+    :param attack_index: parse_mappings.index_attack_data output for attack_data
+    :param dedup_layers: see main
+    :param writer: background_writer.BackgroundWriter the outputs are saved on
+    :param output_folder: see main
+    :param relationship_cache: optional cache of the mapping relationships of a previous build of this ATT&CK
+                               version, framework and domain, see parse_mappings.parse_mappings
+    :param compress: see main
+    :param ndjson_shards: see main
+    :param shard_size: see main
+    :param archive_layers: see main
+    :param profiler: optional stage_profiler.StageProfiler each utility script is profiled with as a stage
+    :param write_controls: whether the controls are written to the SQLite database. They are shared by every
+                           domain of the framework, so only the first domain built writes them
+
+    :returns: the mappings as plain STIX objects
+    """
+    mappings = build_domain_layers(attack_version, framework, domain, controls_bundle, controls, attack_data,
+                                   attack_index, dedup_layers, writer, output_folder, relationship_cache, compress,
+                                   archive_layers, profiler)
+    build_domain_exports(attack_version, framework, domain, controls, attack_path, attack_data, mappings, writer,
+                         output_folder, compress, ndjson_shards, shard_size, profiler, write_controls)
+    return mappings
+
+
+def build_domain_layers(attack_version, framework, domain, controls_bundle, controls, attack_data, attack_index,
+                        dedup_layers, writer, output_folder=PROJECT_FOLDER, relationship_cache=None, compress=False,
+                        archive_layers=False, profiler=None):
+    """parse the mappings of one ATT&CK domain to the already parsed controls of a framework, and build the
+    outputs analysts look at while editing the mappings: the mappings bundle, the heatmap layers and the coverage.
+    See build_domain for the parameters
+
+    :returns: the mappings as plain STIX objects
+    """
+    profiler = profiler or stage_profiler.StageProfiler()
+    dashed_framework = framework.replace('_', '-')
+    dashed_attack_version = attack_version.replace('_', '-')
+    attack_version_string = "v" + attack_version.replace("_", ".")
+    infix = domain_infix_lookup[domain]
+
+    framework_folder = output_folder / "frameworks" / f"attack_{attack_version}" / framework
+
+    dist_folder = output_folder / "dist"
+    dist_prefix = f"attack-{dashed_attack_version}-to-{dashed_framework}-"
+
+    # Create the dist/ directory if not already present, if already present, do not raise an error.
+    dist_folder.mkdir(parents=True, exist_ok=True)
+
+    in_mappings = mappings_file(attack_version, framework, domain)
+    out_mappings = framework_folder / "stix" / f"{dashed_framework}-{infix}mappings{bundle_suffix(compress)}"
+
+    with profiler.stage(attack_version, framework, domain, "mappings"):
+        mappings = parse.build_mappings(in_mappings=in_mappings,
+                                        out_mappings=out_mappings,
+                                        controls=controls_bundle,
+                                        attack_data=attack_data,
+                                        attack_index=attack_index,
+                                        relationship_cache=relationship_cache)
+        writer.submit(parse.save_bundle, mappings, out_mappings)
+
+        # the utility scripts take the plain STIX objects, as they would be read back from the saved bundle
+        mappings = json.loads(mappings.serialize())["objects"]
+
+    layers_folder = f"{infix}layers"
+    out_layers = framework_folder / layers_folder
+    out_coverage = dist_folder / f"{dist_prefix}{infix}coverage.json"
+    out_coverage_layers = dist_folder / f"{dist_prefix}{infix}coverage-layers"
+
+    # run the utility scripts
+    with profiler.stage(attack_version, framework, domain, "heatmaps"):
+        mappings_to_heatmaps.main(
+            framework=framework,
+            attack_data=attack_data,
+            controls=controls,
+            mappings=mappings,
+            domain=domain,
+            version=attack_version_string,
+            output=out_layers,
+            clear=out_layers.exists(),
+            build_dir=True,
+            dedup=dedup_layers,
+            writer=writer,
+            layers_folder=layers_folder,
+            archive=archive_layers
+        )
+
+    with profiler.stage(attack_version, framework, domain, "coverage"):
+        mappings_to_coverage.main(
+            framework=framework,
+            attack_data=attack_data,
+            controls=controls,
+            mappings=mappings,
+            domain=domain,
+            version=attack_version_string,
+            output=out_coverage,
+            layers_output=out_coverage_layers,
+            writer=writer
+        )
+
+    return mappings
+
+
+def build_domain_exports(attack_version, framework, domain, controls, attack_path, attack_data, mappings, writer,
+                         output_folder=PROJECT_FOLDER, compress=False, ndjson_shards=None, shard_size=None,
+                         profiler=None, write_controls=True):
+    """build the bulk exports of the mappings of one ATT&CK domain built by build_domain_layers: the
+    substituted bundle, the list of mappings, the Feather files, the SQLite database and the index documents.
+    See build_domain for the parameters
+    :param mappings: the mappings as plain STIX objects
+    """
+    profiler = profiler or stage_profiler.StageProfiler()
+    dashed_framework = framework.replace('_', '-')
+    dashed_attack_version = attack_version.replace('_', '-')
+    attack_version_string = "v" + attack_version.replace("_", ".")
+    infix = domain_infix_lookup[domain]
+
+    framework_folder = output_folder / "frameworks" / f"attack_{attack_version}" / framework
 
-def main():
-    """rebuild all control frameworks from the input data"""
+    dist_folder = output_folder / "dist"
+    dist_prefix = f"attack-{dashed_attack_version}-to-{dashed_framework}-"
+    dist_folder.mkdir(parents=True, exist_ok=True)
 
-    for attack_version in [ATTACK_8_2, ATTACK_9_0, ATTACK_10_1, ATTACK_12_1]:
-        for framework in [R4, R5]:
-            # TODO: Lots of variable setting. Clean up
-            versioned_folder = f"attack_{attack_version}"
+    out_substituted = framework_folder / "stix" / f"{dashed_framework}-{domain}{bundle_suffix(compress)}"
+    out_xlsx = dist_folder / f"{dist_prefix}{infix}mappings.xlsx"
+    out_feather_mappings = dist_folder / f"{dist_prefix}{infix}mappings.feather"
+    out_sqlite = dist_folder / "attack-control-framework-mappings.sqlite"
+    out_shards = dist_folder / f"{dist_prefix}{domain}-ndjson" if ndjson_shards else None
+    out_index = dist_folder / f"{dist_prefix}{infix}index"
+
+    with profiler.stage(attack_version, framework, domain, "substitute"):
+        substitute.main(
+            attack_data=attack_reader.iter_objects(attack_path),
+            controls=controls,
+            mappings=mappings,
+            allow_unmapped=False,
+            output=out_substituted,
+            writer=writer,
+            shards_output=out_shards,
+            shard_by_type=ndjson_shards == "type",
+            shard_size=shard_size
+        )
+
+    with profiler.stage(attack_version, framework, domain, "list_mappings"):
+        # the list of mappings and its Feather file are written from the same dataframe
+        mappings_df = list_mappings.build_mappings_df(attack_data, controls, mappings)
+        list_mappings.main(
+            attack_data=attack_data,
+            controls=controls,
+            mappings=mappings,
+            output=out_xlsx,
+            writer=writer,
+            mappings_df=mappings_df
+        )
+
+    with profiler.stage(attack_version, framework, domain, "feather"):
+        mappings_to_feather.main(
+            attack_data=attack_data,
+            controls=controls,
+            mappings=mappings,
+            out_mappings=out_feather_mappings,
+            writer=writer,
+            mappings_df=mappings_df
+        )
+
+    with profiler.stage(attack_version, framework, domain, "sqlite"):
+        mappings_to_sqlite.main(
+            attack_data=attack_data,
+            controls=controls,
+            mappings=mappings,
+            version=attack_version_string,
+            framework=framework,
+            output=out_sqlite,
+            domain=domain,
+            write_controls=write_controls
+        )
+
+    with profiler.stage(attack_version, framework, domain, "index"):
+        mappings_to_index.main(
+            attack_data=attack_data,
+            controls=controls,
+            mappings=mappings,
+            version=attack_version_string,
+            framework=framework,
+            domain=domain,
+            output=out_index,
+            writer=writer
+        )
+
+
+def check(output_folder=PROJECT_FOLDER):
+    """validate every mappings file against its controls and ATT&CK data without building the STIX data.
+    The report of each mappings file is printed and written to dist/ within output_folder.
+    Only the ATT&CK fields the validation reads are loaded, see parse_mappings.INDEX_FIELDS.
+    Returns the total number of errors"""
+    dist_folder = output_folder / "dist"
+    dist_folder.mkdir(parents=True, exist_ok=True)
+
+    # the control IDs of each framework are read once, and their regex matches shared by every ATT&CK version
+    control_ids = {}
+    for framework in FRAMEWORKS:
+        control_ids[framework] = parse.controls_parser(framework_id_lookup[framework]).parse_control_ids(
+            controls_file(framework))
+    control_caches = {framework: {} for framework in FRAMEWORKS}
+
+    error_count = 0
+    for attack_version in ATTACK_VERSIONS:
+        dashed_attack_version = attack_version.replace('_', '-')
+        # each domain is loaded the first time it is needed, then shared by both frameworks along with
+        # the regex matches against its ATT&CK IDs
+        domain_data = {}
+
+        for framework in FRAMEWORKS:
             dashed_framework = framework.replace('_', '-')
-            dashed_attack_version = attack_version.replace('_', '-')
-
-            framework_id = framework_id_lookup[framework]
-            project_folder = pathlib.Path(__file__).absolute().parent.parent
-            framework_folder = project_folder / "frameworks" / versioned_folder / framework
-
-            dist_folder = project_folder / "dist"
-            dist_prefix = f"attack-{dashed_attack_version}-to-{dashed_framework}-"
-            attack_version_string = "v" + attack_version.replace("_", ".")
-
-            # Create the dist/ directory if not already present, if already present, do not raise an error.
-            dist_folder.mkdir(exist_ok=True)
-
-            attack_data = project_folder / "data" / "attack" / f"enterprise-attack-{attack_version_string}.json"
-            with attack_data.open("r") as f:
-                attack_data = json.load(f)["objects"]
-
-            in_controls = project_folder / "data" / "controls" / f"{dashed_framework}-controls.tsv"
-            in_mappings = (project_folder / "data" / "mappings" /
-                           f"attack-{dashed_attack_version}-to-{dashed_framework}-mappings.tsv")
-            out_controls = framework_folder / "stix" / f"{dashed_framework}-controls.json"
-            out_mappings = framework_folder / "stix" / f"{dashed_framework}-mappings.json"
-
-            parse.main(in_controls=in_controls,
-                       in_mappings=in_mappings,
-                       out_controls=out_controls,
-                       out_mappings=out_mappings,
-                       framework_id=framework_id,
-                       attack_data=attack_data)
-
-            controls = framework_folder / "stix" / f"{dashed_framework}-controls.json"
-            with controls.open("r") as f:
-                controls = json.load(f)["objects"]
-
-            mappings = framework_folder / "stix" / f"{dashed_framework}-mappings.json"
-            with mappings.open("r") as f:
-                mappings = json.load(f)["objects"]
-
-            out_enterprise = framework_folder / "stix" / f"{dashed_framework}-enterprise-attack.json"
-            out_layers = framework_folder / "layers"
-            out_xlsx = dist_folder / f"{dist_prefix}mappings.xlsx"
-
-            # run the utility scripts
-            mappings_to_heatmaps.main(
-                framework=framework,
-                attack_data=attack_data,
-                controls=controls,
-                mappings=mappings,
-                domain="enterprise-attack",
-                version=attack_version_string,
-                output=out_layers,
-                clear=True,
-                build_dir=True
-            )
+            for domain, infix in domain_infix_lookup.items():
+                in_mappings = mappings_file(attack_version, framework, domain)
+                if not in_mappings.exists():
+                    continue  # this framework has no mappings to this domain of ATT&CK
+                if domain not in domain_data:
+                    attack_data = attack_reader.load_objects(attack_file(attack_version, domain),
+                                                             parse_mappings.INDEX_FIELDS)
+                    domain_data[domain] = attack_data, parse_mappings.index_attack_data(attack_data), {}
+                attack_data, attack_index, technique_cache = domain_data[domain]
 
-            substitute.main(
-                attack_data=attack_data,
-                controls=controls,
-                mappings=mappings,
-                allow_unmapped=False,
-                output=out_enterprise
-            )
+                lookup_caches = {"controlID": control_caches[framework], "techniqueID": technique_cache}
+                report = parse_mappings.validate_mappings(parse_mappings.read_mappings(in_mappings),
+                                                          control_ids[framework],
+                                                          attack_data, attack_index, lookup_caches)
+                parse_mappings.print_validation_report(report, in_mappings)
+                dist_prefix = f"attack-{dashed_attack_version}-to-{dashed_framework}-"
+                with (dist_folder / f"{dist_prefix}{infix}validation.json").open("w") as f:
+                    json.dump(report, f, indent=4)
+                error_count += len(report["errors"])
+
+    return error_count
+
+
+def build_framework(attack_version, framework, domain_data, writer, output_folder=PROJECT_FOLDER,
+                    dedup_layers=False, compress=False, ndjson_shards=None, shard_size=None, archive_layers=False,
+                    timings=None, profiler=None):
+    """parse the controls of a framework for an ATT&CK version, and build the outputs of every ATT&CK domain
+    the framework is mapped to
+    :param domain_data: a dict of format {domain: load_domain output}, shared by the frameworks of the ATT&CK
+                        version. Each domain is loaded into it the first time it is needed
+    :param writer: background_writer.BackgroundWriter the outputs are saved on
+    :param timings: optional dict the seconds taken by the controls and by each domain are recorded in
+    :param profiler: optional stage_profiler.StageProfiler the stages are profiled with, see build_domain
+    see main for the other parameters
+
+    :returns: a tuple of (controls as plain STIX objects, {domain: mappings as plain STIX objects})
+    """
+    timings = {} if timings is None else timings
+    profiler = profiler or stage_profiler.StageProfiler()
+    start = time.perf_counter()
+    # the controls are parsed once and shared by every domain
+    with profiler.stage(attack_version, framework, "controls"):
+        controls_bundle, controls = build_controls(attack_version, framework, writer, output_folder, compress)
+    timings["controls"] = time.perf_counter() - start
+
+    mapped = {}
+    for domain in domain_infix_lookup:
+        if not mappings_file(attack_version, framework, domain).exists():
+            continue  # this framework has no mappings to this domain of ATT&CK
+        start = time.perf_counter()
+        if domain not in domain_data:
+            with profiler.stage(attack_version, domain, "load"):
+                domain_data[domain] = load_domain(attack_version, domain)
+        attack_path, attack_data, attack_index = domain_data[domain]
 
-            list_mappings.main(
-                attack_data=attack_data,
-                controls=controls,
-                mappings=mappings,
-                output=out_xlsx
+        mapped[domain] = build_domain(attack_version, framework, domain, controls_bundle, controls, attack_path,
+                                      attack_data, attack_index, dedup_layers, writer, output_folder,
+                                      compress=compress, ndjson_shards=ndjson_shards, shard_size=shard_size,
+                                      archive_layers=archive_layers, profiler=profiler,
+                                      write_controls=not mapped)
+        timings[domain] = time.perf_counter() - start
+
+    return controls, mapped
+
+
+def compare_frameworks(attack_version, compared, domain_data, writer=None, output_folder=PROJECT_FOLDER,
+                       profiler=None):
+    """write the comparison of the frameworks mapped to each domain of an ATT&CK version to dist/,
+    see mappings_to_comparison.main
+    :param compared: a dict of format {domain: {framework: (controls, mappings)}}
+    :param domain_data: a dict of format {domain: load_domain output}
+    :param profiler: optional stage_profiler.StageProfiler the comparison of each domain is profiled with
+    """
+    profiler = profiler or stage_profiler.StageProfiler()
+    for domain, frameworks in compared.items():
+        if len(frameworks) < 2:
+            continue  # nothing to compare with
+        dashed_attack_version = attack_version.replace('_', '-')
+        out_comparison = (output_folder / "dist" /
+                          f"attack-{dashed_attack_version}-{domain_infix_lookup[domain]}framework-comparison")
+        with profiler.stage(attack_version, domain, "comparison"):
+            mappings_to_comparison.main(
+                attack_data=domain_data[domain][1],
+                frameworks=frameworks,
+                domain=domain,
+                version="v" + attack_version.replace("_", "."),
+                output=out_comparison,
+                writer=writer
             )
 
 
+def main(dedup_layers=False, output_folder=PROJECT_FOLDER, compress=False, ndjson_shards=None, shard_size=None,
+         validate=True, archive_layers=False, profile=None, profile_top=stage_profiler.TOP):
+    """rebuild all control frameworks from the input data
+    :param dedup_layers: write each framework's layers as deduplicated payloads and a manifest instead of
+                         one file per layer, see mappings_to_heatmaps.save_layers_deduplicated
+    :param output_folder: the folder the frameworks/ and dist/ outputs are written to. Defaults to the
+                          repository; the input data is always read from the repository's data/ folder
+    :param compress: write the STIX bundles gzip compressed, as .json.gz files replacing the .json files.
+                     The STIX IDs of the previous build are reused whether or not it was compressed
+    :param ndjson_shards: if "type" or "count", also export the substituted bundles to dist/ as newline-delimited
+                          JSON shards, one set of shards per object type or in order of the objects,
+                          see substitute.write_shards
+    :param shard_size: the maximum number of objects per NDJSON shard, or None for no limit
+    :param validate: once saved, validate the STIX bundles in parallel and write the report to
+                     dist/stix-validation.json within output_folder, see validate_stix.main
+    :param archive_layers: write each framework's layers and their README into a single zip archive, e.g.
+                           layers.zip, instead of one file per layer, see mappings_to_heatmaps.save_layers_archive
+    :param profile: the folder to write the cProfile pstats file of each stage of each ATT&CK version, framework
+                    and domain to, or None not to profile. The outputs are then saved in the stage that
+                    built them rather than on background threads, see stage_profiler.StageProfiler
+    :param profile_top: the number of functions listed in the merged report of the profiles
+
+    :returns: the number of validation errors
+    """
+    bundles = []
+    profiler = stage_profiler.StageProfiler(profile, clear=True)
+
+    # outputs are serialized and saved on background threads while the next stage or pair is computed.
+    # Leaving the with block waits for all of them to be saved, raising the first error if any failed
+    with background_writer.BackgroundWriter(workers=0 if profile else 2) as writer:
+        for attack_version in ATTACK_VERSIONS:
+            # each domain is loaded the first time it is needed, then shared by both frameworks. Only the
+            # domains of one ATT&CK version are held at a time
+            domain_data = {}
+            compared = {}  # {domain: {framework: (controls, mappings)}} of the frameworks mapped to each domain
+
+            for framework in FRAMEWORKS:
+                controls, mapped = build_framework(attack_version, framework, domain_data, writer,
+                                                   output_folder, dedup_layers, compress, ndjson_shards,
+                                                   shard_size, archive_layers, profiler=profiler)
+                for domain, mappings in mapped.items():
+                    compared.setdefault(domain, {})[framework] = (controls, mappings)
+
+                bundles += generated_bundles(attack_version, framework, controls, domain_data, output_folder,
+                                             compress)
+
+            compare_frameworks(attack_version, compared, domain_data, writer, output_folder, profiler)
+
+    error_count = 0
+    if validate:
+        # only the merging of the chunk results is profiled, the chunks are validated in worker processes
+        with profiler.stage("validation"):
+            error_count = validate_stix.main(bundles, output_folder / "dist" / "stix-validation.json")
+    profiler.report(profile_top)
+    return error_count
+
+
+def job_id(attack_version, framework):
+    """return the work queue ID of the job building an ATT&CK version and framework, e.g. attack_12_1-nist800_53_r5"""
+    return f"attack_{attack_version}-{framework}"
+
+
+def build_job(job):
+    """build the (ATT&CK version, framework) pair of a work queue job, see coordinate.
+    Returns a dict of format {stage: seconds} of the time taken by each stage, where saving the outputs
+    once they are built is the "save" stage"""
+    timings = {}
+    profiler = stage_profiler.StageProfiler(job["profile"])
+    writer = background_writer.BackgroundWriter(workers=0 if job["profile"] else 2)
+    with writer:
+        build_framework(job["attack_version"], job["framework"], {}, writer,
+                        pathlib.Path(job["output_folder"]), job["dedup_layers"], job["compress"],
+                        job["ndjson_shards"], job["shard_size"], job["archive_layers"], timings, profiler)
+        start = time.perf_counter()
+    timings["save"] = time.perf_counter() - start
+    return timings
+
+
+def coordinate(queue_folder, dedup_layers=False, output_folder=PROJECT_FOLDER, compress=False, ndjson_shards=None,
+               shard_size=None, validate=True, archive_layers=False, stale_after=work_queue.STALE_AFTER, profile=None,
+               profile_top=stage_profiler.TOP):
+    """rebuild all control frameworks on the workers of a work queue, see work and work_queue.WorkQueue.
+    The (ATT&CK version, framework) pairs are written as jobs to queue_folder, a directory shared with the
+    workers, and their results are written to dist/work-queue-results.json once every job has finished.
+    The comparisons and the validation need the outputs of every framework, so they are run here afterwards,
+    from the saved bundles.
+    :param queue_folder: the shared directory of the work queue
+    :param output_folder: see main, it must be shared with the workers as well
+    :param stale_after: seconds without a heartbeat after which the job of a worker is presumed lost and is
+                        claimed by another worker
+    :param profile: see main. The workers profile the stages of their jobs into the same folder, which must be
+                    shared with them, and the coordinator reports on the profiles of every worker
+    see main for the other parameters
+
+    :returns: the number of failed jobs plus the number of validation errors
+    """
+    output_folder = output_folder.absolute()
+    profile = profile.absolute() if profile else None
+    profiler = stage_profiler.StageProfiler(profile, clear=True)
+    queue = work_queue.WorkQueue(queue_folder, stale_after)
+    jobs = {
+        job_id(attack_version, framework): {
+            "attack_version": attack_version,
+            "framework": framework,
+            "output_folder": str(output_folder),
+            "dedup_layers": dedup_layers,
+            "compress": compress,
+            "ndjson_shards": ndjson_shards,
+            "shard_size": shard_size,
+            "archive_layers": archive_layers,
+            "profile": str(profile) if profile else None,
+        }
+        for attack_version in ATTACK_VERSIONS
+        for framework in FRAMEWORKS
+        if any(mappings_file(attack_version, framework, domain).exists() for domain in domain_infix_lookup)
+    }
+    print(f"writing {len(jobs)} jobs to {queue_folder}... ", end="", flush=True)
+    queue.create(jobs)
+    print("done")
+
+    print("waiting for the workers... ", end="", flush=True)
+    results = queue.wait()
+    print("done")
+    (output_folder / "dist").mkdir(parents=True, exist_ok=True)
+    with (output_folder / "dist" / "work-queue-results.json").open("w") as f:
+        json.dump(results, f, indent=4)
+    failed = 0
+    for finished_job_id, result in results.items():
+        print(f"{finished_job_id}: {result['status']} on {result['worker']} in {result['seconds']:.2f}s")
+        if result["status"] != "done":
+            print(Fore.RED + f"ERROR: {finished_job_id}: {result['error']}" + Fore.RESET)
+            failed += 1
+
+    bundles = []
+    with background_writer.BackgroundWriter(workers=0 if profile else 2) as writer:
+        for attack_version in ATTACK_VERSIONS:
+            domain_data = {}
+            compared = {}
+            for framework in FRAMEWORKS:
+                if results.get(job_id(attack_version, framework), {}).get("status") != "done":
+                    continue
+                dashed_framework = framework.replace('_', '-')
+                stix_folder = output_folder / "frameworks" / f"attack_{attack_version}" / framework / "stix"
+                controls = list(attack_reader.iter_objects(
+                    stix_folder / f"{dashed_framework}-controls{bundle_suffix(compress)}"))
+                for domain, infix in domain_infix_lookup.items():
+                    if not mappings_file(attack_version, framework, domain).exists():
+                        continue
+                    if domain not in domain_data:
+                        domain_data[domain] = load_domain(attack_version, domain)
+                    mappings = list(attack_reader.iter_objects(
+                        stix_folder / f"{dashed_framework}-{infix}mappings{bundle_suffix(compress)}"))
+                    compared.setdefault(domain, {})[framework] = (controls, mappings)
+
+                bundles += generated_bundles(attack_version, framework, controls, domain_data, output_folder,
+                                             compress)
+
+            compare_frameworks(attack_version, compared, domain_data, writer, output_folder, profiler)
+
+    error_count = failed
+    if validate:
+        with profiler.stage("validation"):
+            error_count += validate_stix.main(bundles, output_folder / "dist" / "stix-validation.json")
+    profiler.report(profile_top)
+    return error_count
+
+
+def work(queue_folder, worker=None, stale_after=work_queue.STALE_AFTER):
+    """claim and build the jobs of the work queue written by coordinate until every job has finished,
+    publishing the timings of each job's stages. Any number of workers can run on any number of nodes sharing
+    queue_folder and the output folder of the coordinator
+    :param worker: the name of this worker, see work_queue.default_worker
+
+    :returns: the IDs of the jobs built by this worker
+    """
+    queue = work_queue.WorkQueue(queue_folder, stale_after)
+    return queue.run_worker(build_job, worker)
+
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="rebuild all control frameworks from the input data")
+    parser.add_argument("--dedup-layers",
+                        action="store_true",
+                        help="store each distinct layer payload once, with a manifest.json mapping layer paths "
+                             "to payloads, instead of writing one file per layer")
+    parser.add_argument("--check-only",
+                        action="store_true",
+                        help="only validate the mappings files against the controls and ATT&CK data, reporting "
+                             "every problem, without building any outputs. Exits with status 1 if there are errors")
+    parser.add_argument("--output",
+                        type=pathlib.Path,
+                        default=PROJECT_FOLDER,
+                        help="folder to write the frameworks/ and dist/ outputs to instead of the repository")
+    parser.add_argument("--compress",
+                        action="store_true",
+                        help="write the STIX bundles gzip compressed (.json.gz) instead of as indented JSON")
+    parser.add_argument("--ndjson-shards",
+                        choices=["type", "count"],
+                        help="also export each substituted bundle to dist/ as newline-delimited JSON shards with a "
+                             "manifest, sharded by object type or only by --shard-size")
+    parser.add_argument("--shard-size",
+                        type=int,
+                        help="the maximum number of objects per NDJSON shard")
+    parser.add_argument("--skip-validation",
+                        action="store_true",
+                        help="don't validate the STIX bundles once they are built. By default they are validated "
+                             "in parallel and the build exits with status 1 if there are errors")
+    parser.add_argument("--archive-layers",
+                        action="store_true",
+                        help="write the layers of each framework and their README into a single zip archive, "
+                             "e.g. layers.zip, instead of one file per layer")
+    parser.add_argument("--coordinate",
+                        type=pathlib.Path,
+                        metavar="QUEUE",
+                        help="write the (ATT&CK version, framework) pairs as jobs to the work queue in this shared "
+                             "directory, wait for the workers started with --work to build them, then compare and "
+                             "validate the outputs. --output must be shared with the workers")
+    parser.add_argument("--work",
+                        type=pathlib.Path,
+                        metavar="QUEUE",
+                        help="build jobs of the work queue in this shared directory until all of them are finished, "
+                             "using the options given to the coordinator")
+    parser.add_argument("--worker-name",
+                        help="with --work, the name of this worker in the job results, defaults to host:pid")
+    parser.add_argument("--stale-after",
+                        type=float,
+                        default=work_queue.STALE_AFTER,
+                        help="with --coordinate or --work, seconds without a heartbeat after which the job of a "
+                             "worker is presumed lost and is built by another worker")
+    parser.add_argument("--profile",
+                        action="store_true",
+                        help="profile each stage of each ATT&CK version, framework and domain with cProfile, "
+                             "writing a pstats file per stage to --profile-output, and print the hottest functions "
+                             "of the merged profiles by cumulative time. The outputs are saved in the stage that "
+                             "built them rather than in the background, so the build is slower")
+    parser.add_argument("--profile-output",
+                        type=pathlib.Path,
+                        help="with --profile, the folder of the pstats files, defaults to profile/ within --output")
+    parser.add_argument("--profile-top",
+                        type=int,
+                        default=stage_profiler.TOP,
+                        help="with --profile, the number of functions in the merged report")
+    args = parser.parse_args()
+
+    if args.check_only:
+        sys.exit(1 if check(output_folder=args.output) else 0)
+    if args.ndjson_shards == "count" and not args.shard_size:
+        parser.error("--ndjson-shards count requires --shard-size")
+    if args.archive_layers and args.dedup_layers:
+        parser.error("--archive-layers and --dedup-layers can't be combined")
+    if args.coordinate and args.work:
+        parser.error("--coordinate and --work can't be combined")
+    profile = (args.profile_output or args.output / "profile") if args.profile else None
+    if args.work:
+        work(args.work, worker=args.worker_name, stale_after=args.stale_after)
+        sys.exit(0)
+    if args.coordinate:
+        error_count = coordinate(args.coordinate, dedup_layers=args.dedup_layers, output_folder=args.output,
+                                 compress=args.compress, ndjson_shards=args.ndjson_shards,
+                                 shard_size=args.shard_size, validate=not args.skip_validation,
+                                 archive_layers=args.archive_layers, stale_after=args.stale_after,
+                                 profile=profile, profile_top=args.profile_top)
+        sys.exit(1 if error_count else 0)
+    error_count = main(dedup_layers=args.dedup_layers, output_folder=args.output, compress=args.compress,
+                       ndjson_shards=args.ndjson_shards, shard_size=args.shard_size,
+                       validate=not args.skip_validation, archive_layers=args.archive_layers, profile=profile,
+                       profile_top=args.profile_top)
+    sys.exit(1 if error_count else 0)
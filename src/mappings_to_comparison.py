@@ -0,0 +1,162 @@
+import itertools
+import json
+import os
+import shutil
+
+import mappings_to_heatmaps
+
+
+def build_technique_index(attack_data, frameworks):
+    """scan the mappings of every framework once into a shared index of the controls mapped to each technique.
+    :param attack_data: ATT&CK content of the domain
+    :param frameworks: a dict of format {framework: (controls, mappings)} of plain STIX objects
+
+    :returns: a dict of format {ATT&CK ID: {framework: [control IDs]}} of the mapped techniques
+    """
+    stixid_to_attack_id = {
+        sdo["id"]: sdo["external_references"][0]["external_id"]
+        for sdo in attack_data
+        if sdo["type"] == "attack-pattern" and sdo.get("external_references")
+    }
+
+    index = {}
+    for framework, (controls, mappings) in frameworks.items():
+        stixid_to_control_id = {
+            sdo["id"]: sdo["external_references"][0]["external_id"]
+            for sdo in controls
+            if sdo["type"] == "course-of-action"
+        }
+        for mapping in mappings:
+            attack_id = stixid_to_attack_id.get(mapping["target_ref"])
+            if attack_id is None:
+                continue  # not a technique of this domain
+            control_id = stixid_to_control_id[mapping["source_ref"]]
+            index.setdefault(attack_id, {}).setdefault(framework, set()).add(control_id)
+
+    return {
+        attack_id: {framework: sorted(control_ids) for framework, control_ids in by_framework.items()}
+        for attack_id, by_framework in sorted(index.items())
+    }
+
+
+def get_comparison_layers(index, framework_a, framework_b, domain, version):
+    """return the Navigator layers comparing two frameworks: the techniques only mapped to controls of
+    framework_a, only mapped to controls of framework_b, mapped to both, and the difference between the
+    number of controls of framework_b and framework_a mapped to each technique"""
+    dashed_a = framework_a.replace('_', '-')
+    dashed_b = framework_b.replace('_', '-')
+
+    only_a = []
+    only_b = []
+    both = []
+    delta = []
+    for attack_id, by_framework in index.items():
+        controls_a = by_framework.get(framework_a, [])
+        controls_b = by_framework.get(framework_b, [])
+        if controls_a and controls_b:
+            both.append({
+                "techniqueID": attack_id,
+                "score": len(controls_a) + len(controls_b),
+                "comment": f"{framework_a}: {', '.join(controls_a)}; {framework_b}: {', '.join(controls_b)}",
+            })
+        elif controls_a:
+            only_a.append(mappings_to_heatmaps.technique(attack_id, len(controls_a), controls_a))
+        elif controls_b:
+            only_b.append(mappings_to_heatmaps.technique(attack_id, len(controls_b), controls_b))
+        else:
+            continue  # only mapped by other frameworks
+        delta.append({
+            "techniqueID": attack_id,
+            "score": len(controls_b) - len(controls_a),
+            "comment": f"{len(controls_a)} {framework_a} controls, {len(controls_b)} {framework_b} controls",
+        })
+
+    return [
+        {
+            "outfile": f"{dashed_a}-only.json",
+            "layer": mappings_to_heatmaps.create_layer(
+                f"{framework_a} only",
+                f"techniques mapped to {framework_a} controls but not to {framework_b} controls, where scores "
+                f"are the number of associated {framework_a} controls",
+                domain,
+                only_a,
+                version
+            )
+        },
+        {
+            "outfile": f"{dashed_b}-only.json",
+            "layer": mappings_to_heatmaps.create_layer(
+                f"{framework_b} only",
+                f"techniques mapped to {framework_b} controls but not to {framework_a} controls, where scores "
+                f"are the number of associated {framework_b} controls",
+                domain,
+                only_b,
+                version
+            )
+        },
+        {
+            "outfile": "both.json",
+            "layer": mappings_to_heatmaps.create_layer(
+                f"{framework_a} and {framework_b}",
+                f"techniques mapped to both {framework_a} and {framework_b} controls, where scores are the "
+                f"number of associated controls of both frameworks",
+                domain,
+                both,
+                version
+            )
+        },
+        {
+            "outfile": "score-delta.json",
+            "layer": mappings_to_heatmaps.create_layer(
+                f"{framework_b} vs {framework_a}",
+                f"techniques mapped to {framework_a} or {framework_b} controls, where scores are the number of "
+                f"associated {framework_b} controls minus the number of associated {framework_a} controls",
+                domain,
+                delta,
+                version
+            )
+        },
+    ]
+
+
+def save_comparison(index, layers, output):
+    """write the technique index and the comparison layers of each pair of frameworks to the output directory,
+    replacing a previous comparison
+    :param layers: a dict of format {pair folder: [layers]}
+    """
+    print(f"writing comparison to {output}... ", end="", flush=True)
+    if os.path.exists(output):
+        shutil.rmtree(output)
+    os.makedirs(output)
+    with open(os.path.join(output, "technique-index.json"), "w") as f:
+        json.dump(index, f, indent=4)
+    for pair_folder, pair_layers in layers.items():
+        for layer in pair_layers:
+            os.makedirs(os.path.join(output, pair_folder), exist_ok=True)
+            with open(os.path.join(output, pair_folder, layer["outfile"]), "w") as f:
+                json.dump(layer["layer"], f)
+    print("done")
+
+
+def main(attack_data, frameworks, domain, version, output, writer=None):
+    """compare the mappings of several frameworks to one ATT&CK domain, writing the technique index of
+    build_technique_index and the comparison layers of every pair of frameworks to the output directory,
+    the layers of each pair in a folder named after it, e.g. nist800-53-r4-vs-nist800-53-r5.
+    :param frameworks: a dict of format {framework: (controls, mappings)}, in the order they are compared.
+                       Score deltas are the later framework of a pair minus the earlier one
+
+    :returns: the technique index
+    """
+    print("comparing frameworks... ", end="", flush=True)
+    index = build_technique_index(attack_data, frameworks)
+    layers = {}
+    for framework_a, framework_b in itertools.combinations(frameworks, 2):
+        pair_folder = f"{framework_a.replace('_', '-')}-vs-{framework_b.replace('_', '-')}"
+        layers[pair_folder] = get_comparison_layers(index, framework_a, framework_b, domain, version)
+    print("done")
+
+    if writer:
+        writer.submit(save_comparison, index, layers, output)
+    else:
+        save_comparison(index, layers, output)
+    return index
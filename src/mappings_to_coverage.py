@@ -0,0 +1,188 @@
+import json
+import os
+
+import mappings_to_heatmaps
+
+
+def ratio(part, total):
+    """return part / total rounded for the report, or 0 if total is 0"""
+    return round(part / total, 4) if total else 0
+
+
+def index_techniques(attack_data):
+    """return the active techniques of attack_data and the names of the tactics.
+    Returns a list of dicts of format {"id": ATT&CK ID, "name", "tactics": [tactic shortnames], "parent": parent
+    ATT&CK ID or None}, and a dict of format {tactic shortname: tactic name}"""
+    techniques = []
+    tactic_names = {}
+    for sdo in attack_data:
+        if not sdo.get("external_references") or sdo.get("revoked", False) or sdo.get("x_mitre_deprecated", False):
+            continue
+        attack_id = sdo["external_references"][0]["external_id"]
+        if sdo["type"] == "x-mitre-tactic" and "x_mitre_shortname" in sdo:
+            tactic_names[sdo["x_mitre_shortname"]] = sdo["name"]
+        elif sdo["type"] == "attack-pattern":
+            techniques.append({
+                "id": attack_id,
+                "name": sdo["name"],
+                "tactics": [phase["phase_name"] for phase in sdo.get("kill_chain_phases", [])
+                            if phase["kill_chain_name"].startswith("mitre")],
+                "parent": attack_id.split(".")[0] if "." in attack_id else None,
+            })
+    return techniques, tactic_names
+
+
+def build_coverage(controls, mappings, attack_data):
+    """compute the coverage of ATT&CK by the controls from one incidence matrix of the mappings
+    (see mappings_to_heatmaps.build_incidence) and one pass over the techniques.
+    Returns a dict of format
+    {
+        "techniques": {"total", "covered", "ratio"},
+        "tactics": {tactic shortname: {"name", "techniques", "covered", "ratio", "controls"}},
+        "parent_techniques": {ATT&CK ID: {"name", "covered", "subtechniques", "covered_subtechniques",
+                                          "controls": [control IDs mapped to the technique or its sub-techniques]}},
+        "families": {family ID: {"name", "controls", "mapped_controls", "techniques", "ratio"}},
+    }
+    where covered techniques have at least one mapped control, and "controls" of a tactic is the number of
+    distinct controls mapped to its techniques
+    """
+    import numpy as np
+
+    incidence = mappings_to_heatmaps.build_incidence(controls, mappings, attack_data)
+    mapped = incidence["first_mapping"] != mappings_to_heatmaps.NOT_MAPPED  # controls × mapped techniques
+    technique_column = {attack_id: column for column, attack_id in enumerate(incidence["technique_ids"])}
+    techniques, tactic_names = index_techniques(attack_data)
+
+    # group the columns of the techniques by tactic and by parent technique in one pass
+    tactic_to_techniques = {}
+    parent_to_subtechniques = {}
+    for technique in techniques:
+        for tactic in technique["tactics"]:
+            tactic_to_techniques.setdefault(tactic, []).append(technique)
+        if technique["parent"]:
+            parent_to_subtechniques.setdefault(technique["parent"], []).append(technique)
+
+    def columns(group):
+        return [technique_column[t["id"]] for t in group if t["id"] in technique_column]
+
+    covered_total = len(columns(techniques))
+    coverage = {
+        "techniques": {
+            "total": len(techniques),
+            "covered": covered_total,
+            "ratio": ratio(covered_total, len(techniques)),
+        },
+        "tactics": {},
+        "parent_techniques": {},
+        "families": {},
+    }
+
+    for tactic, group in tactic_to_techniques.items():
+        group_columns = columns(group)
+        coverage["tactics"][tactic] = {
+            "name": tactic_names.get(tactic, tactic),
+            "techniques": len(group),
+            "covered": len(group_columns),
+            "ratio": ratio(len(group_columns), len(group)),
+            "controls": int(mapped[:, group_columns].any(axis=1).sum()),
+        }
+
+    for technique in techniques:
+        if technique["parent"]:
+            continue
+        subtechniques = parent_to_subtechniques.get(technique["id"], [])
+        rollup_columns = columns([technique] + subtechniques)
+        rows = np.flatnonzero(mapped[:, rollup_columns].any(axis=1))
+        coverage["parent_techniques"][technique["id"]] = {
+            "name": technique["name"],
+            "covered": bool(len(rows)),
+            "subtechniques": len(subtechniques),
+            "covered_subtechniques": len(columns(subtechniques)),
+            "controls": sorted(incidence["control_ids"][row] for row in rows),
+        }
+
+    # mapped controls of each family per technique
+    family_counts = np.zeros((len(incidence["family_ids"]), mapped.shape[1]), dtype=np.int64)
+    np.add.at(family_counts, incidence["row_family"], mapped)
+    mapped_controls = np.zeros(len(incidence["family_ids"]), dtype=np.int64)
+    np.add.at(mapped_controls, incidence["row_family"], mapped.any(axis=1))
+    for family, family_id in enumerate(incidence["family_ids"]):
+        family_techniques = int((family_counts[family] > 0).sum())
+        coverage["families"][family_id] = {
+            "name": incidence["family_names"][family],
+            "controls": int(incidence["family_sizes"][family]),
+            "mapped_controls": int(mapped_controls[family]),
+            "techniques": family_techniques,
+            "ratio": ratio(family_techniques, len(techniques)),
+        }
+
+    return coverage
+
+
+def get_coverage_layers(coverage, domain, framework_name, version):
+    """return the Navigator layers of the coverage computed by build_coverage: a rollup of the controls mapped
+    to each parent technique and its sub-techniques, and the parent techniques left uncovered"""
+    rollup_techniques = []
+    gap_techniques = []
+    for attack_id, parent in coverage["parent_techniques"].items():
+        if parent["covered"]:
+            comment = f"Mitigated by {', '.join(parent['controls'])}"
+            if parent["subtechniques"]:
+                comment += (f" ({parent['covered_subtechniques']}/{parent['subtechniques']} "
+                            f"sub-techniques covered)")
+            rollup_techniques.append({"techniqueID": attack_id, "score": len(parent["controls"]), "comment": comment})
+        else:
+            gap_techniques.append({"techniqueID": attack_id, "score": 1, "comment": "No mapped controls"})
+
+    return [
+        {
+            "outfile": "parent-technique-rollup.json",
+            "layer": mappings_to_heatmaps.create_layer(
+                f"{framework_name} parent technique rollup",
+                f"{framework_name} coverage of each technique including its sub-techniques, where scores are "
+                f"the number of distinct controls mapped to the technique or any of its sub-techniques",
+                domain,
+                rollup_techniques,
+                version
+            )
+        },
+        {
+            "outfile": "uncovered-techniques.json",
+            "layer": mappings_to_heatmaps.create_layer(
+                f"{framework_name} uncovered techniques",
+                f"techniques where neither the technique nor any of its sub-techniques is mapped to a "
+                f"{framework_name} control",
+                domain,
+                gap_techniques,
+                version
+            )
+        },
+    ]
+
+
+def save_coverage(coverage, layers, output, layers_output):
+    """write the coverage report to output and its layers to the layers_output directory"""
+    print(f"writing coverage to {output}... ", end="", flush=True)
+    with open(output, "w") as f:
+        json.dump(coverage, f, indent=4)
+    os.makedirs(layers_output, exist_ok=True)
+    for layer in layers:
+        with open(os.path.join(layers_output, layer["outfile"]), "w") as f:
+            json.dump(layer["layer"], f)
+    print("done")
+
+
+def main(framework, attack_data, controls, mappings, domain, version, output, layers_output, writer=None):
+    """compute the coverage of the given ATT&CK domain by the controls of framework and write it as JSON to output,
+    and as ATT&CK Navigator layers to the layers_output directory. Returns the coverage, see build_coverage"""
+    print("computing coverage... ", end="", flush=True)
+    coverage = build_coverage(controls, mappings, attack_data)
+    layers = get_coverage_layers(coverage, domain, framework, version)
+    coverage = {"framework": framework, "domain": domain, "version": version, **coverage}
+    print("done")
+
+    if writer:
+        writer.submit(save_coverage, coverage, layers, output, layers_output)
+    else:
+        save_coverage(coverage, layers, output, layers_output)
+    return coverage
@@ -0,0 +1,66 @@
+import list_mappings
+
+
+def controls_to_df(controls):
+    """Return a pandas dataframe listing the controls in controls along with their family, priority and impact"""
+    import pandas
+
+    rows = []
+    for control in controls:
+        if control["type"] != "course-of-action":
+            continue  # skip control relationships
+
+        rows.append({
+            "Control ID": control["external_references"][0]["external_id"],
+            "Control Name": control["name"],
+            "Family": control.get("x_mitre_family", ""),
+            "Priority": control.get("x_mitre_priority", ""),
+            "Impact": ",".join(control.get("x_mitre_impact", [])),
+            "STIX ID": control["id"],
+        })
+
+    data_frame = pandas.DataFrame(rows)
+    data_frame.sort_values(["Control ID"], ascending=[True], inplace=True)
+
+    return data_frame
+
+
+def save_feather(data_frame, path):
+    """helper function to write a dataframe to an uncompressed Feather (Arrow IPC) file.
+    Uncompressed files can be memory-mapped by read_feather without copying the columns"""
+    import pyarrow.feather
+
+    print(f"writing {path}... ", end="", flush=True)
+    pyarrow.feather.write_feather(data_frame.reset_index(drop=True), path, compression="uncompressed")
+    print("done")
+
+
+def read_feather(path):
+    """memory-map a Feather file written by this script and return it as a pyarrow.Table.
+    Use Table.to_pandas() if a dataframe is needed"""
+    import pyarrow.feather
+
+    return pyarrow.feather.read_table(path, memory_map=True)
+
+
+def main(attack_data, controls, mappings, out_mappings, out_controls=None, writer=None, mappings_df=None):
+    """write the mappings list to out_mappings, and the control metadata to out_controls unless it is None.
+    The control metadata is the same for every ATT&CK domain, see write_controls.
+    mappings_df, if given, is the output of list_mappings.build_mappings_df for the mappings"""
+    if mappings_df is None:
+        mappings_df = list_mappings.build_mappings_df(attack_data, controls, mappings)
+    if writer:
+        writer.submit(save_feather, mappings_df, out_mappings)
+    else:
+        save_feather(mappings_df, out_mappings)
+    if out_controls is not None:
+        write_controls(controls, out_controls, writer)
+
+
+def write_controls(controls, out_controls, writer=None):
+    """write the control metadata of controls to out_controls"""
+    controls_df = controls_to_df(controls)
+    if writer:
+        writer.submit(save_feather, controls_df, out_controls)
+    else:
+        save_feather(controls_df, out_controls)
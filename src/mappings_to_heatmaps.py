@@ -1,15 +1,20 @@
+import hashlib
 import json
 import os
 import re
 import shutil
 import urllib.parse
+import zipfile
 
+# first_mapping of controls which aren't mapped to a technique, see build_incidence. np.iinfo(np.int64).max
+NOT_MAPPED = 2 ** 63 - 1
 
-def technique(attack_id, mapped_controls):
+
+def technique(attack_id, score, mapped_controls):
     """create a technique for a layer"""
     return {
         "techniqueID": attack_id,
-        "score": len(mapped_controls),  # count of mapped controls
+        "score": score,  # count of mapped controls
         "comment": f"Mitigated by {', '.join(sorted(mapped_controls))}",  # list of mapped controls
     }
 
@@ -73,57 +78,116 @@ def parse_family_data(controls):
     return family_id_to_controls, family_id_to_name, id_to_family
 
 
-def to_technique_list(controls, mappings, attack, family_id_to_controls, family_id_to_name, id_to_family):
-    """take a controls ms, a mappings ms, and attack_data ms
-    return a list of Techniques where the score is the number of controls that map to the technique"""
-    technique_to_mapped_controls = {}
-    stixid_to_object = {obj["id"]: obj for obj in attack}
-    stixid_to_object.update({obj["id"]: obj for obj in controls})
+def build_incidence(controls, mappings, attack):
+    """scan the mappings once and return the control×technique incidence matrix of the given controls,
+    from which the techniques of any subset of the controls are scored, see score_techniques.
+    Rows are the controls grouped by family, columns the mapped techniques in order of their first mapping.
+    Returns a dict of format
+    {
+        "control_row": {control STIX ID: row},
+        "control_ids": [control ID of each row],
+        "row_family": array of the family index of each row,
+        "family_ids": [ID of each family, e.g. AC],
+        "family_names": [name of each family],
+        "family_sizes": array of the number of controls in each family,
+        "family_labels": [the entry listing each family in a comment when all of its controls are mapped],
+        "technique_ids": [ATT&CK ID of each column],
+        "first_mapping": rows×columns array of the position of the control's first mapping to the technique
+                         in mappings, or NOT_MAPPED
+    }
+    """
+    import numpy as np
+
+    family_id_to_controls, family_id_to_name, id_to_family = parse_family_data(controls)
+
+    control_row = {}
+    control_ids = []
+    row_family = []
+    for family, family_id in enumerate(family_id_to_controls):
+        for control in family_id_to_controls[family_id]:
+            control_row[control["id"]] = len(control_ids)
+            control_ids.append(control["external_references"][0]["external_id"])
+            row_family.append(family)
+
+    stixid_to_technique = {obj["id"]: obj for obj in attack}
+    technique_column = {}
+    entries = []  # (row, column) of each mapping, in order
     for mapping in mappings:
         # source_ref is the control in controls
-        if mapping["source_ref"] not in stixid_to_object:
+        if mapping["source_ref"] not in control_row:
             continue  # mapping not relevant to this list of controls
-        control_id = stixid_to_object[mapping["source_ref"]]["external_references"][0]["external_id"]
         # target_ref is the technique in attack_data
-        attack_id = stixid_to_object[mapping["target_ref"]]["external_references"][0]["external_id"]
-        # build the mapping
-        if attack_id in technique_to_mapped_controls:
-            technique_to_mapped_controls[attack_id].append(control_id)
-        else:
-            technique_to_mapped_controls[attack_id] = [control_id]
-
-    # collapse families where all controls are mapped; list just the family identifier
-    for attack_id in technique_to_mapped_controls:
-        control_ids = technique_to_mapped_controls[attack_id]
-        # Group mapped controls for this technique according to the family
-        families = {}
-        for cid in control_ids:
-            family_id = id_to_family.search(cid).groups()[0]
-            if family_id not in families:
-                families[family_id] = {cid}  # new set
-            else:
-                families[family_id].add(cid)  # add to set
-
-        # are all controls in the family mapped?
-        collapsed_controls = []
-        for family_id in families:
-            family_set = families[family_id]
-            controls_in_family = set(c["external_references"][0]["external_id"]
-                                     for c in family_id_to_controls[family_id])
-            if family_set == controls_in_family:  # all controls in family mapped?
-                # collapse
-                collapsed_controls.append(f"all '{family_id_to_name[family_id]}' controls")
-            else:
-                collapsed_controls += control_ids
-        technique_to_mapped_controls[attack_id] = collapsed_controls
+        attack_id = stixid_to_technique[mapping["target_ref"]]["external_references"][0]["external_id"]
+        column = technique_column.setdefault(attack_id, len(technique_column))
+        entries.append((control_row[mapping["source_ref"]], column))
 
-    # remove duplicate mappings
-    for attack_id in technique_to_mapped_controls:
-        technique_to_mapped_controls[attack_id] = list(set(technique_to_mapped_controls[attack_id]))
+    first_mapping = np.full((len(control_ids), len(technique_column)), NOT_MAPPED, dtype=np.int64)
+    if entries:
+        rows, columns = np.array(entries).T
+        # an assignment keeps an arbitrary one of repeated indices, the unbuffered minimum keeps the earliest
+        np.minimum.at(first_mapping, (rows, columns), np.arange(len(entries)))
+
+    return {
+        "control_row": control_row,
+        "control_ids": control_ids,
+        "row_family": np.array(row_family, dtype=np.int64),
+        "family_ids": list(family_id_to_controls),
+        "family_names": [family_id_to_name[f] for f in family_id_to_controls],
+        "family_sizes": np.array([len(family_id_to_controls[f]) for f in family_id_to_controls], dtype=np.int64),
+        "family_labels": [f"all '{family_id_to_name[f]}' controls" for f in family_id_to_controls],
+        "technique_ids": list(technique_column),
+        "first_mapping": first_mapping,
+    }
 
-    # transform to techniques
-    return [technique(attack_id, technique_to_mapped_controls[attack_id])
-            for attack_id in technique_to_mapped_controls]
+
+def control_rows(incidence, controls):
+    """return the distinct rows of the incidence matrix of the given controls"""
+    import numpy as np
+
+    return np.unique(np.array([incidence["control_row"][c["id"]] for c in controls
+                               if c["id"] in incidence["control_row"]], dtype=np.int64))
+
+
+def score_techniques(incidence, rows):
+    """return a list of Techniques mapped to the controls of the given rows of the incidence matrix,
+    where the score is the number of controls that map to the technique.
+    Families where all controls are mapped are collapsed to the family in the comment"""
+    import numpy as np
+
+    first_mapping = incidence["first_mapping"][rows]
+    if not first_mapping.size:
+        return []
+    # the techniques mapped to these controls, in order of their first mapping
+    first = first_mapping.min(axis=0)
+    columns = np.flatnonzero(first != NOT_MAPPED)
+    columns = columns[np.argsort(first[columns], kind="stable")]
+    mapped = first_mapping[:, columns] != NOT_MAPPED
+
+    # mapped controls of each family per technique, compared against the size of the family
+    family_counts = np.zeros((len(incidence["family_sizes"]), len(columns)), dtype=np.int64)
+    np.add.at(family_counts, incidence["row_family"][rows], mapped)
+    collapsed = family_counts == incidence["family_sizes"][:, None]
+    partial = ((family_counts > 0) & ~collapsed).any(axis=0)
+    # a technique with any partially mapped family lists every mapped control, on top of the collapsed families
+    scores = collapsed.sum(axis=0) + np.where(partial, mapped.sum(axis=0), 0)
+
+    techniques = []
+    for i, column in enumerate(columns):
+        mapped_controls = [incidence["family_labels"][family] for family in np.flatnonzero(collapsed[:, i])]
+        if partial[i]:
+            mapped_controls += [incidence["control_ids"][row] for row in rows[mapped[:, i]]]
+        techniques.append(technique(incidence["technique_ids"][column], int(scores[i]), mapped_controls))
+    return techniques
+
+
+def to_technique_list(controls, mappings, attack, incidence=None):
+    """take a controls ms, a mappings ms, and attack_data ms
+    return a list of Techniques where the score is the number of controls that map to the technique.
+    incidence, if given, is the output of build_incidence for a superset of controls. It is reused
+    instead of rescanning attack and mappings"""
+    if incidence is None:
+        incidence = build_incidence(controls, mappings, attack)
+    return score_techniques(incidence, control_rows(incidence, controls))
 
 
 def get_framework_overview_layers(controls, mappings, attack, domain, framework_name, version):
@@ -132,6 +196,7 @@ def get_framework_overview_layers(controls, mappings, attack, domain, framework_
     dashed_framework = framework_name.replace('_', '-')
     # build list of control families
     family_id_to_controls, family_id_to_name, id_to_family = parse_family_data(controls)
+    incidence = build_incidence(controls, mappings, attack)
 
     out_layers = [
         {
@@ -141,16 +206,14 @@ def get_framework_overview_layers(controls, mappings, attack, domain, framework_
                 f"{framework_name} heatmap overview of control mappings, where scores are "
                 f"the number of associated controls",
                 domain,
-                to_technique_list(controls, mappings, attack, family_id_to_controls,
-                                  family_id_to_name, id_to_family),
+                to_technique_list(controls, mappings, attack, incidence),
                 version
             )
         }
     ]
     for family_id in family_id_to_controls:
         controls_in_family = family_id_to_controls[family_id]
-        techniques_in_family = to_technique_list(controls_in_family, mappings, attack,
-                                                 family_id_to_controls, family_id_to_name, id_to_family)
+        techniques_in_family = to_technique_list(controls_in_family, mappings, attack, incidence)
         if len(techniques_in_family) > 0:  # don't build heatmaps with no mappings
             # build family overview mapping
             out_layers.append({
@@ -169,8 +232,7 @@ def get_framework_overview_layers(controls, mappings, attack, domain, framework_
             # build layer for each control
             for control in family_id_to_controls[family_id]:
                 control_id = control["external_references"][0]["external_id"]
-                techniques_mapped_to_control = to_technique_list([control], mappings, attack,
-                                                                 family_id_to_controls, family_id_to_name, id_to_family)
+                techniques_mapped_to_control = to_technique_list([control], mappings, attack, incidence)
                 if len(techniques_mapped_to_control) > 0:  # don't build heatmaps with no mappings
                     out_layers.append({
                         "outfile": os.path.join("by_family",
@@ -188,58 +250,71 @@ def get_framework_overview_layers(controls, mappings, attack, domain, framework_
     return out_layers
 
 
-def get_layers_by_property(controls, mappings, attack_data, domain, x_mitre, version):
-    """get layers grouping the mappings according to values of the given property"""
-    property_name = x_mitre.split("x_mitre_")[1]  # remove prefix
-    family_id_to_controls, family_id_to_name, id_to_family = parse_family_data(controls)
-
-    # group controls by the property
-    property_value_to_controls = {}
+def group_by_properties(controls, x_mitres):
+    """make a single pass over the controls, grouping them according to the values of every given property.
+    Returns a dict of format {x_mitre: {value: [controls]}} and a dict of format {x_mitre: is_list_type}"""
+    property_value_to_controls = {x_mitre: {} for x_mitre in x_mitres}
+    is_list_type = {x_mitre: False for x_mitre in x_mitres}
 
-    def add_to_dict(value, control):
-        if value in property_value_to_controls:
-            property_value_to_controls[value].append(control)
+    def add_to_dict(x_mitre, value, control):
+        if value in property_value_to_controls[x_mitre]:
+            property_value_to_controls[x_mitre][value].append(control)
         else:
-            property_value_to_controls[value] = [control]
+            property_value_to_controls[x_mitre][value] = [control]
 
-    # iterate through controls, grouping by property
-    is_list_type = False
+    # iterate through controls, grouping by each property
     for control in controls:
         if control["type"] != "course-of-action":
             continue
-        value = control.get(x_mitre)
-        if not value:
-            continue
-        if isinstance(value, list):
-            is_list_type = True
-            for v in value:
-                add_to_dict(v, control)
-        else:
-            add_to_dict(value, control)
+        for x_mitre in x_mitres:
+            value = control.get(x_mitre)
+            if not value:
+                continue
+            if isinstance(value, list):
+                is_list_type[x_mitre] = True
+                for v in value:
+                    add_to_dict(x_mitre, v, control)
+            else:
+                add_to_dict(x_mitre, value, control)
+
+    return property_value_to_controls, is_list_type
+
+
+def get_layers_by_properties(controls, mappings, attack_data, domain, x_mitres, version):
+    """get layers grouping the mappings according to the values of each of the given properties.
+    The controls are grouped in one pass and the techniques of every property value are
+    scored from one incidence matrix"""
+    incidence = build_incidence(controls, mappings, attack_data)
+    property_value_to_controls, is_list_type = group_by_properties(controls, x_mitres)
 
     out_layers = []
-    for value in property_value_to_controls:
-        # controls for the corresponding values
-        controls_of_value = property_value_to_controls[value]
-        techniques = to_technique_list(controls_of_value, mappings, attack_data,
-                                       family_id_to_controls, family_id_to_name, id_to_family)
-        if len(techniques) > 0:
-            # build layer for this technique set
-            out_layers.append({
-                "outfile": os.path.join(f"by_{property_name}", f"{value}.json"),
-                "layer": create_layer(
-                    f"{property_name}={value} mappings",
-                    f"techniques where the {property_name} of associated controls "
-                    f"{'includes' if is_list_type else 'is'} {value}",
-                    domain,
-                    techniques,
-                    version
-                )
-            })
+    for x_mitre in x_mitres:
+        property_name = x_mitre.split("x_mitre_")[1]  # remove prefix
+        for value in property_value_to_controls[x_mitre]:
+            rows = control_rows(incidence, property_value_to_controls[x_mitre][value])
+            techniques = score_techniques(incidence, rows)
+            if len(techniques) > 0:
+                # build layer for this technique set
+                out_layers.append({
+                    "outfile": os.path.join(f"by_{property_name}", f"{value}.json"),
+                    "layer": create_layer(
+                        f"{property_name}={value} mappings",
+                        f"techniques where the {property_name} of associated controls "
+                        f"{'includes' if is_list_type[x_mitre] else 'is'} {value}",
+                        domain,
+                        techniques,
+                        version
+                    )
+                })
 
     return out_layers
 
 
+def get_layers_by_property(controls, mappings, attack_data, domain, x_mitre, version):
+    """get layers grouping the mappings according to values of the given property"""
+    return get_layers_by_properties(controls, mappings, attack_data, domain, [x_mitre], version)
+
+
 def get_x_mitre(objects, object_type="course-of-action"):
     """return a list of all x_mitre_ properties defined on the given type"""
     keys = set()
@@ -253,63 +328,183 @@ def get_x_mitre(objects, object_type="course-of-action"):
     return keys
 
 
-def main(framework, attack_data, controls, mappings, domain, version, output, clear, build_dir):
-    underscore_version = version.replace('v', '').replace('.', '_')
-    print("generating layers... ", end="", flush=True)
-    layers = get_framework_overview_layers(controls, mappings, attack_data, domain, framework, version)
-    for p in get_x_mitre(controls):  # iterate over all custom properties as potential layer-generation material
-        if p == "x_mitre_family":
-            continue
-        layers += get_layers_by_property(controls, mappings, attack_data, domain, p, version)
-    print("done")
+def save_layers_deduplicated(layers, output):
+    """write the layers to output storing each distinct technique payload once, under payloads/<sha256>.json.
+    manifest.json maps the outfile of every layer to its payload and to the rest of the layer (name,
+    description, gradient, etc). Returns the number of distinct payloads written"""
+    payloads_dir = os.path.join(output, "payloads")
+    os.makedirs(payloads_dir, exist_ok=True)
 
-    if clear:
-        print("clearing layers directory...", end="", flush=True)
-        shutil.rmtree(output)
+    manifest = {}
+    written = set()
+    for layer in layers:
+        payload = json.dumps(layer["layer"]["techniques"], sort_keys=True)
+        digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        if digest not in written:
+            with open(os.path.join(payloads_dir, f"{digest}.json"), "w") as f:
+                f.write(payload)
+            written.add(digest)
+        outfile = "/".join(layer["outfile"].split(os.sep))  # manifest keys always use "/"
+        manifest[outfile] = {
+            "payload": f"payloads/{digest}.json",
+            "layer": {key: value for key, value in layer["layer"].items() if key != "techniques"},
+        }
+
+    with open(os.path.join(output, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=4)
+
+    return len(written)
+
+
+def load_deduplicated_layer(output, outfile):
+    """rebuild the complete layer written to outfile by save_layers_deduplicated into the output directory"""
+    with open(os.path.join(output, "manifest.json"), "r") as f:
+        entry = json.load(f)[outfile]
+    with open(os.path.join(output, entry["payload"]), "r") as f:
+        techniques = json.load(f)
+    layer = dict(entry["layer"])
+    layer["techniques"] = techniques
+    return layer
+
+
+def save_layers(layers, output, dedup=False):
+    """write each layer to its outfile within the output directory, or deduplicated if dedup is true"""
+    if dedup:
+        print("writing deduplicated layers... ", end="", flush=True)
+        payload_count = save_layers_deduplicated(layers, output)
+        print(f"done ({payload_count} distinct payloads for {len(layers)} layers)")
+    else:
+        print("writing layers... ", end="", flush=True)
+        for layer in layers:
+            # make path if it doesn't exist. The README may be written to output at the same time, see main
+            layerdir = os.path.dirname(os.path.join(output, layer["outfile"]))
+            os.makedirs(layerdir, exist_ok=True)
+            # write layer
+            with open(os.path.join(output, layer["outfile"]), "w") as f:
+                json.dump(layer["layer"], f)
         print("done")
 
-    print("writing layers... ", end="", flush=True)
-    for layer in layers:
-        # make path if it doesn't exist
-        layerdir = os.path.dirname(os.path.join(output, layer["outfile"]))
-        if not os.path.exists(layerdir):
-            os.makedirs(layerdir)
-        # write layer
-        with open(os.path.join(output, layer["outfile"]), "w") as f:
-            json.dump(layer["layer"], f)
-    print("done")
-    if build_dir:
-        print("writing layer directory markdown... ", end="", flush=True)
 
-        mdfile_lines = [
-            "# ATT&CK Navigator Layers",
-            "",  # "" is an empty line
+def layer_directory_markdown(layers, framework, version, layers_folder="layers", relative=False, dedup=False):
+    """return the README.md listing the layers with download and ATT&CK Navigator links.
+    layers_folder is the name of the output directory within the framework folder of the repository.
+    If relative, the layers are linked by their path relative to the README instead, without Navigator links.
+    If dedup, the layers aren't linked, as they are written by save_layers_deduplicated and only exist in
+    manifest.json, and the README explains how to rebuild them"""
+    underscore_version = version.replace('v', '').replace('.', '_')
+
+    mdfile_lines = [
+        "# ATT&CK Navigator Layers",
+        "",  # "" is an empty line
+        f"The following [ATT&CK Navigator](https://github.com/mitre-attack/attack-navigator/) layers "
+        f"represent the mappings from ATT&CK to {framework}:",
+        "",
+    ]
+    if dedup:
+        mdfile_lines[-2:] = [
             f"The following [ATT&CK Navigator](https://github.com/mitre-attack/attack-navigator/) layers "
-            f"represent the mappings from ATT&CK to {framework}:",
+            f"represent the mappings from ATT&CK to {framework}. They are stored deduplicated: `manifest.json` "
+            f"maps the file name of each layer to its technique payload in `payloads/` and to the rest of the "
+            f"layer. Rebuild a layer with `mappings_to_heatmaps.load_deduplicated_layer(<this folder>, "
+            f"<file name>)` to view it in the ATT&CK Navigator:",
             "",
         ]
 
-        prefix = (f"https://raw.githubusercontent.com/center-for-threat-informed-defense/"
-                  f"attack-control-framework-mappings/main/frameworks/attack_{underscore_version}")
-        nav_prefix = "https://mitre-attack.github.io/attack-navigator/#layerURL="
+    prefix = (f"https://raw.githubusercontent.com/center-for-threat-informed-defense/"
+              f"attack-control-framework-mappings/main/frameworks/attack_{underscore_version}")
+    nav_prefix = "https://mitre-attack.github.io/attack-navigator/#layerURL="
 
-        for layer in layers:
-            if "/" in layer["outfile"]:  # force URL delimiters even if local system uses "\"
-                path_parts = layer["outfile"].split("/")
-            else:
-                path_parts = layer["outfile"].split("\\")
-
-            depth = len(path_parts) - 1  # how many subdirectories deep is it?
-            layer_name = layer['layer']['name']
-            if layer_name.endswith("overview"):
-                depth = max(0, depth - 1)  # overviews get un-indented
-            path = [prefix] + [framework, "layers"] + path_parts
+    for layer in layers:
+        if "/" in layer["outfile"]:  # force URL delimiters even if local system uses "\"
+            path_parts = layer["outfile"].split("/")
+        else:
+            path_parts = layer["outfile"].split("\\")
+
+        depth = len(path_parts) - 1  # how many subdirectories deep is it?
+        layer_name = layer['layer']['name']
+        if layer_name.endswith("overview"):
+            depth = max(0, depth - 1)  # overviews get un-indented
+        if dedup:
+            md_line = f"{'    ' * depth}- {layer_name} ( `{layer['outfile']}` )"
+        elif relative:
+            md_line = f"{'    ' * depth}- {layer_name} ( [download]({'/'.join(path_parts)}) )"
+        else:
+            path = [prefix] + [framework, layers_folder] + path_parts
             path = "/".join(path)
             encoded_path = urllib.parse.quote(path, safe='~()*!.\'')  # encode the url for the query string
             md_line = f"{'    ' * depth}- {layer_name} ( [download]({path}) | [view]({nav_prefix}{encoded_path}) )"
-            mdfile_lines.append(md_line)
+        mdfile_lines.append(md_line)
+
+    return "\n".join(mdfile_lines)
+
+
+def save_layer_directory(layers, framework, version, output, layers_folder="layers", dedup=False):
+    """write README.md to the output directory, listing the layers with download and ATT&CK Navigator links.
+    layers_folder is the name of the output directory within the framework folder of the repository.
+    If dedup, the README refers to the manifest of the deduplicated layers instead, see layer_directory_markdown"""
+    print("writing layer directory markdown... ", end="", flush=True)
+    os.makedirs(output, exist_ok=True)
+    with open(os.path.join(output, "README.md"), "w") as f:
+        f.write(layer_directory_markdown(layers, framework, version, layers_folder, dedup=dedup))
+    print("done")
+
+
+def save_layers_archive(layers, archive, readme=None):
+    """write the layers into a single zip archive instead of one file per layer, each layer under its outfile
+    (with "/" separators) and readme, if given, as README.md. The layers are serialized in memory and
+    compressed into the archive as they are written, without intermediate files"""
+    print(f"writing layers to {archive}... ", end="", flush=True)
+    with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for layer in layers:
+            zf.writestr("/".join(layer["outfile"].split(os.sep)), json.dumps(layer["layer"]))
+        if readme is not None:
+            zf.writestr("README.md", readme)
+    print("done")
+
+
+def load_archived_layer(archive, outfile):
+    """read the layer written to outfile by save_layers_archive from the archive. Only the central directory
+    of the archive and the entry of the layer are read"""
+    with zipfile.ZipFile(archive, "r") as zf:
+        return json.loads(zf.read(outfile))
 
-        with open(os.path.join(output, "README.md"), "w") as f:
-            f.write("\n".join(mdfile_lines))
 
+def main(framework, attack_data, controls, mappings, domain, version, output, clear, build_dir, dedup=False,
+         writer=None, layers_folder="layers", archive=False):
+    """build the layers and write them to the output directory. If writer, a background_writer.BackgroundWriter,
+    is given the layers and README are written on it and main returns once the layers are built.
+    If archive, the layers and README are written to a zip archive named after the output directory
+    instead, e.g. layers.zip, see save_layers_archive. The layers in the other format, if any, are removed"""
+    print("generating layers... ", end="", flush=True)
+    layers = get_framework_overview_layers(controls, mappings, attack_data, domain, framework, version)
+    # all custom properties are potential layer-generation material
+    x_mitres = [p for p in get_x_mitre(controls) if p != "x_mitre_family"]
+    layers += get_layers_by_properties(controls, mappings, attack_data, domain, x_mitres, version)
+    print("done")
+
+    if clear:
+        print("clearing layers directory...", end="", flush=True)
+        shutil.rmtree(output)
         print("done")
+
+    archive_path = f"{output}.zip"
+    if archive:
+        readme = layer_directory_markdown(layers, framework, version, layers_folder, relative=True) \
+            if build_dir else None
+        if writer:
+            writer.submit(save_layers_archive, layers, archive_path, readme)
+        else:
+            save_layers_archive(layers, archive_path, readme)
+        return
+    if os.path.exists(archive_path):
+        os.remove(archive_path)
+
+    if writer:
+        writer.submit(save_layers, layers, output, dedup)
+    else:
+        save_layers(layers, output, dedup)
+    if build_dir:
+        if writer:
+            writer.submit(save_layer_directory, layers, framework, version, output, layers_folder, dedup)
+        else:
+            save_layer_directory(layers, framework, version, output, layers_folder, dedup)
@@ -0,0 +1,112 @@
+import json
+import os
+import shutil
+
+import mappings_to_heatmaps
+
+
+def file_name(external_id):
+    """return the index file name of a control or technique ID, e.g. AC-2_(1).json for AC-2 (1)"""
+    return f"{'_'.join(external_id.split(' '))}.json"
+
+
+def build_index(attack_data, controls, mappings, version, framework, domain):
+    """build the lookup index of the mappings: one small document per technique listing the controls mapped
+    to it, one per control listing the techniques mapped to it, and a manifest of the document of each ID.
+    Every control and every active technique has a document, with an empty list if it has no mappings.
+    Returns a dict of format {relative path: document}, including manifest.json"""
+    technique_documents = {}
+    active_techniques = set()
+    for technique in attack_data:
+        if technique["type"] != "attack-pattern" or not technique.get("external_references"):
+            continue
+        technique_documents[technique["id"]] = {
+            "techniqueID": technique["external_references"][0]["external_id"],
+            "name": technique["name"],
+            "controls": [],
+        }
+        if not technique.get("revoked", False) and not technique.get("x_mitre_deprecated", False):
+            active_techniques.add(technique["id"])
+    control_documents = {}
+    family_id_to_controls, family_id_to_name, _ = mappings_to_heatmaps.parse_family_data(controls)
+    for family_id, family_controls in family_id_to_controls.items():
+        for control in family_controls:
+            control_documents[control["id"]] = {
+                "controlID": control["external_references"][0]["external_id"],
+                "name": control["name"],
+                "familyID": family_id,
+                "family": family_id_to_name[family_id],
+                "techniques": [],
+            }
+
+    for mapping in mappings:
+        control = control_documents[mapping["source_ref"]]
+        technique = technique_documents[mapping["target_ref"]]
+        technique["controls"].append({
+            "controlID": control["controlID"],
+            "name": control["name"],
+            "familyID": control["familyID"],
+            "family": control["family"],
+            "mappingType": mapping["relationship_type"],
+        })
+        control["techniques"].append({
+            "techniqueID": technique["techniqueID"],
+            "name": technique["name"],
+            "mappingType": mapping["relationship_type"],
+        })
+
+    # deprecated and revoked techniques are only indexed if something is still mapped to them
+    technique_documents = [document for stixid, document in technique_documents.items()
+                           if stixid in active_techniques or document["controls"]]
+
+    index = {}
+    manifest = {"version": version, "framework": framework, "domain": domain, "techniques": {}, "controls": {}}
+    for folder, documents, id_key, list_key, entry_key in [
+        ("techniques", technique_documents, "techniqueID", "controls", "controlID"),
+        ("controls", control_documents.values(), "controlID", "techniques", "techniqueID"),
+    ]:
+        for document in sorted(documents, key=lambda d: d[id_key]):
+            document[list_key].sort(key=lambda entry: entry[entry_key])
+            path = f"{folder}/{file_name(document[id_key])}"
+            manifest[folder][document[id_key]] = path
+            index[path] = document
+    index["manifest.json"] = manifest
+
+    return index
+
+
+def save_index(index, output):
+    """write the documents of the index to the output directory, replacing a previous index"""
+    print(f"writing index to {output}... ", end="", flush=True)
+    if os.path.exists(output):
+        shutil.rmtree(output)
+    for path, document in index.items():
+        os.makedirs(os.path.dirname(os.path.join(output, path)), exist_ok=True)
+        with open(os.path.join(output, path), "w") as f:
+            json.dump(document, f)
+    print("done")
+
+
+def lookup(output, kind, external_id):
+    """return the index document of a technique or control ID from the index in the output directory,
+    or None if the ID isn't indexed. kind is "techniques" or "controls"
+    """
+    with open(os.path.join(output, "manifest.json"), "r") as f:
+        path = json.load(f)[kind].get(external_id)
+    if path is None:
+        return None
+    with open(os.path.join(output, path), "r") as f:
+        return json.load(f)
+
+
+def main(attack_data, controls, mappings, version, framework, domain, output, writer=None):
+    """write the per-technique and per-control lookup index of the mappings to the output directory,
+    see build_index"""
+    print("building index... ", end="", flush=True)
+    index = build_index(attack_data, controls, mappings, version, framework, domain)
+    print("done")
+
+    if writer:
+        writer.submit(save_index, index, output)
+    else:
+        save_index(index, output)
@@ -0,0 +1,159 @@
+import contextlib
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS controls (
+    version TEXT NOT NULL,
+    framework TEXT NOT NULL,
+    stix_id TEXT NOT NULL,
+    control_id TEXT NOT NULL,
+    name TEXT,
+    family TEXT,
+    priority TEXT,
+    impact TEXT
+);
+CREATE TABLE IF NOT EXISTS techniques (
+    version TEXT NOT NULL,
+    framework TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    stix_id TEXT NOT NULL,
+    technique_id TEXT NOT NULL,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS mappings (
+    version TEXT NOT NULL,
+    framework TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    stix_id TEXT NOT NULL,
+    control_id TEXT NOT NULL,
+    technique_id TEXT NOT NULL,
+    mapping_type TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS control_relationships (
+    version TEXT NOT NULL,
+    framework TEXT NOT NULL,
+    stix_id TEXT NOT NULL,
+    source_control_id TEXT NOT NULL,
+    target_control_id TEXT NOT NULL,
+    relationship_type TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS controls_by_id ON controls (version, framework, control_id);
+CREATE INDEX IF NOT EXISTS controls_by_family ON controls (version, framework, family);
+CREATE UNIQUE INDEX IF NOT EXISTS techniques_by_id ON techniques (version, framework, domain, technique_id);
+CREATE INDEX IF NOT EXISTS mappings_by_control ON mappings (control_id, version, framework);
+CREATE INDEX IF NOT EXISTS mappings_by_technique ON mappings (technique_id, version, framework);
+CREATE INDEX IF NOT EXISTS control_relationships_by_source
+    ON control_relationships (source_control_id, relationship_type, version, framework);
+CREATE INDEX IF NOT EXISTS control_relationships_by_target
+    ON control_relationships (target_control_id, relationship_type, version, framework);
+"""
+
+# stored as the database's user_version. Databases written with another schema version are rebuilt from scratch
+SCHEMA_VERSION = 1
+
+TABLES = ["controls", "techniques", "mappings", "control_relationships"]
+DOMAIN_TABLES = ["techniques", "mappings"]  # tables also keyed by the ATT&CK domain
+LOCK_TIMEOUT = 60  # seconds to wait for another process writing to the database
+
+
+def external_id(sdo):
+    """return the external ID (e.g AC-1 or T1003) of the given object"""
+    return sdo["external_references"][0]["external_id"]
+
+
+def to_rows(attack_data, controls, mappings, version, framework, domain):
+    """build the rows of each table for one ATT&CK version, framework and domain.
+    Returns a dict of format {table name: [row tuples]}"""
+    stixid_to_control = {sdo["id"]: sdo for sdo in controls if sdo["type"] == "course-of-action"}
+    stixid_to_technique = {
+        sdo["id"]: sdo
+        for sdo in attack_data
+        if (sdo["type"] == "attack-pattern" and sdo.get("external_references") and
+            not sdo.get("revoked", False) and not sdo.get("x_mitre_deprecated", False))
+    }
+
+    rows = {table: [] for table in TABLES}
+    for control in stixid_to_control.values():
+        rows["controls"].append((
+            version,
+            framework,
+            control["id"],
+            external_id(control),
+            control["name"],
+            control.get("x_mitre_family"),
+            control.get("x_mitre_priority"),
+            ",".join(control["x_mitre_impact"]) if "x_mitre_impact" in control else None,
+        ))
+    for technique in stixid_to_technique.values():
+        rows["techniques"].append((
+            version,
+            framework,
+            domain,
+            technique["id"],
+            external_id(technique),
+            technique["name"],
+        ))
+    for mapping in mappings:
+        rows["mappings"].append((
+            version,
+            framework,
+            domain,
+            mapping["id"],
+            external_id(stixid_to_control[mapping["source_ref"]]),
+            external_id(stixid_to_technique[mapping["target_ref"]]),
+            mapping["relationship_type"],
+        ))
+    for relationship in controls:
+        if relationship["type"] != "relationship":
+            continue
+        rows["control_relationships"].append((
+            version,
+            framework,
+            relationship["id"],
+            external_id(stixid_to_control[relationship["source_ref"]]),
+            external_id(stixid_to_control[relationship["target_ref"]]),
+            relationship["relationship_type"],
+        ))
+
+    return rows
+
+
+def main(attack_data, controls, mappings, version, framework, output, domain="enterprise-attack",
+         write_controls=True):
+    """write the controls, techniques, mappings and control relationships of the given ATT&CK version,
+    framework and domain into the SQLite database at output. Rows previously written for the same version,
+    framework and domain are replaced, rows of other versions, frameworks and domains are kept.
+    The controls and control relationships are shared by every domain of the version and framework. If
+    write_controls is False they are left as written with another domain"""
+    rows = to_rows(attack_data, controls, mappings, version, framework, domain)
+    tables = TABLES if write_controls else DOMAIN_TABLES
+
+    print(f"writing {version} {framework} {domain} to {output}... ", end="", flush=True)
+    # the workers of make.py --work write to the same database, each waits for the transaction of the others.
+    # Transactions are begun explicitly, as the sqlite3 module would commit before the schema statements
+    with contextlib.closing(sqlite3.connect(output, timeout=LOCK_TIMEOUT, isolation_level=None)) as connection:
+        # a single transaction, holding the write lock from before the schema version is read, committed on
+        # success and rolled back on error
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            user_version, = connection.execute("PRAGMA user_version").fetchone()
+            if user_version != SCHEMA_VERSION:
+                for table in TABLES:
+                    connection.execute(f"DROP TABLE IF EXISTS {table}")  # nosec
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    connection.execute(statement)
+            connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")  # nosec
+            for table in tables:
+                where, params = "version = ? AND framework = ?", (version, framework)
+                if table in DOMAIN_TABLES:
+                    where, params = f"{where} AND domain = ?", params + (domain,)
+                connection.execute(f"DELETE FROM {table} WHERE {where}", params)  # nosec
+                if rows[table]:
+                    placeholders = ", ".join("?" * len(rows[table][0]))
+                    connection.executemany(f"INSERT INTO {table} VALUES ({placeholders})", rows[table])  # nosec
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+    print("done")
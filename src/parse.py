@@ -1,16 +1,30 @@
 import json
 import os
 
+import attack_reader
 from parse_mappings import parse_mappings
 import parse_r4_controls
 import parse_r5_controls
 
 
+def controls_parser(framework_id):
+    """return the module parsing the controls of the given framework id - e.g., "NIST 800-53 Revision 4" """
+    if framework_id == "NIST 800-53 Revision 4":
+        return parse_r4_controls
+    elif framework_id == "NIST 800-53 Revision 5":
+        return parse_r5_controls
+    else:
+        raise ValueError(f"Unknown framework_id \"{framework_id}\"")
+
+
 def save_bundle(bundle, path):
-    """helper function to write a STIX bundle to file"""
+    """helper function to write a STIX bundle to file, gzip compressed as it is serialized if path ends with .gz.
+    The other variant of the bundle, if any, is removed so that readers don't find a stale copy"""
     print(f"{'overwriting' if os.path.exists(path) else 'writing'} {path}... ", end="", flush=True)
-    with open(path, "w", encoding="utf-8") as outfile:
+    with attack_reader.open_bundle(path, "w") as outfile:
         bundle.fp_serialize(outfile, indent=4, sort_keys=True, ensure_ascii=False)
+    if os.path.exists(attack_reader.other_variant(path)):
+        os.remove(attack_reader.other_variant(path))
     print("done")
 
 
@@ -19,9 +33,10 @@ def main(in_controls,
          out_controls,
          out_mappings,
          framework_id,
-         attack_data):
+         attack_data,
+         writer=None):
     """
-    parse the NIST 800-53 controls and ATT&CK mappings into STIX2.0 bundles
+    parse the NIST 800-53 controls and ATT&CK mappings into STIX2.0 bundles and save them
     :param in_controls: tsv file of NIST 800-53 revision 4 controls
     :param in_mappings: tsv file mapping NIST 800-53 revision 4 controls to ATT&CK
     :param out_controls: output STIX bundle file for the controls. If this file already exists,
@@ -30,16 +45,67 @@ def main(in_controls,
     :param out_mappings: output STIX bundle file for the mappings.
     :param framework_id: the framework id - e.g., "NIST 800-53 Revision 4"
     :param attack_data: ATT&CK content.
+    :param writer: optional background_writer.BackgroundWriter the bundles are saved on. If not given
+                   the bundles are saved before returning.
 
     :returns tuple: containing the output controls and mappings (out_controls, out_mappings)
     """
+    controls, mappings = build(in_controls, in_mappings, out_controls, out_mappings, framework_id, attack_data)
+
+    if writer:
+        writer.submit(save_bundle, controls, out_controls)
+        writer.submit(save_bundle, mappings, out_mappings)
+    else:
+        save_bundle(controls, out_controls)
+        save_bundle(mappings, out_mappings)
+
+    return out_controls, out_mappings
+
+
+def build(in_controls,
+          in_mappings,
+          out_controls,
+          out_mappings,
+          framework_id,
+          attack_data):
+    """
+    parse the NIST 800-53 controls and ATT&CK mappings into STIX2.0 bundles
+    :param in_controls: tsv file of NIST 800-53 revision 4 controls
+    :param in_mappings: tsv file mapping NIST 800-53 revision 4 controls to ATT&CK
+    :param out_controls: output STIX bundle file for the controls. If this file already exists,
+                         the STIX IDs within will be reused in the replacing file so that they
+                         don't change between consecutive executions of this script.
+    :param out_mappings: output STIX bundle file for the mappings.
+    :param framework_id: the framework id - e.g., "NIST 800-53 Revision 4"
+    :param attack_data: ATT&CK content.
 
+    :returns tuple: containing the controls and mappings stix2.Bundles (controls, mappings)
+    """
+    controls = build_controls(in_controls, out_controls, framework_id)
+    mappings = build_mappings(in_mappings, out_mappings, controls, attack_data)
+
+    return controls, mappings
+
+
+def build_controls(in_controls, out_controls, framework_id):
+    """
+    parse the NIST 800-53 controls into a STIX2.0 bundle. The controls of a framework are the same
+    for every ATT&CK domain, so parse them once and pass them to build_mappings for each domain
+    :param in_controls: tsv file of NIST 800-53 revision 4 controls
+    :param out_controls: output STIX bundle file for the controls. If this file or its gzip compressed
+                         (or uncompressed) variant already exists, the STIX IDs within will be reused
+                         so that they don't change between consecutive executions of this script.
+    :param framework_id: the framework id - e.g., "NIST 800-53 Revision 4"
+
+    :returns: the controls stix2.Bundle
+    """
     # build control ID helper lookups so that STIX IDs don't get replaced on each rebuild
     control_ids = {}
     control_relationship_ids = {"subcontrol-of": {}, "related-to": {}}
-    if os.path.exists(out_controls):
+    existing_controls = attack_reader.find_bundle(out_controls)
+    if existing_controls:
         # parse idMappings from existing output so that IDs don't change when regenerated
-        with open(out_controls, "r") as f:
+        with attack_reader.open_bundle(existing_controls) as f:
             bundle = json.load(f)
         for sdo in bundle["objects"]:
             if not sdo["type"] == "relationship":
@@ -54,24 +120,34 @@ def main(in_controls,
                 control_relationship_ids[rel_type][from_ids] = to_id
 
     # build controls in STIX
-    if framework_id == "NIST 800-53 Revision 4":
-        parse_controls = parse_r4_controls.parse_controls
-    elif framework_id == "NIST 800-53 Revision 5":
-        parse_controls = parse_r5_controls.parse_controls
-    else:
-        raise ValueError(f"Unknown framework_id \"{framework_id}\"")
-
-    controls = parse_controls(
+    controls, _ = controls_parser(framework_id).parse_controls(
         in_controls,
         control_ids,
         control_relationship_ids,
         framework_id,
     )
 
+    return controls
+
+
+def build_mappings(in_mappings, out_mappings, controls, attack_data, attack_index=None, relationship_cache=None):
+    """
+    parse the ATT&CK mappings of one ATT&CK domain into a STIX2.0 bundle
+    :param in_mappings: tsv file mapping NIST 800-53 revision 4 controls to ATT&CK
+    :param out_mappings: output STIX bundle file for the mappings. If this file or its gzip compressed
+                         (or uncompressed) variant already exists, the STIX IDs within will be reused.
+    :param controls: the controls stix2.Bundle returned by build_controls
+    :param attack_data: ATT&CK content of the domain.
+    :param attack_index: optional parse_mappings.index_attack_data output for attack_data, shared between frameworks
+    :param relationship_cache: optional cache of the relationships of a previous build, see parse_mappings
+
+    :returns: the mappings stix2.Bundle
+    """
     # build mapping ID helper lookup so that STIX IDs don't get replaced on each rebuild
     mapping_relationship_ids = {}
-    if os.path.exists(out_mappings):
-        with open(out_mappings, "r") as f:
+    existing_mappings = attack_reader.find_bundle(out_mappings)
+    if existing_mappings:
+        with attack_reader.open_bundle(existing_mappings) as f:
             bundle = json.load(f)
         for sdo in bundle["objects"]:
             from_ids = f"{sdo['source_ref']}---{sdo['target_ref']}"
@@ -84,9 +160,8 @@ def main(in_controls,
         controls,
         mapping_relationship_ids,
         attack_data,
+        attack_index,
+        relationship_cache,
     )
 
-    save_bundle(controls, out_controls)
-    save_bundle(mappings, out_mappings)
-
-    return out_controls, out_mappings
+    return mappings
@@ -1,44 +1,96 @@
+import bisect
+import csv
+import functools
 import re
 
 from colorama import Fore
-from stix2.v20 import Bundle, Relationship
-from tqdm import tqdm
-import pandas as pd
 
 
-def dict_regex_lookup(the_dict, regex_str):
-    """return all values in the dict where the key matches the regex.
-    Params are the dict, and a string to be used as regex"""
-    # add anchor characters if they're not explicitly specified to prevent T1001 from matching T1001.001
-    regex_str = regex_str.strip()
+# the ATT&CK object fields index_attack_data and validate_mappings read, see attack_reader.load_objects
+INDEX_FIELDS = ("type", "id", "external_references", "revoked", "x_mitre_deprecated")
+
+# the mappings repeat the same few patterns in every file, each is compiled once
+compile_regex = functools.lru_cache(maxsize=None)(re.compile)
+
+# IDs without regex syntax other than "." which are looked up directly rather than matched against every key
+literal_id = re.compile(r"^[\w\- .]+$")
+
+
+def anchor(regex_str):
+    """add anchor characters to regex_str if they're not explicitly specified to prevent T1001 from matching
+    T1001.001"""
     if not regex_str.endswith("$"):
         regex_str = regex_str + "$"
     if not regex_str.startswith("^"):
         regex_str = "^" + regex_str
+    return regex_str
+
+
+def literal_prefix(regex_str):
+    """return the characters every match of regex_str starts with, e.g. T1003 for T1003(\\.001)?.
+    Empty if the regex has alternatives or character classes outside of a group"""
+    regex_str = regex_str.lstrip("^")
+    depth = 0
+    escaped = False
+    for char in regex_str:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char in "|[" and depth == 0:
+            return ""
+    prefix = re.match(r"[\w\-]*", regex_str).group()
+    # a quantifier after the prefix applies to its last character only
+    if regex_str[len(prefix):len(prefix) + 1] in ("?", "*", "{"):
+        prefix = prefix[:-1]
+    return prefix
+
+
+def key_index(the_dict):
+    """return the keys of the dict sorted for dict_regex_lookup, as a list of (key, position in the dict)"""
+    return sorted((key, position) for position, key in enumerate(the_dict))
+
+
+def dict_regex_lookup(the_dict, regex_str, cache=None, index=None):
+    """return all values in the dict where the key matches the regex.
+    Params are the dict, and a string to be used as regex.
+    cache, if given, is a dict memoizing the keys matched by each regex. It may be shared by dicts with the same keys.
+    index, if given, is the key_index of the dict. Only the keys starting with the literal prefix of the regex
+    are matched against it"""
+    regex_str = regex_str.strip()
+    # plain IDs such as AC-1 or T1003.001 are a single dict lookup. The "." is taken literally,
+    # which is the only key it can match for ATT&CK and control IDs
+    if literal_id.match(regex_str):
+        return [the_dict[regex_str]] if regex_str in the_dict else []
+    if cache is not None and regex_str in cache:
+        return [the_dict[key] for key in cache[regex_str]]
     try:
-        regex = re.compile(regex_str)
+        regex = compile_regex(anchor(regex_str))
     except Exception as err:
-        print(Fore.RED + "ERROR: cannot compile regex", regex_str, "because of", err, Fore.RESET)
+        print(Fore.RED + "ERROR: cannot compile regex", anchor(regex_str), "because of", err, Fore.RESET)
         exit()
-    values = []
-    for key in the_dict:
-        if regex.match(key):
-            if "(" in key or ")" in key:
-                continue
-            values.append(the_dict[key])
-    return values
+    candidates = the_dict
+    prefix = literal_prefix(regex_str) if index is not None else ""
+    if prefix:
+        start = bisect.bisect_left(index, (prefix,))
+        end = bisect.bisect_left(index, (prefix + "\U0010ffff",))
+        candidates = [key for key, position in sorted(index[start:end], key=lambda entry: entry[1])]
+    keys = [key for key in filter(regex.match, candidates) if "(" not in key and ")" not in key]
+    if cache is not None:
+        cache[regex_str] = keys
+    return [the_dict[key] for key in keys]
 
 
-def parse_mappings(mappings_path, controls, relationship_ids, attack_data):
-    """parse the NIST800-53 revision 4 mappings and return a STIX bundle
-    of relationships mapping the controls to ATT&CK
+def index_attack_data(attack_data):
+    """return a dict of format {attack_id: stixID} for the objects in attack_data which may be mapped to,
+    skipping relationships and revoked or deprecated objects. Build it once per ATT&CK domain and version
+    and pass it to parse_mappings for each framework"""
+    from tqdm import tqdm
 
-    :param mappings_path: the filepath to the mappings TSV file
-    :param controls: a stix2.Bundle representing the controls framework
-    :param relationship_ids: is a dict of format {relationship-source-id---relationship-target-id: relationship-id}
-                             which maps relationships to desired STIX IDs
-    :param attack_data: ATT&CK content
-    """
     tqdm_format = "{desc}: {percentage:3.0f}% |{bar}| {elapsed}<{remaining}{postfix}"
 
     # build mapping of attack ID to stixID
@@ -58,45 +110,181 @@ def parse_mappings(mappings_path, controls, relationship_ids, attack_data):
             # map attackID to stixID
             attack_id_to_stix_id[attack_object["external_references"][0]["external_id"]] = attack_object["id"]
 
+    return attack_id_to_stix_id
+
+
+def read_mappings(mappings_path):
+    """read the mappings TSV file into a list of rows, each a dict of format {column: value}"""
+    with open(mappings_path, "r", newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f, delimiter="\t"))
+
+
+def validate_mappings(mappings, control_ids, attack_data, attack_index=None, lookup_caches=None):
+    """check every row of the mappings against the controls and ATT&CK in one pass, collecting all problems
+    instead of stopping at the first one
+
+    :param mappings: the mappings rows as returned by read_mappings
+    :param control_ids: the external IDs of the controls, e.g. AC-1
+    :param attack_data: ATT&CK content, including revoked and deprecated objects. Only the INDEX_FIELDS are read
+    :param attack_index: optional output of index_attack_data for attack_data. Built from attack_data if not given
+    :param lookup_caches: optional dict of format {"controlID": cache, "techniqueID": cache} of the dict_regex_lookup
+                          caches of the control and ATT&CK IDs, shared with the parse of the same mappings
+
+    :returns: a dict of format {"rows": row count, "errors": [problem], "warnings": [problem]}, where each problem
+              is a dict of format {"row": line number in the TSV, "controlID", "techniqueID", "problem"}.
+              Rows which don't resolve are errors, rows repeating an earlier row are warnings
+    """
+    attack_id_to_stix_id = attack_index if attack_index is not None else index_attack_data(attack_data)
+    control_id_lookup = {control_id: control_id for control_id in control_ids}
+    indexes = {"controlID": key_index(control_id_lookup), "techniqueID": key_index(attack_id_to_stix_id)}
+    if lookup_caches is None:
+        lookup_caches = {"controlID": {}, "techniqueID": {}}
+    # revoked and deprecated IDs, only built if a technique doesn't resolve
+    inactive_lookups = None
+
+    report = {"rows": len(mappings), "errors": [], "warnings": []}
+
+    def add_problem(severity, row_number, row, problem):
+        report[severity].append({
+            "row": row_number,
+            "controlID": row["controlID"],
+            "techniqueID": row["techniqueID"],
+            "problem": problem,
+        })
+
+    first_row_of = {}
+    for index, row in enumerate(mappings):
+        row_number = index + 2  # 1-based line number after the header line
+
+        key = (row["controlID"].strip(), row["techniqueID"].strip())
+        if key in first_row_of:
+            add_problem("warnings", row_number, row, f"duplicate of row {first_row_of[key]}")
+            continue
+        first_row_of[key] = row_number
+
+        invalid = False
+        for column in ["controlID", "techniqueID"]:
+            if literal_id.match(row[column].strip()):
+                continue
+            try:
+                compile_regex(anchor(row[column].strip()))
+            except re.error as err:
+                add_problem("errors", row_number, row, f"invalid {column} pattern: {err}")
+                invalid = True
+        if invalid:
+            continue
+
+        if not dict_regex_lookup(control_id_lookup, row["controlID"], lookup_caches["controlID"],
+                                 indexes["controlID"]):
+            add_problem("errors", row_number, row, "unresolved controlID")
+
+        if not dict_regex_lookup(attack_id_to_stix_id, row["techniqueID"], lookup_caches["techniqueID"],
+                                 indexes["techniqueID"]):
+            if inactive_lookups is None:
+                inactive_lookups = {"revoked": {}, "deprecated": {}}
+                for attack_object in attack_data:
+                    if attack_object["type"] == "relationship" or not attack_object.get("external_references"):
+                        continue
+                    attack_id = attack_object["external_references"][0]["external_id"]
+                    if attack_object.get("revoked", False):
+                        inactive_lookups["revoked"][attack_id] = attack_id
+                    elif attack_object.get("x_mitre_deprecated", False):
+                        inactive_lookups["deprecated"][attack_id] = attack_id
+            if dict_regex_lookup(inactive_lookups["revoked"], row["techniqueID"]):
+                add_problem("errors", row_number, row, "techniqueID is revoked")
+            elif dict_regex_lookup(inactive_lookups["deprecated"], row["techniqueID"]):
+                add_problem("errors", row_number, row, "techniqueID is deprecated")
+            else:
+                add_problem("errors", row_number, row, "unresolved techniqueID")
+
+    return report
+
+
+def print_validation_report(report, mappings_path):
+    """print the problems found by validate_mappings"""
+    for problem in report["errors"]:
+        print(Fore.RED + f"ERROR: {mappings_path} row {problem['row']}: {problem['problem']} "
+              f"(controlID {problem['controlID']}, techniqueID {problem['techniqueID']})" + Fore.RESET)
+    for problem in report["warnings"]:
+        print(Fore.YELLOW + f"WARNING: {mappings_path} row {problem['row']}: {problem['problem']} "
+              f"(controlID {problem['controlID']}, techniqueID {problem['techniqueID']})" + Fore.RESET)
+    print(f"{mappings_path}: {report['rows']} rows, {len(report['errors'])} errors, "
+          f"{len(report['warnings'])} warnings")
+
+
+def parse_mappings(mappings_path, controls, relationship_ids, attack_data, attack_index=None,
+                   relationship_cache=None):
+    """parse the NIST800-53 revision 4 mappings and return a STIX bundle
+    of relationships mapping the controls to ATT&CK
+
+    :param mappings_path: the filepath to the mappings TSV file
+    :param controls: a stix2.Bundle representing the controls framework
+    :param relationship_ids: is a dict of format {relationship-source-id---relationship-target-id: relationship-id}
+                             which maps relationships to desired STIX IDs
+    :param attack_data: ATT&CK content
+    :param attack_index: optional output of index_attack_data for attack_data. Built from attack_data if not given
+    :param relationship_cache: optional dict of format {(source_ref, target_ref, id): Relationship} kept by the
+                               caller between builds of the same mappings. Relationships of unchanged rows are
+                               reused from it instead of being created and validated again. It is left holding
+                               the relationships of this build only
+    """
+    from stix2.v20 import Bundle, Relationship
+    from tqdm import tqdm
+
+    tqdm_format = "{desc}: {percentage:3.0f}% |{bar}| {elapsed}<{remaining}{postfix}"
+
+    attack_id_to_stix_id = attack_index if attack_index is not None else index_attack_data(attack_data)
+
     # build mapping of control ID to stixID
     control_id_to_stix_id = {}
     for sdo in tqdm(controls.objects, desc="parsing controls", bar_format=tqdm_format):
         if sdo.type == "course-of-action":  # only do mitigations
             control_id_to_stix_id[sdo["external_references"][0]["external_id"]] = sdo["id"]
 
+    mappings = read_mappings(mappings_path)
+
+    # report every row which doesn't resolve before stopping. Each distinct regex is only matched once,
+    # its matches are shared by the validation and the parse
+    lookup_caches = {"controlID": {}, "techniqueID": {}}
+    report = validate_mappings(mappings, control_id_to_stix_id, attack_data, attack_id_to_stix_id, lookup_caches)
+    if report["errors"]:
+        print_validation_report(report, mappings_path)
+        exit(1)
+
     # build mapping relationships
     relationships = {}
-    mappings_df = pd.read_csv(mappings_path, sep="\t", keep_default_na=False, header=0)
-    for index, row in tqdm(list(mappings_df.iterrows()), desc="parsing mappings", bar_format=tqdm_format):
+    used_cache = {}
+    for row in tqdm(mappings, desc="parsing mappings", bar_format=tqdm_format):
+        control_id, technique_id = row["controlID"], row["techniqueID"]
         # create list of control STIX IDs matching this row
-        from_ids = dict_regex_lookup(control_id_to_stix_id, row["controlID"])
+        from_ids = dict_regex_lookup(control_id_to_stix_id, control_id, lookup_caches["controlID"])
         # create list of technique STIX IDs matching this row
-        to_ids = dict_regex_lookup(attack_id_to_stix_id, row["techniqueID"])
-        # only have a description if the row does
-        # description = row["description"] if row["description"] else None
-
-        if not from_ids:
-            print(Fore.RED + "ERROR: cannot find controlID", row["controlID"], Fore.RESET)
-            print(f"{row=}")
-        if not to_ids:
-            print(Fore.RED + "ERROR: cannot find techniqueID", row["techniqueID"], Fore.RESET)
-            print(f"{row=}")
-        if not from_ids or not to_ids:
-            exit()
+        to_ids = dict_regex_lookup(attack_id_to_stix_id, technique_id, lookup_caches["techniqueID"])
 
         # combinatorics of every from to every to
         for from_id in from_ids:
             for to_id in to_ids:
                 joined_id = f"{from_id}---{to_id}"
-                # build the mapping relationship
-                r = Relationship(
-                    id=relationship_ids[joined_id] if joined_id in relationship_ids else None,
-                    source_ref=from_id,
-                    target_ref=to_id,
-                    relationship_type="mitigates",
-                )
-                if joined_id not in relationships:
-                    relationships[joined_id] = r
+                if joined_id in relationships:
+                    continue
+                key = (from_id, to_id, relationship_ids.get(joined_id))
+                if relationship_cache is not None and key in relationship_cache:
+                    r = relationship_cache[key]
+                else:
+                    # build the mapping relationship
+                    r = Relationship(
+                        id=key[2],
+                        source_ref=from_id,
+                        target_ref=to_id,
+                        relationship_type="mitigates",
+                    )
+                # keyed by the ID the relationship was saved with, which the next build reads back
+                used_cache[(from_id, to_id, r.id)] = r
+                relationships[joined_id] = r
+
+    if relationship_cache is not None:
+        relationship_cache.clear()
+        relationship_cache.update(used_cache)
 
     # construct and return the bundle of relationships
     return Bundle(*relationships.values())
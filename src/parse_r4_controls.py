@@ -1,10 +1,9 @@
+import csv
 import itertools
 import re
+import sys
 import uuid
 
-from stix2.v20 import Bundle, CourseOfAction, Relationship
-from tqdm import tqdm
-import pandas as pd
 
 id_formats = {
     "control": [                                                # CONTROL FORMATS:
@@ -38,9 +37,11 @@ def row_type(row):
 
 class Statement:
     """helper class defining a statement or substatement"""
+    __slots__ = ("external_id", "description", "substatements")
+
     def __init__(self, row):
         """constructor"""
-        self.external_id = row["NAME"]
+        self.external_id = sys.intern(row["NAME"])
         self.description = row["DESCRIPTION"]
         self.substatements = []
 
@@ -51,29 +52,33 @@ class Statement:
 
 class Control:
     """helper class defining a Control"""
+    __slots__ = ("external_id", "name", "family", "supplemental", "impact", "related", "is_enhancement",
+                 "description", "statements", "parent_id", "priority", "stix_id")
+
     def __init__(self, row, control_ids, parent=None):
         """constructor"""
-        self.external_id = row["NAME"]
+        # identifiers and the family, priority and impact values repeat across many controls of a catalog
+        # so they are interned, sharing one string object between controls, relationships and the ID assignments
+        self.external_id = sys.intern(row["NAME"])
         self.name = row["TITLE"].title()  # titlecase
-        self.family = row["FAMILY"].title()  # titlecase
+        self.family = sys.intern(row["FAMILY"].title())  # titlecase
         self.supplemental = row["SUPPLEMENTAL GUIDANCE"]
-        self.impact = row["BASELINE-IMPACT"]
-        self.related = row["RELATED"].split(",") if row["RELATED"] else []
+        self.impact = tuple(sys.intern(impact) for impact in row["BASELINE-IMPACT"].split(",")) \
+            if row["BASELINE-IMPACT"] else ()
+        self.related = [sys.intern(related_id) for related_id in row["RELATED"].split(",")] if row["RELATED"] else []
         self.is_enhancement = row_type(row) == "control_enhancement"
         self.description = row["DESCRIPTION"]
         self.statements = []
         # parent control
         self.parent_id = parent.external_id if self.is_enhancement else None
-        self.priority = parent.priority if self.is_enhancement else row["PRIORITY"]  # inherit from parent
+        self.priority = parent.priority if self.is_enhancement else sys.intern(row["PRIORITY"])  # inherit from parent
 
-        # try to manually set the STIX ID from the control_ids mapping, if not present it will randomly generate
+        # try to manually set the STIX ID from the control_ids mapping, if not present it will randomly generate.
+        # control_ids is only read, so that it can be shared by parsers running concurrently
         if control_ids and self.external_id in control_ids:
-            self.stix_id = control_ids[self.external_id]
+            self.stix_id = sys.intern(control_ids[self.external_id])
         else:
-            self.stix_id = f"course-of-action--{uuid.uuid4()}"
-
-        # update lookup so that subsequent objects can reference for relationships
-        control_ids[self.external_id] = self.stix_id
+            self.stix_id = sys.intern(f"course-of-action--{uuid.uuid4()}")
 
     def add_statement(self, row):
         """add a statement to this control"""
@@ -98,9 +103,11 @@ class Control:
 
     def to_stix(self, framework_id):
         """convert to a stix2 Course of Action"""
+        from stix2.v20 import CourseOfAction
+
         custom_properties = {}
         if self.impact:
-            custom_properties["x_mitre_impact"] = self.impact.split(",")
+            custom_properties["x_mitre_impact"] = list(self.impact)
         if self.priority:
             custom_properties["x_mitre_priority"] = self.priority
         if self.family:
@@ -120,15 +127,28 @@ class Control:
         )
 
 
+def parse_control_ids(control_path):
+    """return the IDs (e.g AC-1) of the controls and control enhancements in the controls TSV file,
+    without building the controls"""
+    with open(control_path, "r", newline="", encoding="utf-8") as controlsfile:
+        rows = csv.DictReader(controlsfile, delimiter="\t")
+        return [row["NAME"] for row in rows if row_type(row) in ("control", "control_enhancement")]
+
+
 def parse_controls(control_path, control_ids, relationship_ids, framework_id):
     """parse the NIST800-53 revision 4 controls and return a STIX bundle
     :param control_path: the filepath to the controls TSV file
     :param control_ids: is a dict of format {control_name: stixID} which maps
-                        control names (e.g AC-1) to desired STIX IDs
+                        control names (e.g AC-1) to desired STIX IDs. It isn't modified
     :param relationship_ids: is a dict of format {relationship-source-id---relationship-target-id: relationship-id},
                         same general purpose as control_ids
     :param framework_id: the framework id - e.g., "NIST 800-53 Revision 4"
+    :returns: the STIX bundle, and a dict of format {control_name: stixID} of the STIX IDs assigned to the
+              parsed controls, either reused from control_ids or newly generated
     """
+    import pandas as pd
+    from stix2.v20 import Bundle, Relationship
+    from tqdm import tqdm
 
     tqdmformat = "{desc}: {percentage:3.0f}% |{bar}| {elapsed}<{remaining}{postfix}"
 
@@ -154,14 +174,21 @@ def parse_controls(control_path, control_ids, relationship_ids, framework_id):
     for control in tqdm(controls, desc="creating controls", bar_format=tqdmformat):
         stix_controls.append(control.to_stix(framework_id))
 
+    # the ID assignments of this catalog, so that relationships only refer to controls parsed from it
+    assigned_ids = {control.external_id: control.stix_id for control in controls}
+
+    # the related-to relationships already built, so that a control listing the same related control twice
+    # gets a single relationship, whose ID is reused between builds like any other
+    related_joined_ids = set()
+
     # parse control relationships into stix
     relationships = []
-    for control in tqdm(list(filter(lambda c: control.parent_id or len(control.related) > 0, controls)),
+    for control in tqdm(list(filter(lambda c: c.parent_id or len(c.related) > 0, controls)),
                         desc="creating control relationships",
                         bar_format=tqdmformat):
         if control.parent_id:
             # build subcontrol-of relationships
-            target_id = control_ids[control.parent_id]
+            target_id = assigned_ids[control.parent_id]
             source_id = control.stix_id
             joined_id = f"{source_id}---{target_id}"
             rel_type = "subcontrol-of"
@@ -177,11 +204,14 @@ def parse_controls(control_path, control_ids, relationship_ids, framework_id):
         if len(control.related) > 0:
             # build related-to relationships
             for related_id in control.related:
-                if related_id not in control_ids:
+                if related_id not in assigned_ids:
                     continue  # sometimes related doesn't refer to a control but rather an appendix section
                 source_id = control.stix_id
-                target_id = control_ids[related_id]
+                target_id = assigned_ids[related_id]
                 joined_id = f"{source_id}---{target_id}"
+                if joined_id in related_joined_ids:
+                    continue  # listed twice
+                related_joined_ids.add(joined_id)
                 rel_type = "related-to"
                 related_refs = relationship_ids.get(rel_type, {})
 
@@ -192,4 +222,4 @@ def parse_controls(control_path, control_ids, relationship_ids, framework_id):
                     relationship_type=rel_type
                 ))
 
-    return Bundle(*itertools.chain(stix_controls, relationships), allow_custom=True)
+    return Bundle(*itertools.chain(stix_controls, relationships), allow_custom=True), assigned_ids
@@ -1,10 +1,8 @@
 import itertools
 import re
+import sys
 import uuid
 
-from stix2.v20 import Bundle, CourseOfAction, Relationship
-from tqdm import tqdm
-
 
 id_formats = {
     "control": [                                                # CONTROL FORMATS:
@@ -35,6 +33,8 @@ def row_type(row):
 
 class Control:
     """helper class defining a Control"""
+    __slots__ = ("external_id", "name", "text", "discussion", "related", "stix_id", "is_enhancement", "parent_id")
+
     def __init__(self, row, columns, control_ids):
         """constructor"""
 
@@ -45,7 +45,8 @@ class Control:
             except (KeyError, ValueError):
                 return None  # column doesn't exist for row
 
-        self.external_id = get_column("Control Identifier")
+        # identifiers are interned, sharing one string object between controls, relationships and the ID assignments
+        self.external_id = sys.intern(get_column("Control Identifier"))
         # print("id:", self.external_id)
         self.name = get_column("Control (or Control Enhancement) Name")
         # print("name:", self.name)
@@ -53,22 +54,22 @@ class Control:
         # print("text:", self.text)
         self.discussion = get_column("Discussion")
         # print("discussion:", self.discussion)
-        self.related = get_column("Related Controls").split(", ") if get_column("Related Controls") else []
+        self.related = [sys.intern(related_id) for related_id in get_column("Related Controls").split(", ")] \
+            if get_column("Related Controls") else []
         # print("related:", self.related)
 
-        # try to manually set the STIX ID from the control_ids mapping, if not present it will randomly generate
+        # try to manually set the STIX ID from the control_ids mapping, if not present it will randomly generate.
+        # control_ids is only read, so that it can be shared by parsers running concurrently
         if control_ids and self.external_id in control_ids:
-            self.stix_id = control_ids[self.external_id]
+            self.stix_id = sys.intern(control_ids[self.external_id])
         else:
-            self.stix_id = f"course-of-action--{uuid.uuid4()}"
-
-        # update lookup so that subsequent objects can reference for relationships
-        control_ids[self.external_id] = self.stix_id
+            self.stix_id = sys.intern(f"course-of-action--{uuid.uuid4()}")
 
         # if this is a control enhancement, set the parent ID
         self.is_enhancement = row_type(row) == "control_enhancement"
         # print("enhancement:", self.is_enhancement)
-        self.parent_id = id_formats["control_enhancement"][0].search(row).groups()[0] if self.is_enhancement else None
+        self.parent_id = sys.intern(id_formats["control_enhancement"][0].search(row).groups()[0]) \
+            if self.is_enhancement else None
         # print("parentID:", self.parent_id)
 
     def format_description(self):
@@ -82,6 +83,8 @@ class Control:
 
     def to_stix(self, framework_id):
         """convert to a stix2 Course of Action"""
+        from stix2.v20 import CourseOfAction
+
         return CourseOfAction(
             id=self.stix_id,
             name=self.name,
@@ -95,15 +98,34 @@ class Control:
         )
 
 
+def parse_control_ids(control_path):
+    """return the IDs (e.g AC-1) of the controls and control enhancements in the controls TSV file,
+    without building the controls"""
+    with open(control_path, "r") as controlsfile:
+        controls_data = controlsfile.read().split("\n")
+    id_column = controls_data[0].split("\t").index("Control Identifier")
+
+    control_ids = []
+    for row in controls_data[1:]:
+        row = row.strip('"')  # remove leading and trailing quotation marks
+        if row_type(row) in ("control", "control_enhancement"):
+            control_ids.append(row.split("\t")[id_column].strip('"'))
+    return control_ids
+
+
 def parse_controls(control_path, control_ids, relationship_ids, framework_id):
     """parse the NIST800-53 revision 4 controls and return a STIX bundle
     :param control_path: the filepath to the controls TSV file
     :param control_ids: is a dict of format {control_name: stixID} which maps
-                        control names (e.g AC-1) to desired STIX IDs
+                        control names (e.g AC-1) to desired STIX IDs. It isn't modified
     :param relationship_ids: is a dict of format {relationship-source-id---relationship-target-id: relationship-id},
                         same general purpose as control_ids
     :param framework_id: the framework id - e.g., "NIST 800-53 Revision 4".
+    :returns: the STIX bundle, and a dict of format {control_name: stixID} of the STIX IDs assigned to the
+              parsed controls, either reused from control_ids or newly generated
     """
+    from stix2.v20 import Bundle, Relationship
+    from tqdm import tqdm
 
     tqdmformat = "{desc}: {percentage:3.0f}% |{bar}| {elapsed}<{remaining}{postfix}"
 
@@ -133,14 +155,21 @@ def parse_controls(control_path, control_ids, relationship_ids, framework_id):
     for control in tqdm(controls, desc="creating controls", bar_format=tqdmformat):
         stix_controls.append(control.to_stix(framework_id))
 
+    # the ID assignments of this catalog, so that relationships only refer to controls parsed from it
+    assigned_ids = {control.external_id: control.stix_id for control in controls}
+
+    # the related-to relationships already built, so that a control listing the same related control twice
+    # gets a single relationship, whose ID is reused between builds like any other
+    related_joined_ids = set()
+
     # parse control relationships into stix
     relationships = []
-    for control in tqdm(list(filter(lambda c: control.parent_id or len(control.related) > 0, controls)),
+    for control in tqdm(list(filter(lambda c: c.parent_id or len(c.related) > 0, controls)),
                         desc="creating control relationships",
                         bar_format=tqdmformat):
         if control.parent_id:
             # build subcontrol-of relationships
-            target_id = control_ids[control.parent_id]
+            target_id = assigned_ids[control.parent_id]
             source_id = control.stix_id
             joined_id = f"{source_id}---{target_id}"
             rel_type = "subcontrol-of"
@@ -156,11 +185,14 @@ def parse_controls(control_path, control_ids, relationship_ids, framework_id):
         if len(control.related) > 0:
             # build related-to relationships
             for related_id in control.related:
-                if related_id not in control_ids:
+                if related_id not in assigned_ids:
                     continue  # sometimes related doesn't refer to a control but rather an appendix section
                 source_id = control.stix_id
-                target_id = control_ids[related_id]
+                target_id = assigned_ids[related_id]
                 joined_id = f"{source_id}---{target_id}"
+                if joined_id in related_joined_ids:
+                    continue  # listed twice
+                related_joined_ids.add(joined_id)
                 rel_type = "related-to"
                 related_refs = relationship_ids.get(rel_type, {})
 
@@ -171,4 +203,4 @@ def parse_controls(control_path, control_ids, relationship_ids, framework_id):
                     relationship_type=rel_type
                 ))
 
-    return Bundle(*itertools.chain(stix_controls, relationships))
+    return Bundle(*itertools.chain(stix_controls, relationships)), assigned_ids
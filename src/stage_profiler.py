@@ -0,0 +1,79 @@
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import shutil
+
+TOP = 30  # functions listed in the merged report
+
+
+class StageProfiler:
+    """helper class profiling each stage of a build separately with cProfile. The profile of each stage is
+    written to its own pstats file, named after the stage, e.g. 12_1-nist800_53_r5-enterprise-attack-heatmaps.pstats,
+    which can be inspected with python -m pstats. report merges them into a single report of the hottest functions.
+
+    A profiler without an output folder is disabled: its stages run unprofiled, so that callers don't need to
+    check whether profiling is on. cProfile only profiles the calling thread, so the outputs must be saved
+    in the profiled thread, e.g. with a background_writer.BackgroundWriter without workers, to be included.
+    """
+    def __init__(self, output=None, clear=False):
+        """constructor
+        :param output: the folder the pstats files are written to, or None to disable profiling
+        :param clear: remove the profiles of a previous build from the folder. Profilers of other processes
+                      adding to the same report, e.g. the workers of make.py --work, leave it as it is
+        """
+        self.output = output
+        if output is not None:
+            if clear and os.path.exists(output):
+                shutil.rmtree(output)
+            os.makedirs(output, exist_ok=True)
+
+    @contextlib.contextmanager
+    def stage(self, *names):
+        """profile the code run within the with block as the stage named by joining names with dashes,
+        e.g. stage("12_1", "nist800_53_r5", "controls")"""
+        if self.output is None:
+            yield
+            return
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(os.path.join(self.output, f"{'-'.join(names)}.pstats"))
+
+    def paths(self):
+        """return the paths of the pstats files of the profiled stages, including those of other processes
+        profiling into the same folder"""
+        return sorted(
+            os.path.join(self.output, file_name)
+            for file_name in os.listdir(self.output)
+            if file_name.endswith(".pstats") and file_name != "merged.pstats"
+        )
+
+    def report(self, top=TOP):
+        """merge the profiles of every stage, write them to merged.pstats and print the time taken by each stage
+        and the top functions of the merged profiles by cumulative time, also written to report.txt.
+        Does nothing if profiling is disabled
+        :param top: the number of functions to list
+        """
+        if self.output is None:
+            return
+        paths = self.paths()
+        if not paths:
+            return
+        stream = io.StringIO()
+        stage_times = sorted(((pstats.Stats(path).total_tt, path) for path in paths), reverse=True)
+        stream.write(f"{len(paths)} profiled stages in {self.output}, slowest first:\n")
+        for total_tt, path in stage_times[:top]:
+            stream.write(f"{total_tt:10.3f}s  {os.path.basename(path)[:-len('.pstats')]}\n")
+        stream.write("\n")
+
+        merged_path = os.path.join(self.output, "merged.pstats")
+        pstats.Stats(*paths).dump_stats(merged_path)
+        pstats.Stats(merged_path, stream=stream).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+        with open(os.path.join(self.output, "report.txt"), "w") as f:
+            f.write(stream.getvalue())
+        print(stream.getvalue())
@@ -1,39 +1,151 @@
+import collections
+import hashlib
+import itertools
 import json
 import os
+import shutil
 import uuid
 
+import attack_reader
+
 
 def save_bundle(bundle, path):
-    """helper function to write a STIX bundle to file"""
+    """helper function to write a STIX bundle to file. The objects of the bundle are serialized one at a time
+    as they are consumed, so bundle["objects"] may be any iterable. The output is identical to
+    json.dump(bundle, indent=4, sort_keys=True), gzip compressed as it is written if path ends with .gz.
+    The other variant of the bundle, if any, is removed so that readers don't find a stale copy"""
     print(f"{'overwriting' if os.path.exists(path) else 'writing'} {path}... ", end="", flush=True)
-    with open(path, "w", encoding="utf-8") as outfile:
-        json.dump(bundle, outfile, indent=4, sort_keys=True, ensure_ascii=False)
+    with attack_reader.open_bundle(path, "w") as outfile:
+        outfile.write("{")
+        for i, key in enumerate(sorted(bundle)):
+            outfile.write(f"{',' if i else ''}\n    {json.dumps(key)}: ")
+            if key != "objects":
+                outfile.write(json.dumps(bundle[key], indent=4, sort_keys=True, ensure_ascii=False))
+                continue
+            outfile.write("[")
+            empty = True
+            for sdo in bundle["objects"]:
+                # indent the object to its depth in the bundle; JSON strings never contain raw newlines
+                serialized = json.dumps(sdo, indent=4, sort_keys=True, ensure_ascii=False).replace("\n", "\n        ")
+                outfile.write(f"{'' if empty else ','}\n        {serialized}")
+                empty = False
+            outfile.write("]" if empty else "\n    ]")
+        outfile.write("\n}")
+    if os.path.exists(attack_reader.other_variant(path)):
+        os.remove(attack_reader.other_variant(path))
+    print("done")
+
+
+def write_shards(objects, output, bundle, by_type=True, shard_size=None):
+    """generator writing each of objects to newline-delimited JSON shard files in the output directory as it
+    passes through, yielding it unchanged. Once objects are exhausted manifest.json is written, listing the
+    shards in order with their object count and SHA-256 digest, so that importers can ingest the shards in
+    parallel and skip shards already ingested after a partial failure. A previous export in output is replaced.
+
+    :param objects: iterable of STIX objects, consumed lazily
+    :param output: the directory to write the shards and manifest to
+    :param bundle: the bundle the objects belong to, whose id and spec_version are recorded in the manifest
+    :param by_type: write the objects of each type to separate shards, e.g. attack-pattern-0000.ndjson.
+                    If false the objects are written to objects-0000.ndjson, ... in order
+    :param shard_size: the maximum number of objects per shard, or None for no limit
+    """
+    if os.path.exists(output):
+        shutil.rmtree(output)
+    os.makedirs(output)
+
+    shards = []
+    open_shards = {}  # {shard key: (shard manifest entry, file, digest)}
+    try:
+        for sdo in objects:
+            key = sdo["type"] if by_type else "objects"
+            if key in open_shards and shard_size and open_shards[key][0]["objects"] >= shard_size:
+                entry, f, digest = open_shards.pop(key)
+                f.close()
+                entry["sha256"] = digest.hexdigest()
+            if key not in open_shards:
+                index = sum(1 for shard in shards if shard["key"] == key)
+                entry = {"file": f"{key}-{index:04d}.ndjson", "key": key, "objects": 0}
+                shards.append(entry)
+                open_shards[key] = (entry, open(os.path.join(output, entry["file"]), "wb"), hashlib.sha256())
+            entry, f, digest = open_shards[key]
+            line = (json.dumps(sdo, sort_keys=True, ensure_ascii=False) + "\n").encode("utf-8")
+            f.write(line)
+            digest.update(line)
+            entry["objects"] += 1
+            yield sdo
+    finally:
+        for entry, f, digest in open_shards.values():
+            f.close()
+            entry["sha256"] = digest.hexdigest()
+
+    manifest = {
+        "id": bundle["id"],
+        "spec_version": bundle["spec_version"],
+        "objects": sum(shard["objects"] for shard in shards),
+        "shards": [
+            {"file": shard["file"], "type": shard["key"] if by_type else None, "objects": shard["objects"],
+             "sha256": shard["sha256"]}
+            for shard in shards
+        ],
+    }
+    with open(os.path.join(output, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=4)
+
+
+def save_shards(bundle, output, by_type=True, shard_size=None):
+    """helper function to write the objects of a STIX bundle as newline-delimited JSON shards, see write_shards"""
+    print(f"writing {output}... ", end="", flush=True)
+    collections.deque(write_shards(bundle["objects"], output, bundle, by_type, shard_size), maxlen=0)
     print("done")
 
 
+def save_bundle_and_shards(bundle, path, shards_output, by_type=True, shard_size=None):
+    """write a STIX bundle to file and its objects as newline-delimited JSON shards in one pass over its objects"""
+    save_bundle(dict(bundle, objects=write_shards(bundle["objects"], shards_output, bundle, by_type, shard_size)),
+                path)
+
+
+def iter_shard(output, shard):
+    """yield the objects of one shard listed in the manifest of the shards in the output directory,
+    raising ValueError if the shard doesn't match its SHA-256 digest"""
+    with open(os.path.join(output, shard["file"]), "rb") as f:
+        content = f.read()
+    if hashlib.sha256(content).hexdigest() != shard["sha256"]:
+        raise ValueError(f"shard {shard['file']} does not match its digest")
+    for line in content.splitlines():
+        yield json.loads(line)
+
+
+def read_manifest(output):
+    """return the manifest of the shards in the output directory, see write_shards"""
+    with open(os.path.join(output, "manifest.json"), "r") as f:
+        return json.load(f)
+
+
 def substitute(attack_objects, controls, mappings_bundle, allow_unmapped=False):
     """substitute the controls bundle and mappings bundle for the mitigations in attack_bundle.
     attack_bundle, controls_bundle and mappings_bundle are of type stix2.Bundle
     allow_unmapped, if true, allows controls in the output bundle if they don't have mappings to ATT&CK techniques
     Returns a new bundle resembling attack_bundle but with mitigations and mitigates relationships
-    from controls_bundle and mappings_bundle
+    from controls_bundle and mappings_bundle. attack_objects may be a stream of objects such as
+    attack_reader.iter_objects; the objects of the returned bundle are an iterator which consumes it lazily
     """
     # add attack data which are not mitigations or mitigation relationships
-    out_objects = [
+    attack_objects = (
         sdo
         for sdo in attack_objects
         if (sdo["type"] != "course-of-action" and
             not (sdo["type"] == "relationship" and sdo["relationship_type"] == "mitigates"))
-    ]
+    )
     if allow_unmapped:  # add all controls
-        out_objects.extend(controls)
+        out_controls = controls
     else:  # add only controls which have associated mappings
         used_ids = set()
         for mapping in mappings_bundle:
             used_ids.add(mapping["source_ref"])
-        out_objects.extend([sdo for sdo in controls if sdo["id"] in used_ids])
+        out_controls = [sdo for sdo in controls if sdo["id"] in used_ids]
     # add mappings
-    out_objects.extend(mappings_bundle)
+    out_objects = itertools.chain(attack_objects, out_controls, mappings_bundle)
 
     return {
         "type": "bundle",
@@ -43,9 +155,19 @@ def substitute(attack_objects, controls, mappings_bundle, allow_unmapped=False):
     }
 
 
-def main(attack_data, controls, mappings, allow_unmapped, output):
-    print("substituting... ", end="", flush=True)
+def main(attack_data, controls, mappings, allow_unmapped, output, writer=None, shards_output=None,
+         shard_by_type=True, shard_size=None):
+    """substitute the controls and mappings for the ATT&CK mitigations and save the bundle to output.
+    If shards_output is given the objects are also written as newline-delimited JSON shards to that directory,
+    in the same pass over the objects, see write_shards for shard_by_type and shard_size.
+    The objects are substituted lazily, while the bundle is saved"""
     out_bundle = substitute(attack_data, controls, mappings, allow_unmapped)
-    print("done")
 
-    save_bundle(out_bundle, output)
+    if shards_output:
+        job = (save_bundle_and_shards, out_bundle, output, shards_output, shard_by_type, shard_size)
+    else:
+        job = (save_bundle, out_bundle, output)
+    if writer:
+        writer.submit(*job)
+    else:
+        job[0](*job[1:])
@@ -0,0 +1,130 @@
+import collections
+import concurrent.futures
+import itertools
+import json
+import os
+
+from colorama import Fore
+
+import attack_reader
+
+CHUNK_SIZE = 2000  # objects per chunk, large enough that pickling a chunk costs little next to validating it
+REF_PROPERTIES = ("source_ref", "target_ref")
+
+
+def validate_chunk(objects):
+    """validate a chunk of STIX objects against the object definitions of stix2, for the STIX version of each
+    object, and collect their references. Runs in a worker process.
+    Returns a tuple of ([problem], [ID of each object], [(object ID, property, referenced ID)]), where each
+    problem is a dict of format {"id", "problem"}"""
+    import stix2
+    import stix2.exceptions
+
+    problems = []
+    ids = []
+    refs = []
+    for sdo in objects:
+        sdo_id = sdo.get("id")
+        ids.append(sdo_id)
+        if "type" not in sdo or not sdo_id:
+            problems.append({"id": sdo_id, "problem": "missing type or id"})
+            continue
+        if not sdo_id.startswith(f"{sdo['type']}--"):
+            problems.append({"id": sdo_id, "problem": f"id doesn't match type {sdo['type']}"})
+        try:
+            # custom objects such as x-mitre-tactic are returned as they are, after the checks above
+            stix2.parse(sdo, allow_custom=True)
+        except (stix2.exceptions.STIXError, ValueError) as err:
+            problems.append({"id": sdo_id, "problem": f"{type(err).__name__}: {err}"})
+        for ref_property in REF_PROPERTIES:
+            if ref_property in sdo:
+                refs.append((sdo_id, ref_property, sdo[ref_property]))
+    return problems, ids, refs
+
+
+def map_bounded(executor, func, iterable, window):
+    """like executor.map, but reading iterable and submitting its items as the results are consumed, so that
+    at most window items are held by the executor at once. Results are yielded in order"""
+    pending = collections.deque()
+    for item in iterable:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def validate_bundle(path, reference_ids=(), executor=None, chunk_size=CHUNK_SIZE, window=None):
+    """validate the STIX bundle at path: every object must conform to its STIX definition, IDs must be unique,
+    and the source_ref and target_ref of every relationship must resolve to an object of the bundle or of
+    reference_ids. The objects are validated in chunks of chunk_size across the processes of executor, and
+    the results of the chunks merged into one report.
+    :param path: the filepath to the STIX bundle, which may be gzip compressed
+    :param reference_ids: the STIX IDs of the objects of other bundles which the bundle may refer to,
+                          e.g. the controls and ATT&CK objects referred to by a mappings bundle
+    :param executor: an optional concurrent.futures.Executor to validate the chunks with. The chunks
+                     are validated in this process if not given
+    :param window: the number of chunks read ahead into executor, defaults to twice the number of CPUs
+
+    :returns: a dict of format {"bundle": path, "objects": object count, "errors": [problem]}, where each
+              problem is a dict of format {"id", "problem"}
+    """
+    objects = attack_reader.iter_objects(path)
+    chunks = iter(lambda: list(itertools.islice(objects, chunk_size)), [])
+    if executor:
+        results = map_bounded(executor, validate_chunk, chunks, window or 2 * os.cpu_count())
+    else:
+        results = map(validate_chunk, chunks)
+
+    errors = []
+    ids = set()
+    refs = []
+    object_count = 0
+    for chunk_problems, chunk_ids, chunk_refs in results:
+        errors += chunk_problems
+        for sdo_id in chunk_ids:
+            if sdo_id in ids:
+                errors.append({"id": sdo_id, "problem": "duplicate id"})
+            ids.add(sdo_id)
+        refs += chunk_refs
+        object_count += len(chunk_ids)
+
+    for sdo_id, ref_property, ref in refs:
+        if ref not in ids and ref not in reference_ids:
+            errors.append({"id": sdo_id, "problem": f"unresolved {ref_property} {ref}"})
+
+    return {"bundle": str(path), "objects": object_count, "errors": errors}
+
+
+def print_report(report):
+    """print the problems found by validate_bundle"""
+    for problem in report["errors"]:
+        print(Fore.RED + f"ERROR: {report['bundle']} {problem['id']}: {problem['problem']}" + Fore.RESET)
+    print(f"{report['bundle']}: {report['objects']} objects, {len(report['errors'])} errors")
+
+
+def main(bundles, output, workers=None, chunk_size=CHUNK_SIZE):
+    """validate the STIX bundles in parallel and write the merged report as JSON to output.
+    :param bundles: a list of tuples of format (bundle path, reference_ids), see validate_bundle
+    :param output: the filepath of the report
+    :param workers: the number of worker processes, defaults to the number of CPUs
+
+    :returns: the total number of errors
+    """
+    reports = []
+    workers = workers or os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for path, reference_ids in bundles:
+            print(f"validating {path}... ", end="", flush=True)
+            reports.append(validate_bundle(path, reference_ids, executor, chunk_size, 2 * workers))
+            print("done")
+
+    for report in reports:
+        print_report(report)
+    error_count = sum(len(report["errors"]) for report in reports)
+    print(f"writing {output}... ", end="", flush=True)
+    with open(output, "w") as f:
+        json.dump({"errors": error_count, "bundles": reports}, f, indent=4)
+    print("done")
+
+    return error_count
@@ -0,0 +1,213 @@
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+STALE_AFTER = 300  # seconds without a heartbeat after which the worker holding a job is presumed dead
+
+
+def write_json(path, data):
+    """write data as JSON to path atomically, so that readers on other nodes never see a partial file"""
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f, indent=4)
+    os.replace(temp_path, path)
+
+
+def default_worker():
+    """return the name of this worker process, e.g. build-node-2:4121"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """helper class distributing jobs to workers on any number of nodes through a shared directory, without a
+    queue service. The directory holds one file per job in jobs/, the lock file of each claimed job in locks/
+    and the result of each finished job in results/.
+
+    A worker claims a job by creating its lock file exclusively, which only one worker can do, and touches the
+    lock file while it runs the job. A lock which hasn't been touched for stale_after seconds belongs to a dead
+    worker, and the job is claimed anew by creating the lock of the next generation, e.g. job.1.lock after
+    job.0.lock, exclusively as well. Lock files are never moved or replaced, so of several workers recovering
+    the same stale lock only one claims the job. The clocks of the nodes are assumed to agree to well within
+    stale_after.
+    """
+    def __init__(self, folder, stale_after=STALE_AFTER):
+        """constructor
+        :param folder: the shared directory of the queue
+        :param stale_after: seconds without a heartbeat after which a claimed job is claimed again
+        """
+        self.folder = folder
+        self.stale_after = stale_after
+        self.jobs_folder = os.path.join(folder, "jobs")
+        self.locks_folder = os.path.join(folder, "locks")
+        self.results_folder = os.path.join(folder, "results")
+
+    def lock_path(self, job_id, generation):
+        return os.path.join(self.locks_folder, f"{job_id}.{generation}.lock")
+
+    def result_path(self, job_id):
+        return os.path.join(self.results_folder, f"{job_id}.json")
+
+    def create(self, jobs):
+        """write the jobs to the queue, replacing a previous queue in the same directory. The queue is written
+        next to the directory and moved into place, so that workers waiting for it never see part of the jobs
+        :param jobs: a dict of format {job ID: job}, where each job is a JSON serializable dict passed to the
+                     run_job function of the workers. Job IDs must be valid file names
+        """
+        temp_folder = f"{self.folder}.{uuid.uuid4().hex}.tmp"
+        for folder in ["jobs", "locks", "results"]:
+            os.makedirs(os.path.join(temp_folder, folder))
+        for job_id, job in jobs.items():
+            write_json(os.path.join(temp_folder, "jobs", f"{job_id}.json"), job)
+        if os.path.exists(self.folder):
+            shutil.rmtree(self.folder)
+        os.rename(temp_folder, self.folder)
+
+    def jobs(self):
+        """return a dict of format {job ID: job} of every job of the queue"""
+        jobs = {}
+        for file_name in sorted(os.listdir(self.jobs_folder)):
+            if file_name.endswith(".json"):
+                with open(os.path.join(self.jobs_folder, file_name), "r") as f:
+                    jobs[file_name[:-len(".json")]] = json.load(f)
+        return jobs
+
+    def results(self):
+        """return a dict of format {job ID: result} of the finished jobs, see run_worker"""
+        results = {}
+        for file_name in sorted(os.listdir(self.results_folder)):
+            if file_name.endswith(".json"):
+                with open(os.path.join(self.results_folder, file_name), "r") as f:
+                    results[file_name[:-len(".json")]] = json.load(f)
+        return results
+
+    def pending(self):
+        """return the IDs of the jobs without a result, claimed or not"""
+        return [job_id for job_id in self.jobs() if not os.path.exists(self.result_path(job_id))]
+
+    def lock_generation(self, job_id):
+        """return the generation of the latest lock of a job, or None if it isn't claimed"""
+        generations = [
+            int(file_name[len(job_id) + 1:-len(".lock")])
+            for file_name in os.listdir(self.locks_folder)
+            if file_name.startswith(f"{job_id}.") and file_name.endswith(".lock")
+            and file_name[len(job_id) + 1:-len(".lock")].isdigit()
+        ]
+        return max(generations, default=None)
+
+    def is_stale(self, job_id, generation):
+        """return whether a lock of a job hasn't been touched for stale_after seconds"""
+        try:
+            return time.time() - os.stat(self.lock_path(job_id, generation)).st_mtime > self.stale_after
+        except FileNotFoundError:
+            return False  # released in the meantime
+
+    def claim(self, worker):
+        """claim the first pending job which isn't claimed by a live worker, recovering stale locks.
+        Returns a tuple of (job ID, lock generation) of the claimed job, or None if every pending job is
+        claimed by a live worker"""
+        for job_id in self.pending():
+            generation = self.lock_generation(job_id)
+            if generation is not None:
+                if not self.is_stale(job_id, generation):
+                    continue  # claimed by a live worker
+                print(f"recovering job {job_id} from a dead worker")
+            claimed_generation = 0 if generation is None else generation + 1
+            try:
+                fd = os.open(self.lock_path(job_id, claimed_generation), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue  # claimed or recovered by another worker
+            with os.fdopen(fd, "w") as f:
+                json.dump({"worker": worker, "claimed": time.time()}, f)
+            for stale_generation in range(claimed_generation):
+                self.release(job_id, stale_generation)
+            if os.path.exists(self.result_path(job_id)):
+                self.release(job_id, claimed_generation)  # finished between pending() and the lock
+                continue
+            return job_id, claimed_generation
+        return None
+
+    def heartbeat(self, job_id, generation):
+        """touch the lock of a claimed job to show that its worker is alive"""
+        try:
+            os.utime(self.lock_path(job_id, generation))
+        except FileNotFoundError:
+            pass  # recovered by another worker after a stall, which will publish the same result
+
+    def release(self, job_id, generation):
+        """remove a lock of a job"""
+        try:
+            os.remove(self.lock_path(job_id, generation))
+        except FileNotFoundError:
+            pass
+
+    def publish(self, job_id, generation, result):
+        """write the result of a job and release its lock"""
+        write_json(self.result_path(job_id), result)
+        self.release(job_id, generation)
+
+    def run_worker(self, run_job, worker=None, poll_interval=1.0, heartbeat_interval=None):
+        """claim and run jobs until every job of the queue has a result, waiting for the queue to be created if
+        needed. A worker which finds no job to claim waits for the jobs claimed by other workers, so that it can
+        take over those of a worker which dies.
+        :param run_job: function called with each job, returning a JSON serializable dict of stage timings.
+                        A job which raises is published as failed and isn't retried
+        :param worker: the name of this worker, defaults to default_worker()
+        :param poll_interval: seconds to wait before looking for a job again when none can be claimed
+        :param heartbeat_interval: seconds between heartbeats while running a job, defaults to a quarter of
+                                   stale_after
+
+        :returns: the IDs of the jobs run by this worker
+        """
+        worker = worker or default_worker()
+        heartbeat_interval = heartbeat_interval or self.stale_after / 4
+        while not os.path.exists(self.jobs_folder):
+            time.sleep(poll_interval)  # started before the coordinator created the queue
+        jobs = self.jobs()
+        ran = []
+        while self.pending():
+            claimed = self.claim(worker)
+            if claimed is None:
+                time.sleep(poll_interval)
+                continue
+            job_id, generation = claimed
+
+            stop = threading.Event()
+
+            def beat():
+                while not stop.wait(heartbeat_interval):
+                    self.heartbeat(job_id, generation)
+
+            heart = threading.Thread(target=beat, daemon=True)
+            heart.start()
+            print(f"{worker} running job {job_id}")
+            start = time.perf_counter()
+            result = {"worker": worker, "status": "done", "error": None, "timings": {}}
+            try:
+                result["timings"] = run_job(jobs[job_id])
+            # parse_mappings exits when the mappings don't validate, which mustn't stop the worker
+            except (Exception, SystemExit) as err:
+                traceback.print_exc()
+                result["status"] = "failed"
+                result["error"] = repr(err)
+            finally:
+                stop.set()
+                heart.join()
+            result["seconds"] = time.perf_counter() - start
+            self.publish(job_id, generation, result)
+            ran.append(job_id)
+        return ran
+
+    def wait(self, poll_interval=1.0, timeout=None):
+        """wait until every job of the queue has a result, raising TimeoutError after timeout seconds.
+        Returns the results, see results"""
+        start = time.monotonic()
+        while self.pending():
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f"jobs still pending after {timeout}s: {', '.join(self.pending())}")
+            time.sleep(poll_interval)
+        return self.results()
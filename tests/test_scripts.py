@@ -1,15 +1,37 @@
+import concurrent.futures
+import contextlib
+import functools
+import itertools
 import json
 import os
 import pathlib
+import re
+import sqlite3
 import subprocess
 import sys
+import threading
+import time
+import zipfile
 
 import pytest
 
+import attack_reader
+import background_writer
+import daemon
 import list_mappings
+import mappings_to_comparison
+import mappings_to_coverage
+import mappings_to_feather
 import mappings_to_heatmaps
+import mappings_to_index
+import mappings_to_sqlite
+import make
 import parse
+import parse_mappings
+import stage_profiler
 import substitute
+import validate_stix
+import work_queue
 
 ATTACK_8_2 = "v8.2"
 ATTACK_9_0 = "v9.0"
@@ -18,19 +40,42 @@ ATTACK_VERSIONS = [ATTACK_8_2, ATTACK_9_0, ATTACK_10_1]
 R4 = "nist800_53_r4"
 R5 = "nist800_53_r5"
 NIST_REVS = [R4, R5]
+STAGE_MODULES = ["daemon", "list_mappings", "make", "mappings_to_comparison", "mappings_to_coverage",
+                 "mappings_to_feather", "mappings_to_heatmaps", "mappings_to_index", "mappings_to_sqlite", "parse",
+                 "parse_mappings", "parse_r4_controls", "parse_r5_controls", "stage_profiler", "substitute",
+                 "validate_stix", "work_queue"]
+HEAVY_MODULES = ["numpy", "openpyxl", "pandas", "pyarrow", "stix2", "tqdm"]
 
 
+@functools.lru_cache(maxsize=None)
 def get_attack_data(data_location, attack_version):
+    """load the ATT&CK data of attack_version. Loaded once per session, or once per worker process when
+    the suite runs in parallel; the returned objects are shared, so tests must not modify them"""
     if attack_version not in ATTACK_VERSIONS:
         raise ValueError(f"Unknown ATT&CK version: {attack_version}")
     attack_data_location = pathlib.Path(data_location, "data", "attack", f"enterprise-attack-{attack_version}.json")
-    with attack_data_location.open("r") as f:
+    with attack_reader.open_bundle(attack_reader.find_bundle(attack_data_location)) as f:
         attack_data = json.load(f)["objects"]
 
     return attack_data
 
 
-@pytest.fixture
+@functools.lru_cache(maxsize=None)
+def get_framework_data(data_location, attack_version, rev):
+    """load the controls and mappings of rev for attack_version from the frameworks folder.
+    Returns a tuple of (controls, mappings), cached and shared like get_attack_data"""
+    dashed_rev = rev.replace('_', '-')
+    attack_version_filepath = attack_version.replace('.', '_')[1:]  # turn v10.1 into 10_1
+    stix_location = pathlib.Path(data_location, "frameworks", f"attack_{attack_version_filepath}", rev, "stix")
+    with attack_reader.open_bundle(attack_reader.find_bundle(stix_location / f"{dashed_rev}-controls.json")) as f:
+        controls = json.load(f)["objects"]
+    with attack_reader.open_bundle(attack_reader.find_bundle(stix_location / f"{dashed_rev}-mappings.json")) as f:
+        mappings = json.load(f)["objects"]
+
+    return controls, mappings
+
+
+@pytest.fixture(scope="session")
 def dir_location():
     cwd = os.getcwd()
     if "tests" in cwd:
@@ -39,23 +84,42 @@ def dir_location():
         return cwd
 
 
+@pytest.fixture(scope="session")
+def output_location(tmp_path_factory):
+    """directory the tests write their outputs to instead of the repository. Each pytest-xdist worker
+    has its own session directory, so the tests can run in parallel"""
+    return tmp_path_factory.mktemp("outputs")
+
+
+@pytest.fixture
+def framework_output(output_location, attack_version, rev):
+    """output directory of one ATT&CK version and framework"""
+    path = output_location / attack_version / rev
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+@pytest.fixture
+def attack_data(dir_location, attack_version):
+    return get_attack_data(dir_location, attack_version)
+
+
+@pytest.fixture
+def controls(dir_location, attack_version, rev):
+    return get_framework_data(dir_location, attack_version, rev)[0]
+
+
+@pytest.fixture
+def mappings(dir_location, attack_version, rev):
+    return get_framework_data(dir_location, attack_version, rev)[1]
+
+
 @pytest.mark.parametrize("attack_version", ATTACK_VERSIONS)
 @pytest.mark.parametrize("rev", NIST_REVS)
-def test_list_mappings(dir_location, attack_version, rev):
+def test_list_mappings(attack_data, controls, mappings, framework_output, rev):
     """Tests list_mappings.py with both framework entries"""
     dashed_rev = rev.replace('_', '-')
-    attack_version_filepath = attack_version.replace('.', '_')[1:]  # turn v10.1 into 10_1
-    controls_location = pathlib.Path(dir_location, "frameworks", f"attack_{attack_version_filepath}", rev,
-                                     "stix", f"{dashed_rev}-controls.json")
-    with open(controls_location, "r") as f:
-        controls = json.load(f)["objects"]
-    mappings_location = pathlib.Path(dir_location, "frameworks", f"attack_{attack_version_filepath}", rev,
-                                     "stix", f"{dashed_rev}-mappings.json")
-    with open(mappings_location, "r") as f:
-        mappings = json.load(f)["objects"]
-    output_location = pathlib.Path(dir_location, "frameworks", f"attack_{attack_version_filepath}", rev,
-                                   f"{dashed_rev}-mappings.xlsx")
-    attack_data = get_attack_data(dir_location, attack_version)
+    output_location = framework_output / f"{dashed_rev}-mappings.xlsx"
 
     list_mappings.main(
         attack_data=attack_data,
@@ -65,23 +129,142 @@ def test_list_mappings(dir_location, attack_version, rev):
     )
 
 
+@pytest.mark.parametrize("attack_version", [ATTACK_10_1])
+@pytest.mark.parametrize("rev", NIST_REVS)
+def test_list_mappings_formats(attack_data, controls, mappings, framework_output, rev):
+    """Tests that list_mappings.py writes every format from one call"""
+    import openpyxl
+
+    dashed_rev = rev.replace('_', '-')
+    outputs = [framework_output / f"{dashed_rev}-mappings{extension}"
+               for extension in [".xlsx", ".csv", ".html", ".md"]]
+
+    list_mappings.main(
+        attack_data=attack_data,
+        controls=controls,
+        mappings=mappings,
+        output=outputs
+    )
+
+    for output in outputs:
+        assert output.stat().st_size > 0
+    with outputs[1].open("r") as f:
+        assert len(f.readlines()) == len(mappings) + 1  # header row
+    worksheet = openpyxl.load_workbook(outputs[0])["Sheet1"]
+    assert worksheet.freeze_panes == "A2"
+    assert worksheet.auto_filter.ref == f"A1:E{len(mappings) + 1}"
+    assert worksheet.column_dimensions["B"].width == 69
+
+
 @pytest.mark.parametrize("attack_version", ATTACK_VERSIONS)
 @pytest.mark.parametrize("rev", NIST_REVS)
-def test_mappings_to_heatmaps(dir_location, attack_version, rev):
-    """Tests mappings_to_heatmaps.py with both framework entries"""
+def test_mappings_to_coverage(attack_data, controls, mappings, framework_output, attack_version, rev):
+    """Tests mappings_to_coverage.py with both framework entries"""
+    coverage = mappings_to_coverage.main(
+        framework=rev,
+        attack_data=attack_data,
+        controls=controls,
+        mappings=mappings,
+        domain="enterprise-attack",
+        version=attack_version,
+        output=framework_output / "coverage.json",
+        layers_output=framework_output / "coverage-layers"
+    )
+
+    mapped_techniques = {mapping["target_ref"] for mapping in mappings}
+    assert coverage["techniques"]["covered"] == len(mapped_techniques)
+    assert sum(family["mapped_controls"] for family in coverage["families"].values()) == \
+        len({mapping["source_ref"] for mapping in mappings})
+    for attack_id, parent in coverage["parent_techniques"].items():
+        assert parent["covered"] == bool(parent["controls"])
+        assert parent["covered_subtechniques"] <= parent["subtechniques"]
+    with open(framework_output / "coverage.json", "r") as f:
+        assert json.load(f) == coverage
+    assert (framework_output / "coverage-layers" / "parent-technique-rollup.json").exists()
+
+
+@pytest.mark.parametrize("attack_version", ATTACK_VERSIONS)
+@pytest.mark.parametrize("rev", NIST_REVS)
+def test_mappings_to_index(attack_data, controls, mappings, framework_output, attack_version, rev):
+    """Tests mappings_to_index.py with both framework entries"""
+    output_location = framework_output / "index"
+    mappings_to_index.main(
+        attack_data=attack_data,
+        controls=controls,
+        mappings=mappings,
+        version=attack_version,
+        framework=rev,
+        domain="enterprise-attack",
+        output=output_location
+    )
+
+    with open(output_location / "manifest.json", "r") as f:
+        manifest = json.load(f)
+    assert len(manifest["controls"]) == len([c for c in controls if c["type"] == "course-of-action"])
+    indexed = [mappings_to_index.lookup(output_location, "controls", control_id)["techniques"]
+               for control_id in manifest["controls"]]
+    assert sum(len(techniques) for techniques in indexed) == len(mappings)
+    assert mappings_to_index.lookup(output_location, "techniques", "T0000") is None
+
+
+@pytest.mark.parametrize("attack_version", ATTACK_VERSIONS)
+def test_mappings_to_comparison(dir_location, attack_data, output_location, attack_version):
+    """Tests mappings_to_comparison.py comparing both frameworks"""
+    frameworks = {rev: get_framework_data(dir_location, attack_version, rev) for rev in NIST_REVS}
+    output = output_location / attack_version / "framework-comparison"
+    index = mappings_to_comparison.main(
+        attack_data=attack_data,
+        frameworks=frameworks,
+        domain="enterprise-attack",
+        version=attack_version,
+        output=output
+    )
+
+    def load_layer(outfile):
+        with open(output / "nist800-53-r4-vs-nist800-53-r5" / outfile, "r") as f:
+            return {technique["techniqueID"]: technique["score"] for technique in json.load(f)["techniques"]}
+
+    only_r4 = load_layer("nist800-53-r4-only.json")
+    only_r5 = load_layer("nist800-53-r5-only.json")
+    both = load_layer("both.json")
+    delta = load_layer("score-delta.json")
+    assert len(only_r4) + len(only_r5) + len(both) == len(index) == len(delta)
+    for attack_id, by_framework in index.items():
+        assert delta[attack_id] == len(by_framework.get(R5, [])) - len(by_framework.get(R4, []))
+        if len(by_framework) == 2:
+            assert attack_id in both
+        else:
+            assert attack_id in (only_r4 if R4 in by_framework else only_r5)
+
+
+@pytest.mark.parametrize("attack_version", ATTACK_VERSIONS)
+@pytest.mark.parametrize("rev", NIST_REVS)
+def test_mappings_to_feather(attack_data, controls, mappings, framework_output, attack_version, rev):
+    """Tests mappings_to_feather.py with both framework entries"""
     dashed_rev = rev.replace('_', '-')
-    attack_version_filepath = attack_version.replace('.', '_')[1:]  # turn v10.1 into 10_1
-    controls_location = pathlib.Path(dir_location, "frameworks", f"attack_{attack_version_filepath}", rev,
-                                     "stix", f"{dashed_rev}-controls.json")
-    with open(controls_location, "r") as f:
-        controls = json.load(f)["objects"]
-    mappings_location = pathlib.Path(dir_location, "frameworks", f"attack_{attack_version_filepath}", rev,
-                                     "stix", f"{dashed_rev}-mappings.json")
-    with open(mappings_location, "r") as f:
-        mappings = json.load(f)["objects"]
-    output_location = pathlib.Path(dir_location, "frameworks", f"attack_{attack_version_filepath}", rev,
-                                   "layers")
-    attack_data = get_attack_data(dir_location, attack_version)
+    dist_prefix = f"attack-{attack_version.replace('.', '-')[1:]}-to-{dashed_rev}-"  # turn v10.1 into 10-1
+    output_mappings = framework_output / f"{dist_prefix}mappings.feather"
+    output_controls = framework_output / f"{dist_prefix}controls.feather"
+
+    mappings_to_feather.main(
+        attack_data=attack_data,
+        controls=controls,
+        mappings=mappings,
+        out_mappings=output_mappings,
+        out_controls=output_controls
+    )
+
+    table = mappings_to_feather.read_feather(output_mappings)
+    assert table.num_rows == len(mappings)
+    table = mappings_to_feather.read_feather(output_controls)
+    assert table.num_rows == len([c for c in controls if c["type"] == "course-of-action"])
+
+
+@pytest.mark.parametrize("attack_version", ATTACK_VERSIONS)
+@pytest.mark.parametrize("rev", NIST_REVS)
+def test_mappings_to_heatmaps(attack_data, controls, mappings, framework_output, attack_version, rev):
+    """Tests mappings_to_heatmaps.py with both framework entries"""
+    output_location = framework_output / "layers"
 
     mappings_to_heatmaps.main(
         framework=rev,
@@ -91,63 +274,733 @@ def test_mappings_to_heatmaps(dir_location, attack_version, rev):
         domain="enterprise-attack",
         version=attack_version,
         output=output_location,
-        clear=True,
+        clear=output_location.exists(),
         build_dir=True
     )
 
 
+def test_mappings_to_heatmaps_scores():
+    """Tests the scores and comments of the overview layers of mappings_to_heatmaps.py on a fixed set of controls
+    and mappings, where a family whose controls are all mapped to a technique is collapsed in its comment"""
+    families = {"AC": "Access Control", "SC": "System and Communications Protection", "IR": None}
+    controls = [
+        {"type": "course-of-action", "id": f"course-of-action--{control_id.lower()}",
+         "external_references": [{"external_id": control_id}],
+         **({"x_mitre_family": families[control_id[:2]]} if families[control_id[:2]] else {})}
+        for control_id in ["AC-1", "AC-2", "SC-1", "SC-2", "SC-3", "IR-1"]
+    ] + [{"type": "relationship", "id": "relationship--sc-1-sc-2", "source_ref": "course-of-action--sc-1",
+          "target_ref": "course-of-action--sc-2", "relationship_type": "related-to"}]
+    attack = [
+        {"type": "attack-pattern", "id": f"attack-pattern--{attack_id.lower()}",
+         "external_references": [{"external_id": attack_id}]}
+        for attack_id in ["T1001", "T1002", "T1003", "T1004"]
+    ]
+    mappings = [
+        {"type": "relationship", "relationship_type": "mitigates",
+         "source_ref": f"course-of-action--{control_id.lower()}", "target_ref": f"attack-pattern--{attack_id.lower()}"}
+        for control_id, attack_id in [
+            ("AC-1", "T1001"), ("SC-2", "T1003"), ("AC-2", "T1001"), ("SC-1", "T1001"), ("SC-1", "T1002"),
+            ("SC-2", "T1002"), ("SC-3", "T1002"), ("SC-2", "T1003"), ("AC-2", "T1004"),
+        ]
+    ]
+
+    layers = mappings_to_heatmaps.get_framework_overview_layers(controls, mappings, attack, "enterprise-attack",
+                                                                R5, "v10.1")
+    scores = {
+        layer["outfile"]: [(t["techniqueID"], t["score"], t["comment"]) for t in layer["layer"]["techniques"]]
+        for layer in layers
+    }
+    access_control = os.path.join("by_family", "Access_Control")
+    communications = os.path.join("by_family", "System_and_Communications_Protection")
+    all_access_control = "all 'Access Control' controls"
+    all_communications = "all 'System and Communications Protection' controls"
+    assert scores == {
+        # AC is collapsed and SC partially mapped to T1001, so every mapped control is listed besides AC
+        "nist800-53-r5-overview.json": [
+            ("T1001", 4, f"Mitigated by AC-1, AC-2, SC-1, {all_access_control}"),
+            ("T1003", 1, "Mitigated by SC-2"),
+            ("T1002", 1, f"Mitigated by {all_communications}"),
+            ("T1004", 1, "Mitigated by AC-2"),
+        ],
+        os.path.join(access_control, "AC-overview.json"): [
+            ("T1001", 1, f"Mitigated by {all_access_control}"),
+            ("T1004", 1, "Mitigated by AC-2"),
+        ],
+        os.path.join(access_control, "AC-1.json"): [("T1001", 1, "Mitigated by AC-1")],
+        os.path.join(access_control, "AC-2.json"): [("T1001", 1, "Mitigated by AC-2"),
+                                                    ("T1004", 1, "Mitigated by AC-2")],
+        os.path.join(communications, "SC-overview.json"): [
+            ("T1003", 1, "Mitigated by SC-2"),
+            ("T1001", 1, "Mitigated by SC-1"),
+            ("T1002", 1, f"Mitigated by {all_communications}"),
+        ],
+        os.path.join(communications, "SC-1.json"): [("T1001", 1, "Mitigated by SC-1"),
+                                                    ("T1002", 1, "Mitigated by SC-1")],
+        # the repeated mapping of SC-2 to T1003 is counted once
+        os.path.join(communications, "SC-2.json"): [("T1003", 1, "Mitigated by SC-2"),
+                                                    ("T1002", 1, "Mitigated by SC-2")],
+        os.path.join(communications, "SC-3.json"): [("T1002", 1, "Mitigated by SC-3")],
+    }
+    gradient = next(layer["layer"]["gradient"] for layer in layers if layer["outfile"].endswith("r5-overview.json"))
+    assert (gradient["minValue"], gradient["maxValue"]) == (1, 4)
+
+
+@pytest.mark.parametrize("attack_version", [ATTACK_10_1])
+@pytest.mark.parametrize("rev", [R4])  # the revision 5 controls have no priority or impact
+def test_mappings_to_heatmaps_properties(attack_data, controls, mappings, attack_version, rev):
+    """Tests that the priority and impact layers grouped in one pass by get_layers_by_properties are those of
+    get_layers_by_property, and score the controls of each property value as to_technique_list does"""
+    x_mitres = ["x_mitre_priority", "x_mitre_impact"]
+    layers = mappings_to_heatmaps.get_layers_by_properties(controls, mappings, attack_data, "enterprise-attack",
+                                                           x_mitres, attack_version)
+    assert layers == [
+        layer
+        for x_mitre in x_mitres
+        for layer in mappings_to_heatmaps.get_layers_by_property(controls, mappings, attack_data,
+                                                                 "enterprise-attack", x_mitre, attack_version)
+    ]
+
+    expected = {}
+    for x_mitre in x_mitres:
+        property_name = x_mitre.split("x_mitre_")[1]
+        for control in controls:
+            values = control.get(x_mitre) if control["type"] == "course-of-action" else None
+            for value in ([values] if isinstance(values, str) else values or []):
+                expected.setdefault(os.path.join(f"by_{property_name}", f"{value}.json"), []).append(control)
+    # families are collapsed relative to all the controls of the framework, not only those of the value
+    incidence = mappings_to_heatmaps.build_incidence(controls, mappings, attack_data)
+    expected = {
+        outfile: mappings_to_heatmaps.to_technique_list(controls_of_value, mappings, attack_data, incidence)
+        for outfile, controls_of_value in expected.items()
+    }
+    expected = {outfile: techniques for outfile, techniques in expected.items() if techniques}
+    assert expected
+    assert {layer["outfile"]: layer["layer"]["techniques"] for layer in layers} == expected
+    assert len(layers) == len(expected)
+
+
 @pytest.mark.parametrize("attack_version", ATTACK_VERSIONS)
 @pytest.mark.parametrize("rev", NIST_REVS)
-def test_substitute(dir_location, attack_version, rev):
+def test_mappings_to_heatmaps_dedup(attack_data, controls, mappings, attack_version, rev, tmp_path):
+    """Tests that deduplicated layers from mappings_to_heatmaps.py rebuild to the regular layers"""
+    for dedup in [False, True]:
+        mappings_to_heatmaps.main(
+            framework=rev,
+            attack_data=attack_data,
+            controls=controls,
+            mappings=mappings,
+            domain="enterprise-attack",
+            version=attack_version,
+            output=tmp_path / str(dedup),
+            clear=False,
+            build_dir=True,
+            dedup=dedup
+        )
+
+    with open(tmp_path / "True" / "manifest.json", "r") as f:
+        manifest = json.load(f)
+    for outfile in manifest:
+        with open(tmp_path / "False" / outfile, "r") as f:
+            assert mappings_to_heatmaps.load_deduplicated_layer(tmp_path / "True", outfile) == json.load(f)
+    # the README of the deduplicated layers names each layer of the manifest instead of linking to missing files
+    readme = (tmp_path / "True" / "README.md").read_text()
+    assert "](" not in readme.split("\n", 3)[3]
+    assert sorted(re.findall(r"\( `(.+)` \)", readme)) == sorted(manifest)
+
+
+@pytest.mark.parametrize("attack_version", [ATTACK_10_1])
+@pytest.mark.parametrize("rev", NIST_REVS)
+def test_mappings_to_heatmaps_archive(attack_data, controls, mappings, attack_version, rev, tmp_path):
+    """Tests that layers archived by mappings_to_heatmaps.py read back to the regular layers"""
+    for archive in [False, True]:
+        mappings_to_heatmaps.main(
+            framework=rev,
+            attack_data=attack_data,
+            controls=controls,
+            mappings=mappings,
+            domain="enterprise-attack",
+            version=attack_version,
+            output=tmp_path / "layers",
+            clear=(tmp_path / "layers").exists(),
+            build_dir=True,
+            archive=archive
+        )
+        if not archive:
+            outfiles = [path.relative_to(tmp_path / "layers").as_posix() for path in (tmp_path / "layers").rglob("*")
+                        if path.suffix == ".json"]
+            layers = {outfile: json.loads((tmp_path / "layers" / outfile).read_text()) for outfile in outfiles}
+
+    assert not (tmp_path / "layers").exists()
+    for outfile, layer in layers.items():
+        assert mappings_to_heatmaps.load_archived_layer(tmp_path / "layers.zip", outfile) == layer
+    with zipfile.ZipFile(tmp_path / "layers.zip") as zf:
+        assert sorted(zf.namelist()) == sorted(outfiles + ["README.md"])
+
+
+@pytest.mark.parametrize("attack_version", ATTACK_VERSIONS)
+@pytest.mark.parametrize("rev", NIST_REVS)
+def test_mappings_to_sqlite(attack_data, controls, mappings, output_location, attack_version, rev):
+    """Tests mappings_to_sqlite.py with both framework entries"""
+    output_location = output_location / "attack-control-framework-mappings.sqlite"
+
+    # write twice to check that a rebuild replaces the rows of this version and framework
+    for _ in range(2):
+        mappings_to_sqlite.main(
+            attack_data=attack_data,
+            controls=controls,
+            mappings=mappings,
+            version=attack_version,
+            framework=rev,
+            output=output_location
+        )
+
+    with contextlib.closing(sqlite3.connect(output_location)) as connection:
+        count, = connection.execute("SELECT COUNT(*) FROM mappings WHERE version = ? AND framework = ?",
+                                    (attack_version, rev)).fetchone()
+    assert count == len(mappings)
+
+
+def test_mappings_to_sqlite_concurrently(dir_location, tmp_path):
+    """Tests that concurrent writers to a database of an older schema keep the rows of each other"""
+    output_location = tmp_path / "attack-control-framework-mappings.sqlite"
+    with contextlib.closing(sqlite3.connect(output_location)) as connection:
+        connection.execute("CREATE TABLE mappings (version TEXT)")  # schema version 0
+        connection.commit()
+
+    attack_data = get_attack_data(dir_location, ATTACK_10_1)
+    barrier = threading.Barrier(len(NIST_REVS))
+
+    def write(rev):
+        controls, mappings = get_framework_data(dir_location, ATTACK_10_1, rev)
+        barrier.wait()
+        mappings_to_sqlite.main(attack_data, controls, mappings, ATTACK_10_1, rev, output_location)
+        return len(mappings)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(NIST_REVS)) as executor:
+        expected = dict(zip(NIST_REVS, executor.map(write, NIST_REVS)))
+
+    with contextlib.closing(sqlite3.connect(output_location)) as connection:
+        counts = dict(connection.execute("SELECT framework, COUNT(*) FROM mappings GROUP BY framework").fetchall())
+    assert counts == expected
+
+
+@pytest.mark.parametrize("attack_version", ATTACK_VERSIONS)
+@pytest.mark.parametrize("rev", NIST_REVS)
+def test_substitute(attack_data, controls, mappings, framework_output, rev):
     """Tests substitute.py with both frameworks"""
     dashed_rev = rev.replace('_', '-')
-    attack_version_filepath = attack_version.replace('.', '_')[1:]  # turn v10.1 into 10_1
-    rx_controls = pathlib.Path(dir_location, "frameworks", f"attack_{attack_version_filepath}", rev,
-                               "stix", f"{dashed_rev}-controls.json")
-    with open(rx_controls, "r") as f:
-        rx_controls = json.load(f)["objects"]
-    rx_mappings = pathlib.Path(dir_location, "frameworks", f"attack_{attack_version_filepath}", rev,
-                               "stix", f"{dashed_rev}-mappings.json")
-    with open(rx_mappings, "r") as f:
-        rx_mappings = json.load(f)["objects"]
-    output_location = pathlib.Path(dir_location, "frameworks", f"attack_{attack_version_filepath}", rev,
-                                   "stix", f"{dashed_rev}-enterprise-attack.json")
-    attack_data = get_attack_data(dir_location, attack_version)
+    output_location = framework_output / f"{dashed_rev}-enterprise-attack.json"
 
     substitute.main(
         attack_data=attack_data,
-        controls=rx_controls,
-        mappings=rx_mappings,
+        controls=controls,
+        mappings=mappings,
         output=output_location,
         allow_unmapped=True
     )
 
 
-def test_make(dir_location):
+@pytest.mark.parametrize("attack_version", ATTACK_VERSIONS)
+@pytest.mark.parametrize("rev", NIST_REVS)
+def test_substitute_compressed(attack_data, controls, mappings, rev, tmp_path):
+    """Tests that compressed bundles from substitute.py decompress to the uncompressed bundles"""
+    dashed_rev = rev.replace('_', '-')
+    output_location = tmp_path / f"{dashed_rev}-enterprise-attack.json"
+
+    for output in [output_location, pathlib.Path(attack_reader.other_variant(output_location))]:
+        substitute.main(
+            attack_data=attack_data,
+            controls=controls,
+            mappings=mappings,
+            output=output,
+            allow_unmapped=True
+        )
+        # the other variant of the bundle is replaced
+        assert attack_reader.find_bundle(attack_reader.other_variant(output)) == str(output)
+
+    with attack_reader.open_bundle(attack_reader.find_bundle(output_location)) as f:
+        bundle = json.load(f)
+    assert bundle["objects"] == list(attack_reader.iter_objects(attack_reader.other_variant(output_location)))
+
+
+@pytest.mark.parametrize("attack_version", ATTACK_VERSIONS)
+@pytest.mark.parametrize("rev", NIST_REVS)
+def test_substitute_shards(attack_data, controls, mappings, rev, tmp_path):
+    """Tests that the NDJSON shards from substitute.py hold the objects of the substituted bundle"""
+    dashed_rev = rev.replace('_', '-')
+    output_location = tmp_path / f"{dashed_rev}-enterprise-attack.json"
+
+    for by_type in [True, False]:
+        shards_location = tmp_path / f"shards-{by_type}"
+        substitute.main(
+            attack_data=attack_data,
+            controls=controls,
+            mappings=mappings,
+            output=output_location,
+            allow_unmapped=True,
+            shards_output=shards_location,
+            shard_by_type=by_type,
+            shard_size=1000
+        )
+
+        with open(output_location, "r") as f:
+            bundle = json.load(f)
+        manifest = substitute.read_manifest(shards_location)
+        assert manifest["id"] == bundle["id"]
+        assert manifest["objects"] == len(bundle["objects"])
+        shard_objects = []
+        for shard in manifest["shards"]:
+            objects = list(substitute.iter_shard(shards_location, shard))
+            assert 0 < len(objects) == shard["objects"] <= 1000
+            assert not by_type or all(sdo["type"] == shard["type"] for sdo in objects)
+            shard_objects += objects
+        assert len(shard_objects) == len(bundle["objects"])
+        assert {sdo["id"]: sdo for sdo in shard_objects} == {sdo["id"]: sdo for sdo in bundle["objects"]}
+
+
+@pytest.mark.parametrize("attack_version", ATTACK_VERSIONS)
+def test_attack_reader(dir_location, attack_data, attack_version):
+    """Tests that attack_reader.py projects the ATT&CK objects without changing the projected fields"""
+    attack_data_location = pathlib.Path(dir_location, "data", "attack", f"enterprise-attack-{attack_version}.json")
+    attack_data_location = attack_reader.find_bundle(attack_data_location)
+
+    assert list(attack_reader.iter_objects(attack_data_location)) == attack_data
+    projected = attack_reader.load_objects(attack_data_location)
+    expected = [sdo for sdo in attack_data if sdo["type"] != "relationship"]
+    assert len(projected) == len(expected)
+    for projected_sdo, sdo in zip(projected, expected):
+        assert set(projected_sdo) <= set(attack_reader.PIPELINE_FIELDS)
+        assert projected_sdo["id"] == sdo["id"]
+        if "external_references" in sdo:
+            assert projected_sdo["external_references"] == sdo["external_references"][:1]
+
+
+def test_object_store(dir_location, tmp_path):
+    """Tests that attack_reader.ObjectStore holds objects shared by several releases once"""
+    attack_data_location = pathlib.Path(dir_location, "data", "attack", f"enterprise-attack-{ATTACK_10_1}.json")
+    attack_data_location = attack_reader.find_bundle(attack_data_location)
+    with attack_reader.open_bundle(attack_data_location) as f:
+        bundle = json.load(f)
+    # a later release changing one technique and removing another
+    techniques = [i for i, sdo in enumerate(bundle["objects"]) if sdo["type"] == "attack-pattern"]
+    bundle["objects"][techniques[0]] = {**bundle["objects"][techniques[0]], "modified": "2099-01-01T00:00:00.000Z"}
+    del bundle["objects"][techniques[1]]
+    with open(tmp_path / "next-release.json", "w") as f:
+        json.dump(bundle, f)
+
+    store = attack_reader.ObjectStore()
+    release = store.add_release("release", attack_data_location)
+    assert release == attack_reader.load_objects(attack_data_location)
+    next_release = store.add_release("next", tmp_path / "next-release.json")
+    assert len(next_release) == len(release) - 1
+    assert len(store.objects) == len(release) + 1
+    shared = {id(sdo) for sdo in release} & {id(sdo) for sdo in next_release}
+    assert len(shared) == len(release) - 2
+
+    store.remove_release("release")
+    assert len(store.objects) == len(next_release)
+
+
+def test_background_writer(tmp_path):
+    """Tests that background_writer.py runs every job before the flush barrier and propagates job errors,
+    including jobs which exit"""
+    def write(path, text):
+        path.write_text(text)
+
+    def fail():
+        raise ValueError("failed to write")
+
+    with background_writer.BackgroundWriter(workers=2, max_pending=1) as writer:
+        for i in range(10):
+            writer.submit(write, tmp_path / f"{i}.txt", str(i))
+        writer.flush()
+        assert sorted(path.read_text() for path in tmp_path.iterdir()) == [str(i) for i in range(10)]
+
+    with pytest.raises(ValueError):
+        with background_writer.BackgroundWriter() as writer:
+            writer.submit(fail)
+
+    with background_writer.BackgroundWriter() as writer:
+        writer.submit(fail)
+        with pytest.raises(ValueError):
+            writer.flush()
+        writer.submit(write, tmp_path / "after.txt", "after")  # a failed job doesn't fail later jobs
+        writer.flush()
+    assert (tmp_path / "after.txt").read_text() == "after"
+
+    # a job exiting is raised by flush, and its worker keeps running jobs
+    with background_writer.BackgroundWriter(workers=1, max_pending=1) as writer:
+        writer.submit(exit, 1)
+        with pytest.raises(SystemExit):
+            writer.flush()
+        for i in range(3):
+            writer.submit(write, tmp_path / "after.txt", str(i))
+        writer.flush()
+    assert (tmp_path / "after.txt").read_text() == "2"
+
+
+def test_stage_profiler(tmp_path, capsys):
+    """Tests that stage_profiler.py profiles each stage separately, including the jobs of a writer without
+    workers, and reports on the merged profiles"""
+    def encode(objects):
+        return json.dumps(objects)
+
+    def save(objects, path):
+        path.write_text(encode(objects))
+
+    profiler = stage_profiler.StageProfiler(tmp_path / "profile", clear=True)
+    with background_writer.BackgroundWriter(workers=0) as writer:
+        for version in ["10_1", "12_1"]:
+            with profiler.stage(version, R5, "save"):
+                writer.submit(save, [{"id": i} for i in range(1000)], tmp_path / f"{version}.json")
+    profiler.report(top=10)
+
+    assert sorted(os.listdir(tmp_path / "profile")) == [
+        f"10_1-{R5}-save.pstats", f"12_1-{R5}-save.pstats", "merged.pstats", "report.txt"
+    ]
+    report = (tmp_path / "profile" / "report.txt").read_text()
+    assert f"12_1-{R5}-save" in report
+    assert "(encode)" in report
+    assert report in capsys.readouterr().out
+
+    disabled = stage_profiler.StageProfiler()
+    with disabled.stage("disabled"):
+        pass
+    disabled.report()
+    assert len(os.listdir(tmp_path / "profile")) == 4
+
+
+def test_daemon_rebuild(dir_location, tmp_path, monkeypatch):
+    """Tests that the daemon rebuilds the layers of a pair and the comparison of its ATT&CK version within a second
+    of a change to its mappings, then its bulk exports, and keeps rebuilding after a failed write"""
+    data_location = tmp_path / "repository" / "data"
+    (data_location / "attack").mkdir(parents=True)
+    (data_location / "mappings").mkdir()
+    os.symlink(pathlib.Path(dir_location, "data", "controls"), data_location / "controls")
+    attack_location = pathlib.Path(attack_reader.find_bundle(
+        pathlib.Path(dir_location, "data", "attack", f"enterprise-attack-{ATTACK_10_1}.json")))
+    os.symlink(attack_location, data_location / "attack" / attack_location.name)
+    for dashed_rev in ["nist800-53-r4", "nist800-53-r5"]:
+        in_mappings = data_location / "mappings" / f"attack-10-1-to-{dashed_rev}-mappings.tsv"
+        in_mappings.write_text(pathlib.Path(dir_location, "data", "mappings", in_mappings.name).read_text())
+    monkeypatch.setattr(make, "PROJECT_FOLDER", tmp_path / "repository")
+
+    output = tmp_path / "output"
+    out_mappings = output / "frameworks" / "attack_10_1" / R5 / "stix" / "nist800-53-r5-mappings.json"
+    out_xlsx = output / "dist" / "attack-10-1-to-nist800-53-r5-mappings.xlsx"
+    out_coverage = output / "dist" / "attack-10-1-to-nist800-53-r5-coverage.json"
+    out_index = output / "dist" / "attack-10-1-framework-comparison" / "technique-index.json"
+
+    def compared_techniques(framework):
+        with open(out_index, "r") as f:
+            return sum(framework in frameworks for frameworks in json.load(f).values())
+
+    build_daemon = daemon.BuildDaemon(output_folder=output)
+    try:
+        build_daemon.warm()
+        assert not output.exists()  # the caches are loaded without writing any output
+        assert build_daemon.handle_request({"wait": True}) == {"rebuilt": [["10_1", R4], ["10_1", R5]],
+                                                               "errors": []}
+        assert (output / "dist" / "attack-10-1-to-nist800-53-r5-controls.feather").is_file()
+        assert out_xlsx.is_file()
+        with open(out_mappings, "r") as f:
+            mapping_count = len(json.load(f)["objects"])
+        r4_techniques, r5_techniques = compared_techniques(R4), compared_techniques(R5)
+
+        rows = in_mappings.read_text().splitlines(keepends=True)
+        in_mappings.write_text("".join(rows[:len(rows) // 2]))  # half of the R5 mappings are removed
+        # CPU time, so that the other processes of a parallel test run don't count
+        start = time.process_time()
+        assert build_daemon.handle_request({"framework": R5}) == {"rebuilt": [["10_1", R5]], "errors": []}
+        assert time.process_time() - start < 1
+        with open(out_mappings, "r") as f:
+            assert len(json.load(f)["objects"]) < mapping_count
+        # the comparison is rewritten with the new R5 mappings and the R4 mappings of the previous build
+        assert compared_techniques(R4) == r4_techniques
+        assert compared_techniques(R5) < r5_techniques
+
+        out_coverage.unlink()
+        out_coverage.mkdir()  # the coverage can't be written
+        response = build_daemon.handle_request({"framework": R5})
+        assert response["rebuilt"] == [] and len(response["errors"]) == 1
+        out_coverage.rmdir()
+        out_xlsx.unlink()
+        out_xlsx.mkdir()  # the list of mappings can't be written, which is reported once the exports are built
+        response = build_daemon.handle_request({"framework": R5, "wait": True})
+        assert response["rebuilt"] == [["10_1", R5]] and len(response["errors"]) == 1
+        out_xlsx.rmdir()
+        assert build_daemon.handle_request({"framework": R5, "wait": True}) == {"rebuilt": [["10_1", R5]],
+                                                                                "errors": []}
+        assert out_coverage.is_file() and out_xlsx.is_file()
+    finally:
+        build_daemon.writer.close()
+        build_daemon.export_writer.close()
+
+
+def test_build_framework_domains(dir_location, tmp_path, monkeypatch):
+    """Tests that make.py builds the mobile- outputs of a framework mapped to ATT&CK for Mobile along with its
+    enterprise outputs, parsing the controls once and writing them to the SQLite database once"""
+    data_location = tmp_path / "repository" / "data"
+    (data_location / "attack").mkdir(parents=True)
+    (data_location / "mappings").mkdir()
+    os.symlink(pathlib.Path(dir_location, "data", "controls"), data_location / "controls")
+    attack_location = pathlib.Path(attack_reader.find_bundle(
+        pathlib.Path(dir_location, "data", "attack", f"enterprise-attack-{ATTACK_10_1}.json")))
+    os.symlink(attack_location, data_location / "attack" / attack_location.name)
+
+    # a small mobile release of a few techniques, given new STIX and ATT&CK IDs
+    techniques = [
+        sdo for sdo in get_attack_data(dir_location, ATTACK_10_1)
+        if sdo["type"] == "attack-pattern" and not sdo.get("revoked") and not sdo.get("x_mitre_deprecated")
+    ][:5]
+    mobile_data = []
+    for i, technique in enumerate(techniques):
+        external_references = [dict(technique["external_references"][0], external_id=f"T14{i:02}")]
+        mobile_data.append(dict(technique, id=f"attack-pattern--00000000-0000-4000-8000-{i:012}",
+                                external_references=external_references))
+    with open(data_location / "attack" / f"mobile-attack-{ATTACK_10_1}.json", "w") as f:
+        json.dump({"type": "bundle", "id": "bundle--00000000-0000-4000-8000-000000000000",
+                   "spec_version": "2.0", "objects": mobile_data}, f)
+
+    mappings_name = "attack-10-1-to-nist800-53-r5-mappings.tsv"
+    rows = pathlib.Path(dir_location, "data", "mappings", mappings_name).read_text().splitlines(keepends=True)
+    (data_location / "mappings" / mappings_name).write_text("".join(rows[:50]))
+    mobile_rows = [f"10/1/21\tM1013\tT14{i:02}\tAC-{i + 2}\t\n" for i in range(len(mobile_data))]
+    (data_location / "mappings" / "attack-10-1-to-nist800-53-r5-mobile-mappings.tsv").write_text(
+        rows[0] + "".join(mobile_rows))
+    monkeypatch.setattr(make, "PROJECT_FOLDER", tmp_path / "repository")
+
+    parsed = []
+    build_controls = parse.build_controls
+    monkeypatch.setattr(parse, "build_controls", lambda **kwargs: parsed.append(kwargs) or build_controls(**kwargs))
+    listed = []
+    mappings_to_df = list_mappings.mappings_to_df
+    monkeypatch.setattr(list_mappings, "mappings_to_df", lambda *args: listed.append(args) or mappings_to_df(*args))
+    sqlite_writes = []
+    sqlite_main = mappings_to_sqlite.main
+    monkeypatch.setattr(mappings_to_sqlite, "main",
+                        lambda *args, **kwargs: sqlite_writes.append(kwargs) or sqlite_main(*args, **kwargs))
+
+    output = tmp_path / "output"
+    writer = background_writer.BackgroundWriter(workers=0)
+    controls, mapped = make.build_framework("10_1", R5, {}, writer, output_folder=output)
+
+    assert len(parsed) == 1
+    assert len(listed) == 2  # the list of mappings and the Feather file of each domain share a dataframe
+    assert [(kwargs["domain"], kwargs["write_controls"]) for kwargs in sqlite_writes] == [
+        (make.ENTERPRISE, True), (make.MOBILE, False)]
+    assert list(mapped) == [make.ENTERPRISE, make.MOBILE]
+    assert sorted(mapping["target_ref"] for mapping in mapped[make.MOBILE]) == [sdo["id"] for sdo in mobile_data]
+
+    framework_folder = output / "frameworks" / "attack_10_1" / R5
+    assert (framework_folder / "stix" / "nist800-53-r5-mobile-mappings.json").is_file()
+    assert (framework_folder / "stix" / "nist800-53-r5-mobile-attack.json").is_file()
+    assert any((framework_folder / "mobile-layers").iterdir())
+    for name in ["mobile-mappings.xlsx", "mobile-mappings.feather", "mobile-coverage.json"]:
+        assert (output / "dist" / f"attack-10-1-to-nist800-53-r5-{name}").is_file()
+
+    with contextlib.closing(sqlite3.connect(output / "dist" / "attack-control-framework-mappings.sqlite")) as db:
+        assert db.execute("SELECT COUNT(*) FROM controls").fetchone()[0] == len(
+            [sdo for sdo in controls if sdo["type"] == "course-of-action"])
+        assert db.execute("SELECT domain, COUNT(*) FROM mappings GROUP BY domain ORDER BY domain").fetchall() == [
+            (make.ENTERPRISE, len(mapped[make.ENTERPRISE])), (make.MOBILE, len(mobile_data))]
+
+
+def test_work_queue(tmp_path):
+    """Tests that work_queue.py runs every job once across several workers and recovers the job of a dead worker"""
+    queue = work_queue.WorkQueue(tmp_path / "queue", stale_after=1)
+    queue.create({f"job-{i}": {"value": i} for i in range(8)})
+    # a worker which claimed job-0 and died without a heartbeat
+    with open(queue.lock_path("job-0", 0), "w") as f:
+        json.dump({"worker": "dead", "claimed": 0}, f)
+    os.utime(queue.lock_path("job-0", 0), (0, 0))
+
+    def run_job(job):
+        if job["value"] == 7:
+            raise ValueError("failed to build")
+        return {"stage": job["value"]}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        ran = list(executor.map(
+            lambda worker: queue.run_worker(run_job, worker, poll_interval=0.05, heartbeat_interval=0.2),
+            ["worker-1", "worker-2", "worker-3"]
+        ))
+
+    assert sorted(itertools.chain(*ran)) == sorted(queue.jobs())
+    results = queue.wait(timeout=1)
+    assert results["job-0"]["worker"] != "dead"
+    assert results["job-3"]["timings"] == {"stage": 3}
+    assert results["job-7"]["status"] == "failed"
+    assert not queue.pending()
+    assert not [path for path in os.listdir(queue.locks_folder) if path.endswith(".lock")]
+
+
+def test_work_queue_recover_once(tmp_path):
+    """Tests that of several workers recovering the same stale lock at once, only one claims the job"""
+    queue = work_queue.WorkQueue(tmp_path / "queue", stale_after=1)
+    queue.create({"job": {}})
+    with open(queue.lock_path("job", 0), "w") as f:
+        json.dump({"worker": "dead", "claimed": 0}, f)
+    os.utime(queue.lock_path("job", 0), (0, 0))
+
+    barrier = threading.Barrier(8)
+
+    def claim(worker):
+        barrier.wait()
+        return queue.claim(worker)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        claims = list(executor.map(claim, [f"worker-{i}" for i in range(8)]))
+
+    assert [claimed for claimed in claims if claimed] == [("job", 1)]
+    assert os.listdir(queue.locks_folder) == ["job.1.lock"]
+    assert queue.claim("late-worker") is None  # the recovered lock is fresh
+
+
+@pytest.mark.parametrize("attack_version", ATTACK_VERSIONS)
+@pytest.mark.parametrize("rev", NIST_REVS)
+def test_validate_mappings(dir_location, attack_data, attack_version, rev):
+    """Tests parse_mappings.validate_mappings reports every unresolved row"""
+    dashed_rev = rev.replace('_', '-')
+    dashed_attack_version = attack_version.replace('.', '-')[1:]  # turn v10.1 into 10-1
+    controls_location = pathlib.Path(dir_location, "data", "controls", f"{dashed_rev}-controls.tsv")
+    mappings_location = pathlib.Path(dir_location, "data", "mappings",
+                                     f"attack-{dashed_attack_version}-to-{dashed_rev}-mappings.tsv")
+    framework_id = "NIST 800-53 Revision 4" if rev == R4 else "NIST 800-53 Revision 5"
+    control_ids = parse.controls_parser(framework_id).parse_control_ids(controls_location)
+
+    rows = parse_mappings.read_mappings(mappings_location)
+    report = parse_mappings.validate_mappings(rows, control_ids, attack_data)
+    assert report["rows"] == len(rows)
+    assert not report["errors"]
+
+    bad_rows = [
+        {"controlID": "XX-99", "techniqueID": rows[0]["techniqueID"]},
+        {"controlID": rows[0]["controlID"], "techniqueID": "T9999.999"},
+    ]
+    report = parse_mappings.validate_mappings(bad_rows, control_ids, attack_data)
+    assert [problem["problem"] for problem in report["errors"]] == ["unresolved controlID", "unresolved techniqueID"]
+    assert [problem["row"] for problem in report["errors"]] == [2, 3]
+
+
+def test_check(dir_location, tmp_path):
+    """Tests make.py --check-only validates every mappings file in well under a second of CPU time,
+    without loading pandas"""
+    script = ("import pathlib, sys, time, make; start = time.process_time(); "
+              f"errors = make.check(pathlib.Path({str(tmp_path)!r})); "
+              "print(errors, time.process_time() - start, 'pandas' in sys.modules)")
+    result = subprocess.run([sys.executable, "-c", script], cwd=pathlib.Path(dir_location, "src"),
+                            capture_output=True, text=True, check=True)
+    errors, seconds, pandas_loaded = result.stdout.strip().split("\n")[-1].split()
+    assert errors == "0"
+    assert float(seconds) < 1
+    assert pandas_loaded == "False"
+    mappings_count = len(list(pathlib.Path(dir_location, "data", "mappings").glob("*-mappings.tsv")))
+    assert len(list((tmp_path / "dist").glob("*validation.json"))) == mappings_count
+
+
+def test_make(dir_location, output_location):
     """Test the main make.py script"""
     script_location = f"{dir_location}/src/make.py"
     child_process = subprocess.Popen([
-        sys.executable, script_location,
+        sys.executable, script_location, "--output", str(output_location / "make"),
     ])
     child_process.wait(timeout=1080)
     assert child_process.returncode == 0
 
 
+@pytest.mark.parametrize("attack_version", [ATTACK_10_1])
+@pytest.mark.parametrize("rev", NIST_REVS)
+def test_validate_stix(dir_location, attack_data, controls, mappings, framework_output, attack_version, rev):
+    """Tests validate_stix.py with valid bundles and with a bundle with invalid objects and dangling references"""
+    dashed_rev = rev.replace('_', '-')
+    attack_version_filepath = attack_version.replace('.', '_')[1:]  # turn v10.1 into 10_1
+    stix_location = pathlib.Path(dir_location, "frameworks", f"attack_{attack_version_filepath}", rev, "stix")
+    reference_ids = {sdo["id"] for sdo in itertools.chain(controls, attack_data)}
+
+    technique_id = next(sdo["id"] for sdo in attack_data if sdo["type"] == "attack-pattern")
+    invalid_bundle = framework_output / "invalid-mappings.json"
+    with open(invalid_bundle, "w") as f:
+        json.dump({"type": "bundle", "id": "bundle--0b2c4f5e-4d1d-4b6a-9d3e-2f1a6c7b8e90", "spec_version": "2.0",
+                   "objects": mappings[:2] + mappings[:1] + [
+                       {**mappings[2], "source_ref": "course-of-action--5f3a2d4c-9b0e-4a8f-8c1d-7e6b5a4f3c2d"},
+                       {key: value for key, value in mappings[3].items() if key != "relationship_type"},
+                       {**mappings[4], "id": f"attack-pattern--{mappings[4]['id'].split('--')[1]}"},
+                       {**mappings[5], "target_ref": technique_id},
+                   ]}, f)
+
+    bundles = [
+        (stix_location / f"{dashed_rev}-mappings.json", reference_ids),
+        (invalid_bundle, reference_ids),
+    ]
+    error_count = validate_stix.main(bundles, framework_output / "stix-validation.json", workers=2, chunk_size=500)
+
+    with open(framework_output / "stix-validation.json", "r") as f:
+        report = json.load(f)
+    assert report["errors"] == error_count
+    assert report["bundles"][0]["errors"] == []
+    assert report["bundles"][0]["objects"] == len(mappings)
+    problems = [problem["problem"] for problem in report["bundles"][1]["errors"]]
+    assert "duplicate id" in problems
+    assert any(problem.startswith("unresolved source_ref") for problem in problems)
+    assert any("relationship_type" in problem for problem in problems)
+    assert any(problem.startswith("id doesn't match type") for problem in problems)
+    assert error_count == len(problems)
+
+
+@pytest.mark.parametrize("attack_version", [ATTACK_10_1])
+@pytest.mark.parametrize("rev", [R5])
+def test_validate_stix_window(dir_location, controls, attack_data, attack_version, rev):
+    """Tests that validate_stix.py reads at most window chunks ahead of the results it has merged"""
+    stix_location = pathlib.Path(dir_location, "frameworks", "attack_10_1", rev, "stix", "nist800-53-r5-mappings.json")
+    reference_ids = {sdo["id"] for sdo in itertools.chain(controls, attack_data)}
+    events = []
+
+    class RecordingFuture(concurrent.futures.Future):
+        def result(self, timeout=None):
+            events.append(-1)
+            return super().result(timeout)
+
+    class RecordingExecutor(concurrent.futures.Executor):
+        def submit(self, fn, *args, **kwargs):
+            events.append(1)
+            future = RecordingFuture()
+            future.set_result(fn(*args, **kwargs))
+            return future
+
+    report = validate_stix.validate_bundle(stix_location, reference_ids, RecordingExecutor(), chunk_size=100,
+                                           window=3)
+    assert report == validate_stix.validate_bundle(stix_location, reference_ids, chunk_size=100)
+    assert events.count(1) == -(-report["objects"] // 100) > 3
+    assert max(itertools.accumulate(events)) == 3
+
+
+@pytest.mark.parametrize("module", STAGE_MODULES)
+def test_import_time(dir_location, record_property, module):
+    """Tests that importing a stage doesn't load the heavy dependencies, which are imported by the functions
+    using them, and records the import time of the stage in the test report"""
+    script = (f"import sys, time; start = time.perf_counter(); import {module}; "
+              f"print(time.perf_counter() - start); "
+              f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    result = subprocess.run([sys.executable, "-c", script], cwd=pathlib.Path(dir_location, "src"),
+                            capture_output=True, text=True, check=True)
+    seconds, loaded = result.stdout.split("\n")[:2]
+    record_property("import_seconds", float(seconds))
+    assert loaded == ""
+
+
 @pytest.mark.parametrize("attack_version", ATTACK_VERSIONS)
 @pytest.mark.parametrize("rev", NIST_REVS)
-def test_parse_framework(dir_location, attack_version, rev):
+def test_parse_framework(dir_location, attack_data, framework_output, attack_version, rev):
     """Tests parse_r4.py.bak.bak.bak with both frameworks"""
     dashed_rev = rev.replace('_', '-')
-    attack_version_filepath = attack_version.replace('.', '_')[1:]  # turn v10.1 into 10_1
-    dashed_attack_version = attack_version_filepath.replace('_', '-')
+    dashed_attack_version = attack_version.replace('.', '-')[1:]  # turn v10.1 into 10-1
     rx_input_controls = pathlib.Path(dir_location, "data", "controls", f"{dashed_rev}-controls.tsv")
     rx_input_mappings = pathlib.Path(dir_location, "data", "mappings",
                                      f"attack-{dashed_attack_version}-to-{dashed_rev}-mappings.tsv")
-    rx_output_controls = pathlib.Path(dir_location, "frameworks", f"attack_{attack_version_filepath}", rev,
-                                      "stix", f"{dashed_rev}-controls.json")
-    rx_output_mappings = pathlib.Path(dir_location, "frameworks", f"attack_{attack_version_filepath}", rev,
-                                      "stix", f"{dashed_rev}-mappings.json")
-    attack_data = get_attack_data(dir_location, attack_version)
+    rx_output_controls = framework_output / "stix" / f"{dashed_rev}-controls.json"
+    rx_output_mappings = framework_output / "stix" / f"{dashed_rev}-mappings.json"
+    rx_output_controls.parent.mkdir(exist_ok=True)
     if rev == R4:
         framework_id = "NIST 800-53 Revision 4"
     elif rev == R5:
@@ -163,3 +1016,51 @@ def test_parse_framework(dir_location, attack_version, rev):
         framework_id=framework_id,
         attack_data=attack_data,
     )
+
+
+@pytest.mark.parametrize("rev", NIST_REVS)
+def test_build_controls_stable_ids(dir_location, tmp_path, rev):
+    """Tests that rebuilding the controls reuses every STIX ID of the previous build, with each relationship
+    built once even if a control lists the same related control twice"""
+    dashed_rev = rev.replace('_', '-')
+    in_controls = pathlib.Path(dir_location, "data", "controls", f"{dashed_rev}-controls.tsv")
+    out_controls = tmp_path / f"{dashed_rev}-controls.json"
+    framework_id = "NIST 800-53 Revision 4" if rev == R4 else "NIST 800-53 Revision 5"
+
+    builds = []
+    for _ in range(2):
+        bundle = parse.build_controls(in_controls, out_controls, framework_id)
+        parse.save_bundle(bundle, out_controls)
+        builds.append({
+            (sdo.relationship_type, sdo.source_ref, sdo.target_ref) if sdo.type == "relationship"
+            else sdo.external_references[0].external_id: sdo.id
+            for sdo in bundle.objects
+        })
+        assert len(builds[-1]) == len(bundle.objects)  # no relationship is built twice
+
+    assert builds[0] == builds[1]
+
+
+def test_parse_controls_concurrently(dir_location):
+    """Tests that the control parsers leave their inputs unmodified, so that catalogs can be parsed in threads"""
+    control_ids = {"AC-1": "course-of-action--3d0b1c2a-7d1e-4c3b-9a51-64c1f8b1e8a1"}
+    relationship_ids = {"subcontrol-of": {}, "related-to": {}}
+    framework_ids = {R4: "NIST 800-53 Revision 4", R5: "NIST 800-53 Revision 5"}
+
+    def parse_rev(rev):
+        in_controls = pathlib.Path(dir_location, "data", "controls", f"{rev.replace('_', '-')}-controls.tsv")
+        parser = parse.controls_parser(framework_ids[rev])
+        return parser.parse_controls(in_controls, control_ids, relationship_ids, framework_ids[rev])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(parse_rev, NIST_REVS * 2))
+
+    assert control_ids == {"AC-1": "course-of-action--3d0b1c2a-7d1e-4c3b-9a51-64c1f8b1e8a1"}
+    assert relationship_ids == {"subcontrol-of": {}, "related-to": {}}
+    for bundle, assigned_ids in results:
+        assert assigned_ids["AC-1"] == control_ids["AC-1"]
+        stix_ids = {sdo.id for sdo in bundle.objects if sdo.type == "course-of-action"}
+        assert set(assigned_ids.values()) == stix_ids
+        relationships = [sdo for sdo in bundle.objects if sdo.type == "relationship"]
+        assert any(sdo.relationship_type == "subcontrol-of" for sdo in relationships)
+        assert all(sdo.source_ref in stix_ids and sdo.target_ref in stix_ids for sdo in relationships)